@@ -1,9 +1,17 @@
-from qick import *
-from AWGProgram import *
+from backend import *
 from compiler import *
 from server import *
+from compile_cache import *
+from compile_worker import *
+from asset_registry import *
+import asyncio
+import concurrent.futures
+import io
 import os
 import json
+import threading
+import time
+import numpy as np
 
 class FPGA_AWG(Server):
     
@@ -14,14 +22,41 @@ class FPGA_AWG(Server):
     envelope_dir_path = "/home/xilinx/FPGA_AWG/envelope_data" 
     program_dir_path = "/home/xilinx/FPGA_AWG/program_cfg"
 
+    compile_cache_entries = 16             # max number of compiled programs kept in memory
+    compile_cache_bytes = 64 * 2**20       # max total size of the compiled programs kept in memory
+    envelope_cache_bytes = 256 * 2**20     # max total size of the envelopes kept in memory
 
+    max_workers = 32                       # max number of commands handled at the same time
+    compile_workers = None                 # max number of programs compiled at the same time, None for one per core
 
-    def __init__(self):
+    # commands that don't change the files, the state or the hardware, they are served while another command holds the lock
+    READ_ONLY_COMMANDS = ["GET_STATE", "GET_WAVEFORM_LIST", "GET_ENVELOPE_LIST", "GET_PROGRAM_LIST",
+                          "COMPILE", "GET_JOB_STATUS", "CANCEL_JOB",
+                          "SET_RESPONSE_FORMAT", "GET_DEPENDENCIES", "GET_METRICS"]
+    # key: state, value: states the AWG can change to from this state
+    # armed: a program is loaded into the hardware and FIRE starts it
+    STATE_TRANSITIONS = {"listening": ["armed"], "armed": ["firing", "listening"], "firing": ["listening"]}
+
+    print_asm = True                       # print the asm of every compiled program
+
+    metrics_file = None                    # path the metrics are written to in the Prometheus text format, None for no file
+    metrics_interval = 10                  # seconds between two writes of metrics_file
+
+
+    def __init__(self, backend="qick"):
         """
         set up the communication and have an server actively listening 
+        BACKEND: "qick" to run on the FPGA, "mock" for the software stand-in (see backend.py)
         """
         super().__init__()
-
+        self.metrics.describe("command_seconds", "histogram", "time from receiving a command to its end", label="command")
+        self.metrics.describe("compile_seconds", "histogram", "time a compile worker took for a program")
+        self.metrics.describe("compiles_total", "counter", "compilations by result", label="result")
+        self.metrics.describe("config_all_seconds", "histogram", "time to load a compiled program into the hardware")
+        self.metrics.describe("state_seconds_total", "timer", "time spent in every AWG state", label="state")
+        self.metrics.describe("state_transitions_total", "counter", "changes into every AWG state", label="state")
+        self.metrics.describe("connections_total", "counter", "client connections accepted")
+        self.metrics.describe("connections_open", "gauge", "client connections open")
 
         # List of directory paths
         dir_paths = [FPGA_AWG.waveform_dir_path, FPGA_AWG.envelope_dir_path, FPGA_AWG.program_dir_path]
@@ -30,40 +65,42 @@ class FPGA_AWG(Server):
             if not os.path.exists(path):
                 os.makedirs(path)
    
-        # key: name; value: path to .json
-        self.waveform_lst = []     # list of registered waveforms
-        self.envelope_lst = []     # list of idata and qdata  
-        self.program_lst = []      # the program to be ran
+        # envelopes are stored as .npy, convert .csv files left from older versions
+        self._convert_csv_envelopes()
+
+        # all waveforms, envelopes and programs on disk, indexed and parsed, the compiler reads them from here
+        self.assets = AssetRegistry({"program": FPGA_AWG.program_dir_path,
+                                     "waveform": FPGA_AWG.waveform_dir_path,
+                                     "envelope": FPGA_AWG.envelope_dir_path},
+                                    max_envelope_bytes=FPGA_AWG.envelope_cache_bytes)
 
-        # register all .json files currently on disk into the above dicts
-        self.waveform_lst = self._load_files_to_lst(self.waveform_dir_path)
-        self.envelope_lst = self._load_files_to_lst(self.envelope_dir_path)
-        self.program_lst = self._load_files_to_lst(self.program_dir_path)
+        # held by every command that changes files, the state or the hardware
+        self._lock = threading.Lock()
 
         # start self.server on listening mode
+        self.state = None
         self.set_state("listening")   # does nothing other than indicating what AWG is doing
 
         # initialize FPGA: load the tproc onto FPGA
-        self.soc = QickSoc()
+        self.backend = backend
+        (self.soc, self.program_class) = load_backend(backend)
         self.soccfg = self.soc
-        self.awg_prog = AWGProgram(self.soccfg, self.soc)
+        self.awg_prog = self.program_class(self.soccfg, self.soc)
         self.trig_mode = "internal"  # defaults this to internal 
-        self.compiler = Compiler(self.awg_prog)        
+        self.armed_program = None    # name of the program loaded into the hardware
+        self.compiler = Compiler(self.awg_prog, assets=self.assets)
+
+        # compiled programs, START_PROGRAM skips compilation if the program and its files are unchanged
+        self.compile_cache = CompileCache(self.assets,
+                                          max_entries=FPGA_AWG.compile_cache_entries,
+                                          max_bytes=FPGA_AWG.compile_cache_bytes)
+        # programs are compiled in worker processes, the server only loads them into the hardware
+        self.compile_jobs = CompileJobs(backend, worker_soccfg(backend, self.soc), max_workers=FPGA_AWG.compile_workers,
+                                        assets=self.assets, metrics=self.metrics)
+        # report of the last compilation of every program (see Compiler.compile_report), key: program name
+        self.compile_reports = {}
         
 
-    def _load_files_to_lst(self, dir_path):
-        """
-        Helper function to load json files from a directory into a list.
-        Returns a list containing the names of all json files stored in current directory_path
-        """
-        file_lst = []
-        if os.path.exists(dir_path):
-            for filename in os.listdir(dir_path):
-                if filename.endswith('.json') or filename.endswith('.csv'):  # Check if the file is a .json or .csv file
-                    file_lst.append(os.path.splitext(filename)[0])
-        return file_lst
-
-
     def run_server(self):
         """
         run indefinitely
@@ -107,6 +144,26 @@ class FPGA_AWG(Server):
                                                   # will only instantiate AWGProgram if self.awg_prog is not None
             STOP_PROGRAM(name)           # stops the AWGProgram if it's running
                                                     # how to actually stop program when Qick is running?
+            ARM_PROGRAM(name)            # compile and load the program into the hardware without starting it
+            FIRE()                       # start the armed program, again for the next shot
+            UPDATE_PULSE(name, params)   # change freq, phase or gain of a live pulse of the armed or firing program,
+                                                  # params is a JSON object, e.g. {"gain": 2000}
+            COMPILE(name)                # compile the program in a worker process, returns a job id
+            GET_JOB_STATUS(job_id)       # queued, running, done, failed or cancelled
+            CANCEL_JOB(job_id)
+            BATCH ... END_BATCH          # runs the commands in between back to back and sends one combined ack
+            GET_DEPENDENCIES(name)       # the assets name uses and the assets that use it
+            GET_TIMELINE(name, range)    # the pulses of the compiled program as a NumPy table, range is a JSON object
+                                                  # {"start": first row, "stop": row after the last}, the table follows the ack as .npy
+            GET_COMPILE_REPORT(name)     # time spent in every compile phase and hardware resources used by the last
+                                                  # compilation of the program, also of a failed one
+            GET_METRICS()                # command latencies, bytes transferred, compile and config_all times, time spent
+                                                  # in every state and connection counts, see metrics.py
+            SET_RESPONSE_FORMAT(format)  # "text" (the default) or "json", the acks of this connection become JSON
+                                                  # objects with a status, an error class and a payload, see Server._send_server_ack
+
+            a command sent as "#<id> COMMAND" is answered with an ack tagged "#<id> ", so a client can send
+            many requests without waiting for each ack (see FPGA_AWG_client pipelined mode)
 
             CHECK_STATUS()               # return state "listening" or "firing". Is this even necessary? it will never be able to return firing
             SET_STATUS(status)           # force set the AWG into "firing pulses" or "waiting for upload" mode
@@ -117,319 +174,518 @@ class FPGA_AWG(Server):
 
         # bind server to socket    
         print(f"--------------- Server Starting... ---------------")
+        asyncio.run(self._serve())
+
+
+    async def _serve(self):
+        """
+        the event loop waits for commands on all connections, every command is run in a worker thread
+        """
+        loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=FPGA_AWG.max_workers)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((FPGA_AWG.host, FPGA_AWG.port))
         self.server_socket.listen()
+        self.server_socket.setblocking(False)
         self.is_running = True
         print(f"Server listening on port {FPGA_AWG.port}...")
 
-        # infinite loop to wait for connection 
-        while True:
-            try:
-                conn, addr = self.server_socket.accept()
+        connections = set()
+        if FPGA_AWG.metrics_file is not None:
+            connections.add(loop.create_task(self._write_metrics(loop)))
+        try:
+            # infinite loop to wait for connections
+            while True:
+                conn, addr = await loop.sock_accept(self.server_socket)
                 print(f"Connected by {addr}")
+                self.metrics.inc("connections_total")
+                self.metrics.inc("connections_open")
+                task = loop.create_task(self._serve_connection(loop, conn, addr))
+                connections.add(task)
+                task.add_done_callback(connections.discard)
+        finally:
+            self._executor.shutdown(wait=False)
 
-                # loop to process commands 
-                while True:
-                    try: 
-                        command = self.receive_string(conn)
-                        # handle the case where client is disconnected
-                        if command is None:
-                            break                        
-                        
-                        # process commands
-                        if command == "UPLOAD_WAVEFORM_CFG":
-                            self.upload_waveform_cfg(conn)
-
-                        elif command == "UPLOAD_ENVELOPE_DATA":
-                            self.upload_envelope_data(conn)
-
-                        elif command == "UPLOAD_PROGRAM":
-                            self.upload_program(conn)
-                    
-                        elif command == "DELETE_WAVEFORM_CFG":
-                            self.delete_waveform_config(conn)
-
-                        elif command == "DELETE_ALL_WAVEFORM_CFG":
-                            self.delete_all_waveform_config(conn)
-                            
-                        elif command == "DELETE_ENVELOPE_DATA":
-                            self.delete_envelope_data(conn)
-
-                        elif command == "DELETE_ALL_ENVELOPE_DATA":
-                            self.delete_all_envelope_data(conn)
-
-                        elif command == "DELETE_PROGRAM":
-                            self.delete_program(conn)
-
-                        elif command == "DELETE_ALL_PROGRAMS":
-                            self.delete_all_programs(conn)
-
-                        elif command == "SET_TRIGGER_MODE":
-                            self.set_trigger_mode(conn)
-                        
-                        elif command == "START_PROGRAM":
-                            self.start_program(conn)
-
-                        elif command == "STOP_PROGRAM": 
-                            self.stop_program(conn)
-
-                        elif command == "GET_WAVEFORM_LIST":
-                            self.get_waveform_lst(conn)
-
-                        elif command == "GET_ENVELOPE_LIST":
-                            self.get_envelope_lst(conn)
-                        
-                        elif command == "GET_PROGRAM_LIST":
-                            self.get_program_lst(conn)
-
-                        elif command == "GET_STATE":
-                            self.get_state(conn)
-
-                        else:
-                            msg = f"Unknown command: {command}"
-                            self._send_server_ack(conn, msg)
-
-                    except Exception as e:
-                        print(f"Error: {e}")
-                        break                   
-                
+
+    async def _serve_connection(self, loop, conn, addr):
+        conn.setblocking(False)
+        try:
+            # loop to process commands 
+            while True:
+                command = await self._async_receive_string(loop, conn)
+                # handle the case where client is disconnected
+                if command is None:
+                    break
+                await loop.run_in_executor(self._executor, self._run_command, conn, command)
+        except Exception as e:
+            print(f"Error: {e}")
+        finally:
+            self._response_formats.pop(conn, None)
+            conn.close()
+            self.metrics.inc("connections_open", -1)
+            print(f"Connection to {addr} has been closed.")
+
+
+    async def _write_metrics(self, loop):
+        """
+        writes the metrics to metrics_file every metrics_interval seconds, e.g. for the textfile collector of
+        the Prometheus node exporter
+        """
+        while True:
+            try:
+                await loop.run_in_executor(self._executor, self.metrics.write_prometheus, FPGA_AWG.metrics_file)
             except Exception as e:
-                conn.close()
-                print(f"Error: {e}")
-            finally:
-                conn.close()
-                print(f"Connection to {addr} has been closed.")
-                print(f"Server listening on port {FPGA_AWG.port}...")
+                print(f"Error writing metrics: {e}")
+            await asyncio.sleep(FPGA_AWG.metrics_interval)
+
+
+    def _run_command(self, conn, command):
+        """
+        runs in a worker thread. The arguments of the command are read from conn in blocking mode,
+        read-only commands run concurrently, all other commands hold self._lock (ARM_PROGRAM and
+        START_PROGRAM only after compiling, see _run_compiling_command)
+        """
+        conn.setblocking(True)
+        known = False
+        try:
+            self._request_start = time.perf_counter()
+            (self._request_id, command) = self._parse_request(command)
+            if command in FPGA_AWG.READ_ONLY_COMMANDS:
+                known = self._dispatch(conn, command)
+            elif command in ["ARM_PROGRAM", "START_PROGRAM"]:
+                known = self._run_compiling_command(conn, command)
+            else:
+                with self._lock:
+                    known = self._dispatch(conn, command)
+        finally:
+            # unknown commands share one label, a client sending garbage can't grow the metrics
+            self.metrics.observe("command_seconds", time.perf_counter() - self._request_start,
+                                 label=command if known else "unknown")
+            self._request_id = None
+            self._request_start = None
+            conn.setblocking(False)
         
         
+    def _run_compiling_command(self, conn, command):
+        """
+        ARM_PROGRAM or START_PROGRAM: the program is compiled in a worker process before the command takes
+        self._lock, so other commands (e.g. STOP_PROGRAM) are served while it compiles. The command then runs
+        holding the lock, it compiles again if a file of the program changed in the meantime
+        """
+        prog_name = self.receive_string(conn)
+        job_id = None
+        with self._lock:
+            self._collect_compile_jobs()
+            if self.state != "firing" and self.assets.exists("program", prog_name) and not self.compile_cache.contains(prog_name):
+                job_id = self.compile_jobs.submit(prog_name)
+        if job_id is not None:
+            self.compile_jobs.join(job_id)
+        with self._lock:
+            if command == "START_PROGRAM":
+                self.start_program(conn, prog_name=prog_name, job_id=job_id)
+            else:
+                self.arm_program(conn, prog_name=prog_name, job_id=job_id)
+        return True
+
+
+    def _dispatch(self, conn, command):
+        """
+        execute one command, its arguments are read from conn. Returns False if the command is unknown
+        """
+        if command == "UPLOAD_WAVEFORM_CFG":
+            self.upload_waveform_cfg(conn)
+
+        elif command == "UPLOAD_ENVELOPE_DATA":
+            self.upload_envelope_data(conn)
+
+        elif command == "UPLOAD_PROGRAM":
+            self.upload_program(conn)
+
+        elif command == "DELETE_WAVEFORM_CFG":
+            self.delete_waveform_config(conn)
+
+        elif command == "DELETE_ALL_WAVEFORM_CFG":
+            self.delete_all_waveform_config(conn)
+
+        elif command == "DELETE_ENVELOPE_DATA":
+            self.delete_envelope_data(conn)
+
+        elif command == "DELETE_ALL_ENVELOPE_DATA":
+            self.delete_all_envelope_data(conn)
+
+        elif command == "DELETE_PROGRAM":
+            self.delete_program(conn)
+
+        elif command == "DELETE_ALL_PROGRAMS":
+            self.delete_all_programs(conn)
+
+        elif command == "SET_TRIGGER_MODE":
+            self.set_trigger_mode(conn)
+
+        elif command == "START_PROGRAM":
+            self.start_program(conn)
+
+        elif command == "STOP_PROGRAM": 
+            self.stop_program(conn)
+
+        elif command == "ARM_PROGRAM":
+            self.arm_program(conn)
+
+        elif command == "FIRE":
+            self.fire(conn)
+
+        elif command == "UPDATE_PULSE":
+            self.update_pulse(conn)
+
+        elif command == "COMPILE":
+            self.compile_program(conn)
+
+        elif command == "GET_JOB_STATUS":
+            self.get_job_status(conn)
+
+        elif command == "CANCEL_JOB":
+            self.cancel_job(conn)
+
+        elif command == "GET_WAVEFORM_LIST":
+            self.get_waveform_lst(conn)
+
+        elif command == "GET_ENVELOPE_LIST":
+            self.get_envelope_lst(conn)
+
+        elif command == "GET_PROGRAM_LIST":
+            self.get_program_lst(conn)
+
+        elif command == "GET_STATE":
+            self.get_state(conn)
+
+        elif command == "BATCH":
+            self.run_batch(conn)
+
+        elif command == "SET_RESPONSE_FORMAT":
+            self.set_response_format(conn)
+
+        elif command == "GET_DEPENDENCIES":
+            self.get_dependencies(conn)
+
+        elif command == "GET_TIMELINE":
+            self.get_timeline(conn)
+
+        elif command == "GET_COMPILE_REPORT":
+            self.get_compile_report(conn)
+
+        elif command == "GET_METRICS":
+            self.get_metrics(conn)
+
+        else:
+            msg = f"Unknown command: {command}"
+            self._send_server_ack(conn, msg, error="UnknownCommandError")
+            return False
+        return True
+
+
+    def run_batch(self, conn):
+        """
+        BATCH is followed by any number of commands and END_BATCH. The commands are executed back to back
+        and answered with one combined ack, so a whole experiment setup is uploaded in one round trip
+        """
+        results = []    # (command, responses of the command)
+        self._batch_acks = []
+        try:
+            while True:
+                command = self.receive_string(conn)
+                if command is None:
+                    # client disconnected, the run loop notices on its next read
+                    return
+                if command == "END_BATCH":
+                    break
+                n = len(self._batch_acks)
+                if command == "BATCH":
+                    self._send_server_ack(conn, "BATCH can't be nested.", error="InvalidArgumentError")
+                else:
+                    self._dispatch(conn, command)
+                results.append((command, self._batch_acks[n:]))
+        finally:
+            self._batch_acks = None
+        lines = [f"{i}: {command}: {' '.join(r['message'] for r in responses)}" for i, (command, responses) in enumerate(results)]
+        msg = f"Batch of {len(results)} commands done.\n" + "\n".join(lines)
+        # a command answers with exactly one response, unless the client disconnected in between
+        payload = [{"command": command, **{key: r[key] for key in ["status", "error", "message", "payload"]}}
+                   for (command, responses) in results for r in responses[:1]]
+        failed = any(r["status"] == "error" for r in payload)
+        self._send_server_ack(conn, msg, payload=payload, error="BatchError" if failed else None)
+
+
     def get_waveform_lst(self, conn):
-        msg = f"Current waveform list: {self.waveform_lst.__repr__()}"
-        self._send_server_ack(conn, msg)
+        names = self.assets.names("waveform")
+        msg = f"Current waveform list: {names.__repr__()}"
+        self._send_server_ack(conn, msg, payload=names)
     
     def get_envelope_lst(self, conn):
-        msg = f"Current envelope list: {self.envelope_lst.__repr__()}"
-        self._send_server_ack(conn, msg)
+        names = self.assets.names("envelope")
+        msg = f"Current envelope list: {names.__repr__()}"
+        self._send_server_ack(conn, msg, payload=names)
 
     def get_program_lst(self, conn):
-        msg = f"Current program list: {self.program_lst.__repr__()}"
-        self._send_server_ack(conn, msg)
+        names = self.assets.names("program")
+        msg = f"Current program list: {names.__repr__()}"
+        self._send_server_ack(conn, msg, payload=names)
        
     def get_state(self, conn):
         msg = f"Current state is {self.state}..."
-        self._send_server_ack(conn, msg)
+        self._send_server_ack(conn, msg, payload={"state": self.state, "armed_program": self.armed_program})
 
     def set_state(self, state):
         """
-        set the AWG into listening state or firing state
+        set the AWG into listening state or firing state, only the changes in STATE_TRANSITIONS are allowed
         """        
+        if state not in FPGA_AWG.STATE_TRANSITIONS:
+            raise RuntimeError(f"Unknown AWG state: {state}")
+        if self.state is not None and state != self.state and state not in FPGA_AWG.STATE_TRANSITIONS[self.state]:
+            raise RuntimeError(f"AWG state can't change from {self.state} to {state}")
+        if state != self.state:
+            self.metrics.switch("state_seconds_total", state)
+            self.metrics.inc("state_transitions_total", label=state)
         self.state = state
     
 
     def upload_waveform_cfg(self, conn):
-        if self.state != "listening":
+        # read the arguments before refusing, the next request follows them on conn
+        name = self.receive_string(conn)
+        if self.state == "firing":
+            self.discard_file(conn)
             msg = f"Can't receive file: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return 
-        name = self.receive_string(conn)
         # filename is not used here 
         filename = self.receive_file(conn, FPGA_AWG.waveform_dir_path, name=name)            # save the config file to disk; filename does not contain abs path
-
-        if name not in self.waveform_lst:
-            self.waveform_lst.append(name)                 
+        if filename is None:
+            msg = "Failed to receive file."
+            self._send_server_ack(conn, msg, error="TransferError")
+            return
+        self.assets.add("waveform", name)
+        updated = self._file_changed("waveform", name)
         msg = "File received successfully."
-        self._send_server_ack(conn, msg)
+        self._send_server_ack(conn, msg, payload={"name": name, "updated_programs": updated})
     
 
     def upload_envelope_data(self, conn):
-        if self.state != "listening":
+        name = self.receive_string(conn)
+        if self.state == "firing":
+            self.discard_file(conn)
             msg = f"Can't receive file: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return 
 
-        name = self.receive_string(conn)
-        filename = self.receive_file(conn, FPGA_AWG.envelope_dir_path, name=name, file_type=".csv")
-
-        if name not in self.envelope_lst:
-            self.envelope_lst.append(name) 
+        # the client sends a .csv or a .npy file, receive it to a temporary file and store it as .npy
+        tmp_path = os.path.join(FPGA_AWG.envelope_dir_path, f".{name}.upload").replace('\\', '/')
+        filename = self.receive_file(conn, FPGA_AWG.envelope_dir_path, name=f".{name}", file_type=".upload")
+        if filename is None:
+            msg = "Failed to receive file."
+            self._send_server_ack(conn, msg, error="TransferError")
+            return
+        try:
+            data = self._store_envelope(tmp_path, name, os.path.splitext(filename)[1])
+        except Exception as e:
+            msg = f"Error: {e}"
+            self._send_server_ack(conn, msg, error="FileError")
+            return
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.assets.add("envelope", name, data)
+        updated = self._file_changed("envelope", name)
         msg = "File received successfully."
-        self._send_server_ack(conn, msg)
+        self._send_server_ack(conn, msg, payload={"name": name, "updated_programs": updated})
+
+
+    def _store_envelope(self, src_path, name, file_type):
+        """
+        convert the envelope in src_path (.csv with one number per row, or .npy) to int16 and save it
+        as envelope_data/name.npy, returns the int16 array
+        """
+        if file_type == ".csv":
+            data = np.loadtxt(src_path, delimiter=",", usecols=0, ndmin=1)
+        elif file_type == ".npy":
+            data = np.load(src_path, allow_pickle=False)
+        else:
+            raise RuntimeError(f"Envelope data must be a .csv or a .npy file, got {file_type}")
+        if data.ndim != 1:
+            raise RuntimeError(f"Envelope data must be one dimensional, got shape {data.shape}")
+        data = np.round(data)
+        if len(data) > 0 and (data.max() > np.iinfo(np.int16).max or data.min() < np.iinfo(np.int16).min):
+            raise RuntimeError("Envelope data exceeds the int16 range")
+        path = os.path.join(FPGA_AWG.envelope_dir_path, name + ".npy").replace('\\', '/')
+        data = data.astype(np.int16)
+        np.save(path, data)
+        return data
+
+
+    def _convert_csv_envelopes(self):
+        for filename in os.listdir(FPGA_AWG.envelope_dir_path):
+            if filename.endswith('.csv'):
+                path = os.path.join(FPGA_AWG.envelope_dir_path, filename).replace('\\', '/')
+                try:
+                    self._store_envelope(path, os.path.splitext(filename)[0], ".csv")
+                    os.remove(path)
+                except Exception as e:
+                    print(f"Error converting {filename} to .npy: {e}")
 
 
     # upload the program config 
     def upload_program(self, conn):
-        if self.state != "listening":
+        name = self.receive_string(conn)
+        if self.state == "firing":
             msg = f"Can't receive file: current AWG state is {self.state}."
-            # TODO: need to empty recv buffer here 
-            self.empty_recv_buffer(conn)
-            self._send_server_ack(conn, msg)
+            self.discard_file(conn)
+            self._send_server_ack(conn, msg, error="StateError")
             return
         
-        name = self.receive_string(conn)
         filename = self.receive_file(conn, FPGA_AWG.program_dir_path, name=name)
- 
-        if name not in self.program_lst:
-            self.program_lst.append(name)
+        if filename is None:
+            msg = "Failed to receive file."
+            self._send_server_ack(conn, msg, error="TransferError")
+            return
+        self.assets.add("program", name)
+        updated = self._file_changed("program", name)
         msg = "File received successfully."
-        self._send_server_ack(conn, msg)
+        self._send_server_ack(conn, msg, payload={"name": name, "updated_programs": updated})
 
 
     def delete_waveform_config(self, conn):
-        if self.state != "listening":
+        name = self.receive_string(conn)
+        if self.state == "firing":
             msg = f"Can't receive file: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return
 
-        name = self.receive_string(conn)
-        if name not in self.waveform_lst:
+        if not self.assets.exists("waveform", name):
             msg = f"{name} is not found in waveform list."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="NotFoundError")
         else:
-            self._delete_helper(conn, FPGA_AWG.waveform_dir_path, name)           
+            self._delete_helper(conn, "waveform", name)           
 
 
     def delete_all_waveform_config(self, conn):
-        if self.state != "listening":
+        if self.state == "firing":
             msg = f"Can't receive file: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return
 
-        lst = self.waveform_lst[:]
+        lst = self.assets.names("waveform")
         try:
             for name in lst:
-                self._delete_all_helper(conn, FPGA_AWG.waveform_dir_path, name)           
+                self._delete_all_helper("waveform", name)           
             msg = f"All waveforms are deleted successfully."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, payload=lst)
         except Exception as e:
             msg = f"Error: {e}"
-            self._send_server_ack(conn, msg)  
+            self._send_server_ack(conn, msg, error="FileError")  
 
 
     def delete_envelope_data(self, conn):
-        if self.state != "listening":
+        name = self.receive_string(conn)
+        if self.state == "firing":
             msg = f"Can't delete file: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return 
         
-        name = self.receive_string(conn)
-        if name not in self.envelope_lst:
+        if not self.assets.exists("envelope", name):
             msg = f"{name} is not found in envelope list."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="NotFoundError")
         else:
-            self._delete_helper(conn, FPGA_AWG.envelope_dir_path, name)
+            self._delete_helper(conn, "envelope", name)
 
 
     def delete_all_envelope_data(self, conn):
-        if self.state != "listening":
+        if self.state == "firing":
             msg = f"Can't delete file: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return 
         
-        lst = self.envelope_lst[:]
+        lst = self.assets.names("envelope")
         try:
             for name in lst:
-                self._delete_all_helper(conn, FPGA_AWG.envelope_dir_path, name) 
+                self._delete_all_helper("envelope", name) 
             msg = f"All envelope data are deleted successfully."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, payload=lst)
         except Exception as e:
             msg = f"Error: {e}"
-            self._send_server_ack(conn, msg)           
+            self._send_server_ack(conn, msg, error="FileError")           
     
     
     def delete_program(self, conn):
-        if self.state != "listening":
+        name = self.receive_string(conn)
+        if self.state == "firing":
             msg = f"Can't delete file: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return
         
-        name = self.receive_string(conn)
-        if name not in self.program_lst:
+        if not self.assets.exists("program", name):
             msg = f"{name} is not found in program list."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="NotFoundError")
         else:
-            self._delete_helper(conn, FPGA_AWG.program_dir_path, name)
+            self._delete_helper(conn, "program", name)
          
     
     def delete_all_programs(self, conn):
-         if self.state != "listening":
+         if self.state == "firing":
             msg = f"Can't delete file: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return
         
-         lst = self.program_lst[:]
+         lst = self.assets.names("program")
          try:
             for name in lst:
-                self._delete_all_helper(conn, FPGA_AWG.program_dir_path, name)
+                self._delete_all_helper("program", name)
             msg = f"All programs are deleted successfully."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, payload=lst)
          except Exception as e:
             msg = f"Error: {e}"
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="FileError")
         
-    def _delete_helper(self, conn, root_dir, name):
+    def _delete_helper(self, conn, kind, name):
         try:
-            file_type = ".json"
-            if root_dir == FPGA_AWG.program_dir_path:
-                target_lst = self.program_lst
-                    
-            elif root_dir ==  FPGA_AWG.envelope_dir_path:
-                target_lst = self.envelope_lst
-                file_type = ".csv"
-                    
-            elif root_dir == FPGA_AWG.waveform_dir_path:
-                target_lst = self.waveform_lst
-   
-            path = os.path.join(root_dir, name + file_type).replace('\\', '/')  # Ensure the path uses forward slashes
-            os.remove(path)
-            
-            target_lst.remove(name)
+            self._delete_all_helper(kind, name)
             msg = f"{name} is deleted successfully."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, payload={"name": name})
         except Exception as e:
             msg = f"Error: {e}"
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="FileError")
                      
 
-    def _delete_all_helper(self, conn, root_dir, name):
-            file_type = ".json"
-            if root_dir == FPGA_AWG.program_dir_path:
-                target_lst = self.program_lst
-                    
-            elif root_dir ==  FPGA_AWG.envelope_dir_path:
-                target_lst = self.envelope_lst
-                file_type = ".csv"
-                    
-            elif root_dir == FPGA_AWG.waveform_dir_path:
-                target_lst = self.waveform_lst
-   
-            path = os.path.join(root_dir, name + file_type).replace('\\', '/')  # Ensure the path uses forward slashes
-            os.remove(path)
-            
-            target_lst.remove(name)
+    def _delete_all_helper(self, kind, name):
+        """
+        delete the file name of kind, raises if it can't be deleted
+        """
+        os.remove(self.assets.path(kind, name))
+        self.assets.remove(kind, name)
+        self._file_changed(kind, name)
             
             
     def set_trigger_mode(self, conn):
-        if self.state != "listening":
+        trig_mode = self.receive_string(conn)
+        if self.state == "firing":
             msg = f"Can't set trigger: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return
         
-        trig_mode = self.receive_string(conn)
         if trig_mode != "internal" and trig_mode != "external":
             msg = f"Trigger can only be 'internal' or 'external'."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="InvalidArgumentError")
             return     
         self.trig_mode = trig_mode
         msg = f"Trigger is set to {trig_mode}."
-        self._send_server_ack(conn, msg)
+        self._send_server_ack(conn, msg, payload={"trig_mode": trig_mode})
 
 
 
 
     # how to get rid of the initial delay time when running the program?
-    def start_program(self, conn):
+    def start_program(self, conn, prog_name=None, job_id=None):
         """
         Start the Qick program. At this point, all the registers are already set and envelope memory loaded
+        PROG_NAME: read from conn if None, JOB_ID: compile job of the program submitted ahead, see _arm
         """
 
         """
@@ -442,62 +698,468 @@ class FPGA_AWG(Server):
 
 
 
-        External mode: 
-            when receives a trigger, it uploads the sweep parameter and pulse
-            to do it, at the end of every pulse (at the end of the whole sequence specified by prog_cfg),
-            update with mathi the parameter that should be sweeped. I should allow multiple parameters to
-            be sweeped, and give the user the option to choose if they just want to sweep one
-            to define the sweeped parameter, we should just allow the user to define sweep param in the 
-            prog_cfg
+        Sweeps:
+            the parameters to sweep are defined in the sweeps of the prog_cfg, the compiler turns them into
+            tproc loops around the whole sequence that update the swept registers with mathi after every
+            repetition (see Compiler._parse_sweeps), so all sweep points run after one start without the host.
             for envelope, I think it is the best to define them in wf_cfg instead of in prog_cfg. Just put
             idata and qdata in the json file.
-
-            Let's say 
         """
         
-        prog_name = self.receive_string(conn)
-        if self.state != "listening":
+        if prog_name is None:
+            prog_name = self.receive_string(conn)
+        if self.state == "firing":
             msg = f"Can't start program: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return
         
+        if not self.assets.exists("program", prog_name):
+            msg = f"Program {prog_name} is not found in program list."
+            self._send_server_ack(conn, msg, error="NotFoundError")
+            return
 
-        if prog_name not in self.program_lst:
+        try:
+            (compile_time, load_time, cached) = self._arm(prog_name, job_id)
+        except Exception as e:
+            self._send_server_ack(conn, str(e), payload={"program": prog_name, "report": self.compile_reports.get(prog_name)},
+                                  error=self._error_class(str(e)))
+            return
+        try:
+            start_time = self._fire()
+        except Exception as e:
+            msg = f"Runtime Error: {e}"
+            self._send_server_ack(conn, msg, error="RuntimeError")
+            return
+
+        msg = (f"Program [{prog_name}] has started... (compile {compile_time * 1e3:.1f} ms{', cached' if cached else ''}, "
+               f"load {load_time * 1e3:.1f} ms, start {start_time * 1e3:.1f} ms)")
+        self._send_server_ack(conn, msg, payload={"program": prog_name, "compile_time": compile_time, "load_time": load_time,
+                                                  "start_time": start_time, "cached": cached, "report": self.compiler.report})
+
+
+    def arm_program(self, conn, prog_name=None, job_id=None):
+        """
+        compile prog_name and load it into the tproc and the envelope memories, FIRE then only has to start the tproc
+        the program stays armed until STOP_PROGRAM, another ARM_PROGRAM or a change of one of its files
+        PROG_NAME: read from conn if None, JOB_ID: compile job of the program submitted ahead, see _arm
+        """
+        if prog_name is None:
+            prog_name = self.receive_string(conn)
+        if self.state == "firing":
+            msg = f"Can't arm program: current AWG state is {self.state}."
+            self._send_server_ack(conn, msg, error="StateError")
+            return
+
+        if not self.assets.exists("program", prog_name):
             msg = f"Program {prog_name} is not found in program list."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="NotFoundError")
             return
 
-        # disallows all uploads and deletions and trigger set commands during firing state
-        self.set_state("firing")
+        try:
+            (compile_time, load_time, cached) = self._arm(prog_name, job_id)
+        except Exception as e:
+            self._send_server_ack(conn, str(e), payload={"program": prog_name, "report": self.compile_reports.get(prog_name)},
+                                  error=self._error_class(str(e)))
+            return
+        msg = (f"Program [{prog_name}] is armed in {(compile_time + load_time) * 1e3:.1f} ms "
+               f"(compile {compile_time * 1e3:.1f} ms{', cached' if cached else ''}, load {load_time * 1e3:.1f} ms).")
+        self._send_server_ack(conn, msg, payload={"program": prog_name, "compile_time": compile_time, "load_time": load_time,
+                                                  "cached": cached, "report": self.compiler.report})
 
-        # compile program and save asm into self.awg_prog
-        # whenever a new program is uploaded, self.awg_prog should be reinit
 
+    def fire(self, conn):
+        """
+        start the armed program. FIRE while firing restarts the program, so back to back shots only
+        need the start of the tproc
+        """
+        if self.state == "listening":
+            msg = f"No program is armed: current AWG state is {self.state}."
+            self._send_server_ack(conn, msg, error="StateError")
+            return
         try:
-            self.compiler.compile(prog_name)
+            start_time = self._fire()
         except Exception as e:
-            msg = f"Compilation Error: {e}"
-            self.set_state("listening")
-            self._send_server_ack(conn, msg)
+            msg = f"Runtime Error: {e}"
+            self._send_server_ack(conn, msg, error="RuntimeError")
+            return
+        msg = f"Program [{self.armed_program}] has fired in {start_time * 1e3:.3f} ms."
+        self._send_server_ack(conn, msg, payload={"program": self.armed_program, "start_time": start_time})
+
+
+    def update_pulse(self, conn):
+        """
+        change the freq, phase or gain of a live pulse (see live_pulses of the program config) of the armed or
+        firing program without compiling or loading it again. The values are written into the tproc data memory,
+        the program reads them at the start of every repetition (every sweep point, or every FIRE).
+        The waveform config is not changed: arming the program again starts from its values
+        """
+        pulse_name = self.receive_string(conn)
+        params = self.receive_string(conn)
+        try:
+            params = json.loads(params)
+            if not isinstance(params, dict):
+                raise ValueError("expected a JSON object")
+        except (TypeError, ValueError) as e:
+            msg = f"Can't read the new values of pulse {pulse_name}: {e}"
+            self._send_server_ack(conn, msg, error="InvalidArgumentError")
+            return
+        if self.state == "listening":
+            msg = f"No program is armed: current AWG state is {self.state}."
+            self._send_server_ack(conn, msg, error="StateError")
+            return
+
+        t_start = time.perf_counter()
+        try:
+            table = self.compiler.live_update(pulse_name, params)
+        except RuntimeError as e:
+            self._send_server_ack(conn, str(e), error="InvalidArgumentError")
+            return
+        try:
+            self._write_live_table(table)
+        except Exception as e:
+            msg = f"Runtime Error: {e}"
+            self._send_server_ack(conn, msg, error="RuntimeError")
             return
+        update_time = time.perf_counter() - t_start
+        msg = f"Pulse {pulse_name} of program [{self.armed_program}] is updated in {update_time * 1e3:.3f} ms: {params}"
+        self._send_server_ack(conn, msg, payload={"program": self.armed_program, "pulse": pulse_name, "params": params,
+                                                  "update_time": update_time})
+
 
-        print(self.awg_prog.asm())
+    def _write_live_table(self, table):
+        """
+        TABLE: {address: value} to write into the tproc data memory
+        """
+        for addr, value in table.items():
+            self.soc.tproc.single_write(addr=addr, data=value)
 
+
+    def _arm(self, prog_name, job_id=None):
+        """
+        compile prog_name (or take it from the compile cache) and load it into the hardware, called with self._lock held
+        JOB_ID: finished compile job of prog_name submitted before the lock was taken (see _run_compiling_command),
+                None to compile holding the lock (e.g. in a BATCH, which runs back to back)
+        returns (compile time, load time, True if the compilation was cached), times in seconds
+        """
+        # compile program and save asm into self.awg_prog
+        t_start = time.perf_counter()
+        job = self.compile_jobs.status(job_id) if job_id is not None else None
+        if job is not None:
+            t_start = job["submit_time"]
+        # puts the job submitted ahead into the cache, unless a file of the program changed while it compiled
+        self._collect_compile_jobs()
+        compiled = self.compile_cache.get(prog_name)
+        cached = compiled is not None and job is None
+        if compiled is not None:
+            (awg_prog, compiler) = compiled
+            if cached:
+                self.metrics.inc("compiles_total", label="cached")
+                print(f"Program [{prog_name}] is unchanged, using the cached compilation.")
+        else:
+            if job is None or job["stale"] or job["state"] != "failed":
+                # no compilation ahead, or it is out of date: compile in a worker process into a fresh program
+                # (the current one may be in the cache or armed), the lock is held so no file changes meanwhile
+                job_id = self.compile_jobs.submit(prog_name)
+            try:
+                # raises RuntimeError with the compilation error, the armed program (if any) is still loaded
+                ((awg_prog, compiler), stale) = self.compile_jobs.wait(job_id)
+            finally:
+                # a failed compilation has a report up to the phase it failed in
+                job = self.compile_jobs.status(job_id)
+                self._save_report(prog_name, job["report"] if job is not None else None)
+            if not stale:
+                self._cache_compiled(prog_name, awg_prog, compiler)
+        t_compiled = time.perf_counter()
+
+        (self.awg_prog, self.compiler) = (awg_prog, compiler)
+        # the worker sends the compiler back without its assets
+        self.compiler.assets = self.assets
         try:
             self.awg_prog.config_all(self.soc)               # soc loads all parameters into registers and waveform data into PL memory
+            # the initial values of the live pulses, UPDATE_PULSE may have changed them for the previous program
+            self._write_live_table(self.compiler.live_table)
+        except Exception as e:
+            # the hardware may be partly loaded
+            self.armed_program = None
+            self.set_state("listening")
+            raise RuntimeError(f"Runtime Error: {e}")
+        t_loaded = time.perf_counter()
+        self.metrics.observe("config_all_seconds", t_loaded - t_compiled)
+        # the report is shared with the compiler in the compile cache, it keeps the time of the last config_all
+        self.compiler.report["timings"]["config_all"] = t_loaded - t_compiled
+        self._save_report(prog_name, self.compiler.report)
+
+        self.armed_program = prog_name
+        self.set_state("armed")
+        if not cached and FPGA_AWG.print_asm:
+            print(self.awg_prog.asm())
+        return (t_compiled - t_start, t_loaded - t_compiled, cached)
+
+
+    def _error_class(self, msg):
+        """
+        error class of the message of an exception raised by _arm
+        """
+        if msg.startswith("Compilation Error"):
+            return "CompilationError"
+        if msg.startswith("Can't"):
+            return "StateError"
+        return "RuntimeError"
+
+
+    def _fire(self):
+        """
+        start the armed program, returns the time it took in seconds
+        """
+        t_start = time.perf_counter()
+        try:
             self.soc.start_src(self.trig_mode)               # reset the trigger mode
             self.soc.start_tproc()                           # starts the tproc to run AWGProgram. Pulse will fire when trigger comes in "external" mode
         except Exception as e:
-            msg = f"Runtime Error: {e}"
+            self.armed_program = None
             self.set_state("listening")
-            self._send_server_ack(conn, msg)
+            raise e
+        # disallows all uploads and deletions and trigger set commands during firing state
+        self.set_state("firing")
+        return time.perf_counter() - t_start
+
+
+    def _cache_compiled(self, prog_name, awg_prog, compiler):
+        # asm code is 8 bytes per instruction
+        size = 8 * len(awg_prog.prog_list) + compiler.envelope_bytes
+        # the worker sends the compiler back without its assets, update needs them
+        compiler.assets = self.assets
+        self.compile_cache.put(prog_name, (awg_prog, compiler), compiler.dependencies, size)
+        self._save_report(prog_name, compiler.report)
+
+
+    def _save_report(self, prog_name, report):
+        if report is None:
+            # the compilation failed before it started, an older report would be misleading
+            self.compile_reports.pop(prog_name, None)
+        else:
+            self.compile_reports[prog_name] = report
+
+
+    def _collect_compile_jobs(self):
+        """
+        put the programs compiled by COMPILE into the compile cache
+        """
+        for (prog_name, (awg_prog, compiler)) in self.compile_jobs.collect():
+            self._cache_compiled(prog_name, awg_prog, compiler)
+
+
+    def compile_program(self, conn):
+        """
+        compile a program in a worker process without loading it, ARM_PROGRAM and START_PROGRAM then use
+        the compilation. Answers with the job id for GET_JOB_STATUS and CANCEL_JOB
+        """
+        prog_name = self.receive_string(conn)
+        if not self.assets.exists("program", prog_name):
+            msg = f"Program {prog_name} is not found in program list."
+            self._send_server_ack(conn, msg, error="NotFoundError")
+            return
+        job_id = self.compile_jobs.submit(prog_name)
+        msg = f"Compile job {job_id} of program [{prog_name}] is submitted."
+        self._send_server_ack(conn, msg, payload={"job_id": job_id, "program": prog_name})
+
+
+    def get_job_status(self, conn):
+        job_id = self.receive_string(conn)
+        job = self.compile_jobs.status(int(job_id)) if job_id.isdecimal() else None
+        if job is None:
+            msg = f"Compile job {job_id} is not found."
+            self._send_server_ack(conn, msg, error="NotFoundError")
             return
+        now = time.perf_counter()
+        if job["state"] == "queued":
+            elapsed = now - job["submit_time"]
+        elif job["state"] == "running":
+            elapsed = now - job["start_time"]
+        else:
+            elapsed = job["end_time"] - (job["start_time"] if job["start_time"] is not None else job["submit_time"])
+        msg = f"Compile job {job_id} of program [{job['prog_name']}] is {job['state']} ({elapsed:.3f} s)."
+        if job["error"] is not None:
+            msg += f" {job['error']}"
+        self._send_server_ack(conn, msg, payload={"job_id": int(job_id), "program": job["prog_name"], "state": job["state"],
+                                                  "elapsed": elapsed, "error": job["error"], "report": job["report"]})
+
+
+    def cancel_job(self, conn):
+        job_id = self.receive_string(conn)
+        job = self.compile_jobs.status(int(job_id)) if job_id.isdecimal() else None
+        if job is None:
+            msg = f"Compile job {job_id} is not found."
+            self._send_server_ack(conn, msg, error="NotFoundError")
+        elif self.compile_jobs.cancel(int(job_id)):
+            msg = f"Compile job {job_id} is cancelled."
+            self._send_server_ack(conn, msg, payload={"job_id": int(job_id), "cancelled": True})
+        else:
+            msg = f"Compile job {job_id} can't be cancelled, it is {job['state']}."
+            self._send_server_ack(conn, msg, payload={"job_id": int(job_id), "cancelled": False})
+
 
-        msg = f"Program [{prog_name}] has started..."
-        self._send_server_ack(conn, msg)
+    def _file_changed(self, kind, name):
+        """
+        the file name of kind was uploaded or deleted (then it's already removed from self.assets)
+        returns the names of the cached programs that were updated without compiling them again
+        """
+        patched = []
+        if kind in ["waveform", "envelope"] and self.assets.exists(kind, name):
+            # rebuild only the register blocks or envelope memory of the cached programs that use it
+            compilers = []
+            def patch(compiled):
+                if not compiled[1].update(kind, name):
+                    return False
+                compilers.append(compiled[1])
+                return True
+            patched = self.compile_cache.update(kind, name, patch)
+            for compiler in compilers:
+                # replace the saved report, it describes the program before the update
+                self._save_report(compiler.prog_name, compiler.report)
+            if len(patched) > 0:
+                print(f"{kind} {name} has changed, updated the compiled programs {patched}.")
+        else:
+            self.compile_cache.invalidate(kind, name)
+        self.compile_jobs.invalidate(kind, name)
+        if self.state == "armed" and (kind, name) in self.compiler.dependencies:
+            # the armed program would play the old version of the file
+            print(f"{kind} {name} of the armed program [{self.armed_program}] has changed, the program is disarmed.")
+            self.armed_program = None
+            self.set_state("listening")
+        return patched
+
+
+    def get_dependencies(self, conn):
+        """
+        the assets name (a program, a waveform or an envelope) uses and the assets that use it, directly
+        or through other assets, e.g. a program uses its waveforms and their envelopes
+        """
+        name = self.receive_string(conn)
+        kinds = [kind for kind in ["program", "waveform", "envelope"] if self.assets.exists(kind, name)]
+        if len(kinds) == 0:
+            msg = f"{name} is not found."
+            self._send_server_ack(conn, msg, error="NotFoundError")
+            return
+        payload = []
+        lines = []
+        for kind in kinds:
+            uses = self.assets.dependencies(kind, name)
+            used_by = self.assets.dependents(kind, name)
+            payload.append({"kind": kind, "name": name, "uses": [list(dep) for dep in uses],
+                            "used_by": [list(dep) for dep in used_by]})
+            lines.append(f"{kind} {name} uses {[f'{k} {n}' for (k, n) in uses]}, "
+                         f"used by {[f'{k} {n}' for (k, n) in used_by]}")
+        msg = "\n".join(lines)
+        self._send_server_ack(conn, msg, payload=payload)
 
 
     
+    def get_timeline(self, conn):
+        """
+        the pulses the compiled program plays, one row per pulse with loops and sweeps expanded (see Compiler.timeline).
+        The ack has the pulse names and loop paths of the ids in the table, the table follows the ack as .npy bytes
+        prefixed with their length (no bytes if the command failed). The program must be armed or compiled
+        """
+        prog_name = self.receive_string(conn)
+        rows = self.receive_string(conn)
+        if self._batch_acks is not None:
+            # the table can't follow a combined ack
+            msg = "GET_TIMELINE can't be sent in a batch."
+            self._send_server_ack(conn, msg, error="InvalidArgumentError")
+            return
+
+        def send_error(msg, error):
+            self._send_server_ack(conn, msg, error=error)
+            self._send_data(conn, b"")
+
+        try:
+            rows = json.loads(rows) if rows else {}
+            (start, stop) = (rows.get("start"), rows.get("stop"))
+            if any(row is not None and not isinstance(row, int) for row in (start, stop)):
+                raise ValueError("start and stop must be integers")
+        except (ValueError, AttributeError) as e:
+            send_error(f"Can't read the rows of the timeline: {e}", "InvalidArgumentError")
+            return
+        if prog_name == self.armed_program:
+            compiler = self.compiler
+        else:
+            self._collect_compile_jobs()
+            compiled = self.compile_cache.get(prog_name)
+            compiler = compiled[1] if compiled is not None else None
+        if compiler is None:
+            send_error(f"Program {prog_name} is not compiled, arm it or COMPILE it first.", "NotFoundError")
+            return
+
+        t_start = time.perf_counter()
+        (table, info) = compiler.timeline(start, stop)
+        buf = io.BytesIO()
+        np.save(buf, table, allow_pickle=False)
+        data = buf.getbuffer()
+        msg = (f"Timeline of program [{prog_name}]: {len(table)} of {info['rows']} pulses, {len(data)} bytes "
+               f"({(time.perf_counter() - t_start) * 1e3:.1f} ms).")
+        self._send_server_ack(conn, msg, payload={"program": prog_name, "rows": len(table), "total_rows": info["rows"],
+                                                  "pulses": info["pulses"], "loop_paths": info["loop_paths"],
+                                                  "nbytes": len(data)})
+        self._send_data(conn, data)
+
+
+    def get_compile_report(self, conn):
+        """
+        the report of the last compilation of the program (see Compiler.compile_report) by START_PROGRAM, ARM_PROGRAM
+        or COMPILE, with the time of config_all if it was loaded. A failed compilation reports the phase it failed in
+        """
+        prog_name = self.receive_string(conn)
+        self._collect_compile_jobs()
+        report = self.compile_reports.get(prog_name)
+        if report is None:
+            msg = f"Program {prog_name} has no compile report, arm it or COMPILE it first."
+            self._send_server_ack(conn, msg, error="NotFoundError")
+            return
+        self._send_server_ack(conn, self._report_summary(report), payload=report)
+
+
+    def _report_summary(self, report):
+        """
+        human readable summary of a compile report
+        """
+        timings = ", ".join(f"{phase} {seconds * 1e3:.1f} ms" for phase, seconds in report["timings"].items() if phase != "compile")
+        if report["phase"] is not None:
+            lines = [f"Compilation of program [{report['program']}] failed in {report['phase']} ({timings})."]
+        else:
+            lines = [f"Program [{report['program']}] compiled in {report['timings']['compile'] * 1e3:.1f} ms ({timings})."]
+        registers = report["registers"]
+        lines.append(f"instructions: {report['instructions']} of {report['instruction_capacity']}, "
+                     f"registers: {registers['used']} of {registers['capacity']} on pages {registers['pages']}"
+                     + (f", {registers['spilled_blocks']} spilled register blocks ({registers['reload_instructions']} regwi to reload them)"
+                        if registers["spilled_blocks"] > 0 else ""))
+        envelope_memory = report["envelope_memory"]
+        for memory in envelope_memory["channels"]:
+            lines.append(f"envelope memory of ch{memory['ch']}: {memory['samples']} of {memory['capacity']} samples")
+        if envelope_memory["envelope_bytes_saved"] > 0:
+            lines.append(f"envelopes: {envelope_memory['envelope_bytes']} bytes loaded, "
+                         f"{envelope_memory['envelope_bytes_saved']} bytes saved by sharing identical envelopes")
+        lines.append(f"largest time value: {report['max_time_value']} (max {Compiler.MAX_PULSE_TIME}), "
+                     f"last pulse ends at {report['end_time']} clk cycles")
+        return "\n".join(lines)
+
+
+    def get_metrics(self, conn):
+        """
+        all metrics (see Metrics.snapshot) and the current state. The latencies are histograms, the message
+        sums up the commands
+        """
+        snapshot = self.metrics.snapshot()
+        metrics = snapshot["metrics"]
+        lines = [f"Server up for {snapshot['uptime']:.0f} s, state {self.state}, "
+                 f"{metrics['connections_open']} open connections of {metrics['connections_total']}, "
+                 f"{metrics['received_bytes_total']} bytes received, {metrics['sent_bytes_total']} bytes sent."]
+        for command, histogram in metrics["command_seconds"].items():
+            lines.append(f"{command}: {histogram['count']} in {histogram['sum'] * 1e3:.1f} ms, "
+                         f"max {histogram['max'] * 1e3:.1f} ms")
+        self._send_server_ack(conn, "\n".join(lines), payload={"state": self.state, **snapshot})
+
+
     def stop_program(self, conn):
         """
         stops currently running program and set output of all generators to 0
@@ -505,18 +1167,19 @@ class FPGA_AWG(Server):
         # assumes the FPGA is currently in the listening state
         if self.state != "firing":
             msg = f"FPGA is not firing pulses: current AWG state is {self.state}."
-            self._send_server_ack(conn, msg)
+            self._send_server_ack(conn, msg, error="StateError")
             return
         
-        # stop all generators
+        # stop all generators, this also replaces the program in the tproc so the program is disarmed
         self.soc.reset_gens()
         # self.soc.stop_tproc()
         # reset awg program
-        self.awg_prog = AWGProgram(self.soccfg, self.soc)
-        self.compiler = Compiler(self.awg_prog)
+        self.awg_prog = self.program_class(self.soccfg, self.soc)
+        self.compiler = Compiler(self.awg_prog, assets=self.assets)
+        self.armed_program = None
         self.set_state("listening")
         msg = f"Program is stopped. Server resumes listening..."
-        self._send_server_ack(conn, msg)
+        self._send_server_ack(conn, msg, payload={"state": self.state})
 
 
 
@@ -525,9 +1188,7 @@ class FPGA_AWG(Server):
         """
         shut down the AWG program, empty the FPGA memory and instance arrays 
         """
-        self.waveform_lst.clear()
-        self.envelope_lst.clear()
-        self.program_lst.clear()
+        self.compile_jobs.shutdown()
         self.server.stop()
         self.set_status("shutdown")
         print("AWG shutdown.")
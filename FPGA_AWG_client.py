@@ -1,18 +1,54 @@
 from client import *
+import contextlib
+import io
+import numpy as np
 
 # a python based client 
 class FPGA_AWG_client(Client):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, pipelined=False, max_in_flight=64, structured=False, verbose=True):
+        """
+        PIPELINED: send commands without waiting for their acks, call wait_all() to collect them
+        STRUCTURED: the methods return the payload of the JSON response of the server and raise
+                    AWGServerError if the command failed. With structured=False (the default) they return the ack string
+        VERBOSE: print the message of every ack
+        """
+        super().__init__(pipelined=pipelined, max_in_flight=max_in_flight, structured=structured, verbose=verbose)
+        self.batch_result = None    # payload of the last batch, one response per command
+        self.timeline_info = None   # payload of the last get_timeline: pulse names and loop paths of the ids in the table
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        the commands in the with block are sent as one BATCH and answered with one combined ack
+
+            with client.batch():
+                client.upload_waveform_cfg("X.json", name="X")
+                client.upload_program("XY8.json", name="XY8")
+            client.batch_result     # [{"command", "status", "error", "message", "payload"}, ...]
+        """
+        self.send_command("BATCH")
+        self._in_batch = True
+        try:
+            yield
+        finally:
+            self._in_batch = False
+            self.send_string("END_BATCH")
+            try:
+                self.batch_result = self.receive_server_ack()
+            except AWGServerError as e:
+                # BatchError, the payload tells which commands failed
+                self.batch_result = e.payload
+                raise
 
     
     def upload_waveform_cfg(self, wf_cfg_path, name):
         if os.path.exists(wf_cfg_path):
-            self.send_string("UPLOAD_WAVEFORM_CFG")
+            self.send_command("UPLOAD_WAVEFORM_CFG")
             self.send_string(name)
             self.send_file(wf_cfg_path)
-            self.receive_server_ack()
+            return self.receive_server_ack()
         else:
             print(f"{wf_cfg_path} does not exist!")
 
@@ -20,71 +56,156 @@ class FPGA_AWG_client(Client):
     # Use this function to upload either i data or q data. 
     def upload_envelope_data(self, data_path, name):
         if os.path.exists(data_path):
-            self.send_string("UPLOAD_ENVELOPE_DATA")
+            self.send_command("UPLOAD_ENVELOPE_DATA")
             self.send_string(name)
             # if file is sent successfully without client side error
             self.send_file(data_path)
-            self.receive_server_ack()
+            return self.receive_server_ack()
         else: 
             print(f"{data_path} does not exist!")
 
+    # upload i data or q data from a numpy array, the array is sent as .npy without a temporary file
+    def upload_envelope_array(self, data, name):
+        data = np.asarray(data)
+        if data.ndim != 1:
+            print(f"Envelope data must be one dimensional, got shape {data.shape}!")
+            return
+        buf = io.BytesIO()
+        # the server checks the range and stores the data as int16
+        np.save(buf, data, allow_pickle=False)
+        self.send_command("UPLOAD_ENVELOPE_DATA")
+        self.send_string(name)
+        self.send_data(buf.getvalue(), name + ".npy")
+        return self.receive_server_ack()
+
     def upload_program(self, prog_cfg_path, name):
         if os.path.exists(prog_cfg_path):
-            self.send_string("UPLOAD_PROGRAM")
+            self.send_command("UPLOAD_PROGRAM")
             self.send_string(name)
             self.send_file(prog_cfg_path)
-            self.receive_server_ack()
+            return self.receive_server_ack()
         else: 
             print(f"{prog_cfg_path} does not exist!")
 
 
     def delete_waveform_cfg(self, name):
-        self.send_string("DELETE_WAVEFORM_CFG")
+        self.send_command("DELETE_WAVEFORM_CFG")
         self.send_string(name)
-        self.receive_server_ack()
+        return self.receive_server_ack()
 
 
     def delete_envelope_data(self, name):
-        self.send_string("DELETE_ENVELOPE_DATA")
+        self.send_command("DELETE_ENVELOPE_DATA")
         self.send_string(name)
-        self.receive_server_ack()
+        return self.receive_server_ack()
 
 
 
     def delete_program(self, name):
-        self.send_string("DELETE_PROGRAM")
+        self.send_command("DELETE_PROGRAM")
         self.send_string(name)
-        self.receive_server_ack()
+        return self.receive_server_ack()
 
     def get_waveform_lst(self):
-        self.send_string("GET_WAVEFORM_LIST")
-        self.receive_server_ack()
+        self.send_command("GET_WAVEFORM_LIST")
+        return self.receive_server_ack()
 
     def get_envelope_lst(self):
-        self.send_string("GET_ENVELOPE_LIST")
-        self.receive_server_ack()
+        self.send_command("GET_ENVELOPE_LIST")
+        return self.receive_server_ack()
 
     def get_program_lst(self):
-        self.send_string("GET_PROGRAM_LIST")
-        self.receive_server_ack()
+        self.send_command("GET_PROGRAM_LIST")
+        return self.receive_server_ack()
+
+    # the assets name uses and the assets that use it, e.g. the waveforms and envelopes of a program
+    def get_dependencies(self, name):
+        self.send_command("GET_DEPENDENCIES")
+        self.send_string(name)
+        return self.receive_server_ack()
+
+    # every pulse the compiled (armed or COMPILEd) program plays, as a NumPy structured array with the fields
+    # ch, start, duration (clk cycles), pulse, loop_path and page, see Compiler.timeline. Only rows start:stop if given.
+    # The names of the pulse and loop_path ids are in self.timeline_info["pulses"] and ["loop_paths"]
+    def get_timeline(self, name, start=None, stop=None):
+        if self.pipelined or self._in_batch:
+            # the table follows the ack
+            raise RuntimeError("get_timeline can't be pipelined or batched")
+        self.send_command("GET_TIMELINE")
+        self.send_string(name)
+        self.send_string(json.dumps({"start": start, "stop": stop}))
+        try:
+            self.timeline_info = self.receive_server_ack()
+        finally:
+            data = self._receive_data()
+        if data is None or len(data) == 0:
+            return None
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    # time spent in every phase of the last compilation of the program and the hardware resources it uses,
+    # also for a failed compilation, see Compiler.compile_report
+    def get_compile_report(self, name):
+        self.send_command("GET_COMPILE_REPORT")
+        self.send_string(name)
+        return self.receive_server_ack()
+
+    def get_metrics(self):
+        self.send_command("GET_METRICS")
+        return self.receive_server_ack()
 
     def get_state(self):
-        self.send_string("GET_STATE")
-        self.receive_server_ack()
+        self.send_command("GET_STATE")
+        return self.receive_server_ack()
 
     def set_trigger_mode(self, trig_mode):
-        self.send_string("SET_TRIGGER_MODE")
+        self.send_command("SET_TRIGGER_MODE")
         self.send_string(trig_mode)
-        self.receive_server_ack()
+        return self.receive_server_ack()
 
     def start_program(self, name):
-        self.send_string("START_PROGRAM")
+        self.send_command("START_PROGRAM")
         self.send_string(name)
-        self.receive_server_ack()
+        return self.receive_server_ack()
+
+    # compile and load the program without starting it, fire() then starts it with minimal latency
+    def arm_program(self, name):
+        self.send_command("ARM_PROGRAM")
+        self.send_string(name)
+        return self.receive_server_ack()
+
+    # start the armed program, call again for the next shot
+    def fire(self):
+        self.send_command("FIRE")
+        return self.receive_server_ack()
+
+    # change the freq (MHz), phase (deg) or gain of a live pulse of the armed or running program, e.g.
+    # update_pulse("X", gain=2000). The pulse must be listed in live_pulses of the program
+    def update_pulse(self, name, freq=None, phase=None, gain=None):
+        params = {field: value for field, value in [("freq", freq), ("phase", phase), ("gain", gain)] if value is not None}
+        self.send_command("UPDATE_PULSE")
+        self.send_string(name)
+        self.send_string(json.dumps(params))
+        return self.receive_server_ack()
+
+    # compile the program in the background, returns {"job_id", "program"}
+    def compile_program(self, name):
+        self.send_command("COMPILE")
+        self.send_string(name)
+        return self.receive_server_ack()
+
+    def get_job_status(self, job_id):
+        self.send_command("GET_JOB_STATUS")
+        self.send_string(str(job_id))
+        return self.receive_server_ack()
+
+    def cancel_job(self, job_id):
+        self.send_command("CANCEL_JOB")
+        self.send_string(str(job_id))
+        return self.receive_server_ack()
 
     def stop_program(self):
-        self.send_string("STOP_PROGRAM")
-        self.receive_server_ack()
+        self.send_command("STOP_PROGRAM")
+        return self.receive_server_ack()
 
         
         
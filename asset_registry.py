@@ -0,0 +1,321 @@
+from collections import OrderedDict
+import csv
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+from prog_parser import *
+
+
+class AssetRegistry():
+    """
+    All waveform configs, envelopes and programs known to the AWG, kept in memory so the compiler
+    doesn't open and parse files on every compile.
+
+    kind of an asset is one of "program", "waveform", "envelope"
+
+    waveform configs are kept as parsed dicts and programs as parsed configs plus the AST of every
+    program line, both are small. Envelopes are kept as int16 arrays up to max_envelope_bytes, the least
+    recently used are evicted and read from disk again when needed.
+
+    The registry also keeps the dependency graph of the assets: a program uses the waveforms it plays,
+    a waveform uses its i and q envelopes. An edge to an asset that doesn't exist (yet) is kept.
+
+    The files stay the source of truth: FPGA_AWG writes a file and then calls add (or remove after
+    deleting it), so the registry always matches the directories.
+    The parsed objects are shared, callers must not change them.
+    """
+
+    FILE_TYPES = {"program": ".json", "waveform": ".json", "envelope": ".npy"}
+    # envelopes copied into envelope_data by hand as .csv are still read, FPGA_AWG converts them on startup
+    LEGACY_FILE_TYPES = {"envelope": ".csv"}
+
+
+    def __init__(self, dir_paths, max_envelope_bytes=256 * 2**20, scan=True):
+        """
+        DIR_PATHS: key: kind, value: directory the files of this kind are stored in
+        """
+        self.dir_paths = dir_paths
+        self.max_envelope_bytes = max_envelope_bytes
+        # memory-map the envelope files instead of reading and caching them, see snapshot
+        self.map_envelopes = False
+        # key: kind, value: dict of name: file name (with extension), in upload order
+        self._index = {kind: {} for kind in AssetRegistry.FILE_TYPES}
+        # key: (kind, name), value: parsed config, for waveforms and programs
+        self._parsed = {}
+        # key: (kind, name), value: {channel: AST of the program line}, for programs
+        self._asts = {}
+        # key: name, value: int16 array, least recently used first
+        self._envelopes = OrderedDict()
+        self.envelope_bytes = 0
+        # key: (kind, name), value: sha256 digest of the file content
+        self._digests = {}
+        # dependency graph. key: (kind, name), value: set of (kind, name) it uses directly
+        self._uses = {}
+        # the reversed edges. key: (kind, name), value: set of (kind, name) that use it directly
+        self._used_by = {}
+        # uploads and deletes run under the lock of FPGA_AWG, but read-only commands don't take it
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        if scan:
+            self.scan()
+
+
+    def scan(self):
+        """
+        index (and parse the configs of) all files in the directories
+        """
+        with self._lock:
+            for kind, dir_path in self.dir_paths.items():
+                if not os.path.exists(dir_path):
+                    continue
+                for filename in sorted(os.listdir(dir_path)):
+                    (name, file_type) = os.path.splitext(filename)
+                    if name.startswith("."):
+                        # partial uploads
+                        continue
+                    if file_type == AssetRegistry.FILE_TYPES[kind]:
+                        self._index[kind][name] = filename
+                    elif file_type == AssetRegistry.LEGACY_FILE_TYPES.get(kind) and name not in self._index[kind]:
+                        self._index[kind][name] = filename
+                    else:
+                        continue
+                    self._parse(kind, name)
+
+
+    def add(self, kind, name, value=None):
+        """
+        the file name of kind was written, VALUE: the parsed content if the caller has it already
+        (the int16 array of an envelope), otherwise it's parsed from the file
+        """
+        with self._lock:
+            self._forget(kind, name)
+            self._index[kind][name] = name + AssetRegistry.FILE_TYPES[kind]
+            if kind == "envelope" and value is not None:
+                self._cache_envelope(name, value)
+            else:
+                self._parse(kind, name)
+
+
+    def remove(self, kind, name):
+        """
+        the file name of kind was deleted
+        """
+        with self._lock:
+            self._forget(kind, name)
+            self._index[kind].pop(name, None)
+
+
+    def names(self, kind):
+        with self._lock:
+            return list(self._index[kind])
+
+
+    def exists(self, kind, name):
+        return name in self._index[kind]
+
+
+    def path(self, kind, name):
+        filename = self._index[kind].get(name)
+        if filename is None:
+            raise FileNotFoundError(f"{kind} {name} is not found")
+        return os.path.join(self.dir_paths[kind], filename).replace('\\', '/')
+
+
+    def waveform(self, name):
+        """
+        the waveform config as a dict
+        """
+        return self._get_parsed("waveform", name)
+
+
+    def program(self, name):
+        """
+        the program config as a dict
+        """
+        return self._get_parsed("program", name)
+
+
+    def program_ast(self, name):
+        """
+        key: channel, e.g. "ch6", value: the program line of the channel parsed by parse_program_line
+        """
+        with self._lock:
+            # parses the program and its lines if they aren't yet
+            self._get_parsed("program", name)
+            return self._asts[name]
+
+
+    def envelope(self, name):
+        """
+        the envelope as an int16 array (a python list for .csv files)
+        """
+        if self.map_envelopes:
+            path = self.path("envelope", name)
+            return self._read_csv(path) if path.endswith(".csv") else np.load(path, mmap_mode='r')
+        with self._lock:
+            data = self._envelopes.get(name)
+            if data is not None:
+                self._envelopes.move_to_end(name)
+                self.hits += 1
+                return data
+            self.misses += 1
+            path = self.path("envelope", name)
+            if path.endswith(".csv"):
+                return self._read_csv(path)
+            data = np.load(path, allow_pickle=False)
+            self._cache_envelope(name, data)
+            return data
+
+
+    def dependencies(self, kind, name):
+        """
+        sorted list of (kind, name) of all assets kind name uses, directly or through other assets
+        """
+        with self._lock:
+            return self._reachable((kind, name), self._uses)
+
+
+    def dependents(self, kind, name):
+        """
+        sorted list of (kind, name) of all assets that use kind name, directly or through other assets
+        """
+        with self._lock:
+            return self._reachable((kind, name), self._used_by)
+
+
+    def _reachable(self, node, edges):
+        seen = set()
+        stack = [node]
+        while len(stack) > 0:
+            for other in edges.get(stack.pop(), ()):
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        seen.discard(node)
+        return sorted(seen)
+
+
+    def _set_uses(self, node, uses):
+        for other in self._uses.pop(node, ()):
+            self._used_by[other].discard(node)
+            if len(self._used_by[other]) == 0:
+                del self._used_by[other]
+        if len(uses) > 0:
+            self._uses[node] = set(uses)
+            for other in uses:
+                self._used_by.setdefault(other, set()).add(node)
+
+
+    def digest(self, kind, name):
+        """
+        sha256 digest of the content of the file, raises OSError if it doesn't exist
+        """
+        with self._lock:
+            digest = self._digests.get((kind, name))
+            if digest is None:
+                with open(self.path(kind, name), 'rb') as file:
+                    digest = hashlib.sha256(file.read()).digest()
+                self._digests[(kind, name)] = digest
+            return digest
+
+
+    def snapshot(self):
+        """
+        a copy of the index and the parsed configs to send to a compile worker process. Envelopes are not
+        copied, the worker memory-maps them, which is cheaper than sending them through a pipe
+        """
+        with self._lock:
+            registry = AssetRegistry(dict(self.dir_paths), max_envelope_bytes=0, scan=False)
+            registry.map_envelopes = True
+            registry._index = {kind: dict(index) for kind, index in self._index.items()}
+            registry._parsed = dict(self._parsed)
+            registry._asts = dict(self._asts)
+            return registry
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+    def _get_parsed(self, kind, name):
+        with self._lock:
+            value = self._parsed.get((kind, name))
+            if value is not None:
+                self.hits += 1
+                return value
+            # not parsed yet, or parsing failed at upload (then it raises again here)
+            self.misses += 1
+            self._parse(kind, name, raise_errors=True)
+            return self._parsed[(kind, name)]
+
+
+    def _parse(self, kind, name, raise_errors=False):
+        if kind == "envelope":
+            # read when it's first used
+            return
+        try:
+            with open(self.path(kind, name), 'rb') as file:
+                cfg = json.load(file)
+            if kind == "program":
+                asts = {ch: parse_program_line(prog_line) for ch, prog_line in cfg["prog_structure"].items()}
+                uses = set()
+                for nodes in asts.values():
+                    self._list_pulses(uses, nodes)
+                # swept waits are written like pulses
+                uses -= {("waveform", sweep["name"]) for sweep in cfg.get("sweeps", []) if "name" in sweep}
+                self._asts[name] = asts
+            else:
+                uses = {("envelope", cfg[key]) for key in ["i_data_name", "q_data_name"] if cfg.get(key) is not None}
+            self._parsed[(kind, name)] = cfg
+            self._set_uses((kind, name), uses)
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"Can't parse {kind} {name}: {e}")
+
+
+    def _list_pulses(self, uses, nodes):
+        for node in nodes:
+            if isinstance(node, Loop):
+                self._list_pulses(uses, node.body)
+            elif isinstance(node, Pulse):
+                uses.add(("waveform", node.name))
+
+
+    def _cache_envelope(self, name, data):
+        if data.nbytes > self.max_envelope_bytes:
+            return
+        self._envelopes[name] = data
+        self.envelope_bytes += data.nbytes
+        while self.envelope_bytes > self.max_envelope_bytes:
+            (_, old_data) = self._envelopes.popitem(last=False)
+            self.envelope_bytes -= old_data.nbytes
+
+
+    def _forget(self, kind, name):
+        self._parsed.pop((kind, name), None)
+        # the edges to the assets it uses, the ones of the assets that use it stay
+        self._set_uses((kind, name), set())
+        if kind == "program":
+            self._asts.pop(name, None)
+        self._digests.pop((kind, name), None)
+        if kind == "envelope" and name in self._envelopes:
+            self.envelope_bytes -= self._envelopes.pop(name).nbytes
+
+
+    def _read_csv(self, path):
+        envelope = []
+        with open(path, mode='r') as file:
+            for row in csv.reader(file):
+                envelope.append(int(row[0]))
+        return envelope
@@ -0,0 +1,43 @@
+BACKENDS = ["qick", "mock"]
+
+
+def load_backend(name):
+    """
+    returns (soc, program class) of the backend name
+        qick: QickSoc and AWGProgram, runs on the FPGA
+        mock: MockSoc and MockProgram, a software stand-in that runs on any machine
+    """
+    if name == "qick":
+        from qick import QickSoc
+        return QickSoc(), load_program_class(name)
+    elif name == "mock":
+        from mock_qick import MockSoc
+        return MockSoc(), load_program_class(name)
+    raise ValueError(f"Unknown backend: {name} (available backends: {BACKENDS})")
+
+
+def load_program_class(name):
+    """
+    returns the program class of the backend name without opening the hardware, used by the compile workers
+    """
+    if name == "qick":
+        from AWGProgram import AWGProgram
+        return AWGProgram
+    elif name == "mock":
+        from mock_qick import MockProgram
+        return MockProgram
+    raise ValueError(f"Unknown backend: {name} (available backends: {BACKENDS})")
+
+
+def worker_soccfg(name, soc):
+    """
+    returns a copy of the configuration of soc that can be sent to a compile worker process
+    """
+    if name == "qick":
+        from qick import QickConfig
+        return QickConfig(soc.get_cfg())
+    elif name == "mock":
+        # MockSoc is its own config, don't copy the program loaded into soc
+        from mock_qick import MockSoc
+        return MockSoc(realtime=soc.realtime)
+    raise ValueError(f"Unknown backend: {name} (available backends: {BACKENDS})")
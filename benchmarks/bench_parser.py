@@ -0,0 +1,108 @@
+"""
+Compares the old string-rescanning tokenizer with prog_parser on deeply nested loop() structures.
+
+The old scheduler tokenized a loop body again every time it entered the loop, so nested loop
+bodies were re-lexed once per iteration of every outer loop. The parser builds the AST once.
+
+run from the repository root:
+    python benchmarks/bench_parser.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from prog_parser import *
+
+
+def legacy_tokenize(prog_line):
+    # copy of the old Compiler.tokenize, kept here as the reference for the benchmark
+    EOL_char = '\n'
+    prog_line = prog_line.strip("[]").replace(" ", "") + EOL_char
+    prog_line = iter(prog_line)
+    in_loop = False
+    curr_token = ""
+    open_parenthesis = 0
+    result = []
+    for c in prog_line:
+        if not in_loop:
+            if c == ",":
+                if curr_token != "":
+                    result.append(curr_token)
+                    curr_token = ""
+            elif curr_token == "loop":
+                result.append("loop")
+                curr_token = ""
+                in_loop = True
+                open_parenthesis += 1
+            else:
+                if c == EOL_char:
+                    if curr_token != "":
+                        result.append(curr_token)
+                else:
+                    curr_token += c
+        else:
+            while c != ",":
+                curr_token += c
+                c = next(prog_line)
+            result.append(curr_token)
+            curr_token = ""
+            for c in prog_line:
+                if c == "(":
+                    open_parenthesis += 1
+                elif c == ")":
+                    open_parenthesis -= 1
+                if open_parenthesis > 0:
+                    curr_token += c
+                else:
+                    result.append(curr_token)
+                    curr_token = ""
+                    in_loop = False
+                    break
+    return result
+
+
+def legacy_walk(tokens):
+    # tokenizes every loop body once per loop iteration, like the old Scheduler.next_pulse
+    tokens = iter(tokens)
+    for t in tokens:
+        if t == "loop":
+            loop_count = int(next(tokens))
+            loop_body = next(tokens)
+            for _ in range(loop_count):
+                legacy_walk(legacy_tokenize(loop_body))
+
+
+def nested_program(depth, loop_count):
+    prog_line = "[X, 10, Y]"
+    for _ in range(depth):
+        prog_line = f"[X, 10, loop({loop_count}, {prog_line}), Y, 10]"
+    return prog_line
+
+
+def timeit(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def run_parser(prog_line):
+    parse_program_line.cache_clear()
+    parse_program_line(prog_line)
+
+
+def main():
+    print(f"{'depth':>5} {'count':>5} {'legacy [ms]':>12} {'parser [ms]':>12} {'speedup':>8}")
+    for depth in range(1, 7):
+        for loop_count in [2, 4, 8]:
+            prog_line = nested_program(depth, loop_count)
+            # skip cases where the old tokenizer would take too long
+            if loop_count ** depth > 10**5:
+                continue
+            t_legacy = timeit(lambda: legacy_walk(legacy_tokenize(prog_line)))
+            t_parser = timeit(run_parser, prog_line)
+            print(f"{depth:>5} {loop_count:>5} {t_legacy * 1e3:>12.3f} {t_parser * 1e3:>12.3f} {t_legacy / t_parser:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
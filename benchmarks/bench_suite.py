@@ -0,0 +1,366 @@
+"""
+Benchmarks of the compile, scheduling and transfer hot paths on the mock backend (mock_qick.py).
+
+Synthetic workloads:
+    xy8/xy16      XY8/XY16 blocks in loops with loop counts from 1 to 10^5
+    nested        XY8 in loops nested 1 to 6 deep
+    channels      XY8 loops on 1 to 8 channels, aligned and staggered
+    pulses        1 to 200 distinct pulses
+    update        a new phase of one of 50 or 200 pulses, applied by Compiler.update to the compiled program
+    simulate      DAC samples of XY8 loops rendered by WaveformSimulator, in chunks
+    envelope      arb pulses with envelopes from 48 to 65536 samples
+    parse         parsing of nested loop structures
+    upload        Client.send_file -> Server.receive_file over loopback
+
+For every case it reports wall time, peak memory (tracemalloc), number of emitted instructions
+and upload throughput, writes the results as JSON, and compares them with a stored baseline.
+The instruction counts are compared exactly, the timings only mean something against a baseline
+saved on the same machine, so save a new one before comparing on a different computer.
+
+run from the repository root:
+    python benchmarks/bench_suite.py                              # run and compare with benchmarks/baseline.json
+    python benchmarks/bench_suite.py --quick                      # only the small cases
+    python benchmarks/bench_suite.py --save-baseline              # store the results as the new baseline
+    python benchmarks/bench_suite.py --output results.json --tolerance 0.5
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from compiler import *
+from mock_qick import *
+from server import *
+from client import *
+from simulator import *
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# metrics where a larger value is a regression, and where a smaller value is a regression
+LOWER_IS_BETTER = ["wall_time", "peak_memory", "instructions"]
+HIGHER_IS_BETTER = ["throughput"]
+# wall time differences below this are timer noise
+MIN_WALL_TIME_DIFF = 2e-3
+
+XY8 = "X, 100, Y, 100, X, 100, Y, 100, Y, 100, X, 100, Y, 100, X, 100"
+XY16 = XY8 + ", -X, 100, -Y, 100, -X, 100, -Y, 100, -Y, 100, -X, 100, -Y, 100, -X, 100"
+
+
+
+class Workspace():
+    """
+    temporary directory with program_cfg, waveform_cfg and envelope_data, the compiler reads them
+    relative to the working directory
+    """
+
+    def __enter__(self):
+        self.old_cwd = os.getcwd()
+        self.path = tempfile.mkdtemp(prefix="awg_bench_")
+        for dir_name in ["program_cfg", "waveform_cfg", "envelope_data"]:
+            os.makedirs(os.path.join(self.path, dir_name))
+        os.chdir(self.path)
+        for name, phase in [("X", 0), ("Y", 90), ("-X", 180), ("-Y", 270)]:
+            self.add_waveform(name, {"style": "const", "freq": 100, "gain": 30000, "phase": phase, "length": 10})
+        return self
+
+    def __exit__(self, *args):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.path)
+
+    def add_waveform(self, name, cfg):
+        with open(os.path.join("waveform_cfg", name + ".json"), "w") as file:
+            json.dump(cfg, file)
+
+    def add_envelope(self, name, length):
+        # stored like FPGA_AWG stores uploaded envelopes
+        data = np.round(30000 * np.sin(np.pi * np.arange(length) / length)).astype(np.int16)
+        np.save(os.path.join("envelope_data", name + ".npy"), data)
+
+    def add_program(self, name, prog_structure):
+        with open(os.path.join("program_cfg", name + ".json"), "w") as file:
+            json.dump({"prog_structure": prog_structure}, file)
+
+
+
+def measure(f, repeat=5):
+    """
+    returns wall time (best of repeat runs) and peak memory of f(), and the value f returned.
+    the memory is measured in a separate run, tracemalloc slows f down
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        wall_time = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = f()
+            wall_time = min(wall_time, time.perf_counter() - start)
+        tracemalloc.start()
+        f()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"wall_time": wall_time, "peak_memory": peak_memory}, result
+
+
+def compile_case(prog_structure):
+    def run():
+        parse_program_line.cache_clear()
+        p = MockProgram(MockSoc())
+        Compiler(p).compile("bench")
+        return p
+    with Workspace() as ws:
+        ws.add_program("bench", prog_structure)
+        metrics, p = measure(run)
+    metrics["instructions"] = len(p.prog_list)
+    return metrics
+
+
+def bench_loops(quick):
+    results = {}
+    loop_counts = [1, 10, 1000] if quick else [1, 10, 100, 1000, 10**4, 10**5]
+    for seq_name, seq in [("xy8", XY8), ("xy16", XY16)]:
+        for loop_count in loop_counts:
+            results[f"{seq_name}_loop{loop_count}"] = compile_case({"ch6": f"[loop({loop_count}, [{seq}])]"})
+    return results
+
+
+def bench_nested(quick):
+    results = {}
+    for depth in range(1, 4 if quick else 7):
+        prog_line = f"[{XY8}]"
+        for _ in range(depth):
+            prog_line = f"[X, 10, loop(4, {prog_line}), Y, 10]"
+        results[f"nested_depth{depth}"] = compile_case({"ch6": prog_line})
+    return results
+
+
+def bench_channels(quick):
+    results = {}
+    for num_channels in ([1, 8] if quick else range(1, 9)):
+        prog_structure = {f"ch{ch}": f"[loop(100, [{XY8}])]" for ch in range(num_channels)}
+        results[f"channels{num_channels}"] = compile_case(prog_structure)
+    # loops that start at different times on every channel can't share a hardware loop and are unrolled
+    prog_structure = {f"ch{ch}": f"[{ch * 10}, loop(100, [{XY8}])]" for ch in range(8)}
+    results["channels8_staggered"] = compile_case(prog_structure)
+    return results
+
+
+def bench_pulses(quick):
+    results = {}
+    for num_pulses in ([1, 50] if quick else [1, 10, 50, 100, 200]):
+        def run(num_pulses=num_pulses):
+            parse_program_line.cache_clear()
+            p = MockProgram(MockSoc())
+            Compiler(p).compile("bench")
+            return p
+        with Workspace() as ws:
+            for i in range(num_pulses):
+                ws.add_waveform(f"P{i}", {"style": "const", "freq": 100, "gain": 30000, "phase": i, "length": 10})
+            ws.add_program("bench", {"ch6": "[" + ", ".join(f"P{i}, 10" for i in range(num_pulses)) + "]"})
+            metrics, p = measure(run)
+        metrics["instructions"] = len(p.prog_list)
+        results[f"pulses{num_pulses}"] = metrics
+    return results
+
+
+def bench_update(quick):
+    results = {}
+    for num_pulses in ([50] if quick else [50, 200]):
+        with Workspace() as ws:
+            for i in range(num_pulses):
+                ws.add_waveform(f"P{i}", {"style": "const", "freq": 100, "gain": 30000, "phase": i, "length": 10})
+            ws.add_program("bench", {"ch6": "[" + ", ".join(f"P{i}, 10" for i in range(num_pulses)) + "]"})
+            p = MockProgram(MockSoc())
+            compiler = Compiler(p)
+            with contextlib.redirect_stdout(io.StringIO()):
+                compiler.compile("bench")
+            runs = iter(range(10**6))
+
+            def run():
+                # the other pulses have integer phases, a block with the same values can't be reused
+                ws.add_waveform("P0", {"style": "const", "freq": 100, "gain": 30000, "phase": next(runs) % 80 + 0.5, "length": 10})
+                compiler.assets.add("waveform", "P0")
+                if not compiler.update("waveform", "P0"):
+                    raise RuntimeError("update benchmark: the pulse was not updated in place")
+                return p
+            metrics, p = measure(run)
+        metrics["instructions"] = len(p.prog_list)
+        results[f"update_pulses{num_pulses}"] = metrics
+    return results
+
+
+def bench_simulate(quick):
+    results = {}
+    for loop_count in ([10] if quick else [10, 1000]):
+        with Workspace() as ws:
+            ws.add_program("bench", {"ch6": f"[loop({loop_count}, [{XY8}])]"})
+            p = MockProgram(MockSoc())
+            compiler = Compiler(p)
+            with contextlib.redirect_stdout(io.StringIO()):
+                compiler.compile("bench")
+
+            def run():
+                sim = WaveformSimulator.from_compiler(compiler)
+                return sum(len(samples) for samples in sim.render(6))
+            metrics, _ = measure(run, repeat=3)
+        results[f"simulate_xy8_loop{loop_count}"] = metrics
+    return results
+
+
+def bench_envelopes(quick):
+    results = {}
+    for length in ([48, 4096] if quick else [48, 1024, 4096, 16384, 65536]):
+        with Workspace() as ws:
+            ws.add_envelope("env", length)
+            ws.add_waveform("A", {"style": "arb", "freq": 100, "gain": 30000, "phase": 0, "length": length // 16,
+                                  "i_data_name": "env", "q_data_name": "env"})
+            ws.add_program("bench", {"ch6": "[A, 10, A]"})
+
+            def run():
+                p = MockProgram(MockSoc())
+                Compiler(p).compile("bench")
+                return p
+            metrics, p = measure(run)
+            metrics["instructions"] = len(p.prog_list)
+            results[f"envelope{length}_compile"] = metrics
+            metrics, _ = measure(lambda: Compiler(MockProgram(MockSoc())).load_envelope_data("env"))
+            results[f"envelope{length}_load"] = metrics
+    return results
+
+
+def bench_parse(quick):
+    results = {}
+    for depth in range(1, 4 if quick else 7):
+        prog_line = f"[{XY8}]"
+        for _ in range(depth):
+            prog_line = f"[X, 10, loop(1000, {prog_line}), Y, 10]"
+
+        def run():
+            parse_program_line.cache_clear()
+            return parse_program_line(prog_line)
+        metrics, _ = measure(run)
+        results[f"parse_depth{depth}"] = metrics
+    return results
+
+
+def bench_upload(quick):
+    results = {}
+    for size in ([2**20] if quick else [2**16, 2**20, 2**24]):
+        tmp_dir = tempfile.mkdtemp(prefix="awg_bench_")
+        try:
+            src_path = os.path.join(tmp_dir, "upload.bin")
+            with open(src_path, "wb") as file:
+                file.write(os.urandom(size))
+            recv_dir = os.path.join(tmp_dir, "recv")
+            os.makedirs(recv_dir)
+
+            server = Server()
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.bind(("127.0.0.1", 0))
+            server_socket.listen()
+            port = server_socket.getsockname()[1]
+
+            def serve():
+                conn, addr = server_socket.accept()
+                server.receive_file(conn, recv_dir, name="upload")
+                server._send_int(conn, 0)    # tell the client the file is written
+                conn.close()
+            thread = threading.Thread(target=serve)
+            thread.start()
+
+            client = Client()
+            with contextlib.redirect_stdout(io.StringIO()):
+                client.connect("127.0.0.1", port)
+                start = time.perf_counter()
+                client.send_file(src_path)
+                client._receive_int()
+                wall_time = time.perf_counter() - start
+                client.disconnect()
+            thread.join()
+            server_socket.close()
+            if os.path.getsize(os.path.join(recv_dir, "upload.json")) != size:
+                raise RuntimeError("upload benchmark: received file has the wrong size")
+            results[f"upload{size}"] = {"wall_time": wall_time, "throughput": size / wall_time}
+        finally:
+            shutil.rmtree(tmp_dir)
+    return results
+
+
+BENCHMARKS = [bench_loops, bench_nested, bench_channels, bench_pulses, bench_update, bench_simulate, bench_envelopes, bench_parse, bench_upload]
+
+
+def compare(results, baseline, tolerance):
+    """
+    returns a list of regression messages
+    """
+    regressions = []
+    for case, metrics in results.items():
+        if case not in baseline:
+            continue
+        for metric, value in metrics.items():
+            old = baseline[case].get(metric)
+            if old is None or old == 0:
+                continue
+            # the instruction count is deterministic
+            tol = 0 if metric == "instructions" else tolerance
+            if metric == "wall_time" and abs(value - old) < MIN_WALL_TIME_DIFF:
+                continue
+            if metric in LOWER_IS_BETTER and value > old * (1 + tol):
+                regressions.append(f"{case}: {metric} {old:.4g} -> {value:.4g} (+{(value / old - 1) * 100:.0f}%)")
+            elif metric in HIGHER_IS_BETTER and value < old * (1 - tol):
+                regressions.append(f"{case}: {metric} {old:.4g} -> {value:.4g} ({(value / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the compile, scheduling and transfer hot paths")
+    parser.add_argument("--quick", action="store_true", help="only run the small cases")
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="allowed relative slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    results = {}
+    for benchmark in BENCHMARKS:
+        results.update(benchmark(args.quick))
+
+    print(f"{'case':<24} {'wall [ms]':>10} {'peak [kB]':>10} {'instr':>8} {'MB/s':>8}")
+    for case, metrics in results.items():
+        peak = f"{metrics['peak_memory'] / 1024:.1f}" if "peak_memory" in metrics else "-"
+        instructions = str(metrics.get("instructions", "-"))
+        throughput = f"{metrics['throughput'] / 2**20:.1f}" if "throughput" in metrics else "-"
+        print(f"{case:<24} {metrics['wall_time'] * 1e3:>10.2f} {peak:>10} {instructions:>8} {throughput:>8}")
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print("Regressions against the baseline:")
+            for msg in regressions:
+                print(f"    {msg}")
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Compares the old 4 KB framing of file uploads with the recv_into/sendfile framing of Server and Client
+over loopback.
+
+The old client read and sent the file in 4 KB pieces, and the old server received it with recv in
+4 KB pieces, allocating a new bytes object for every piece.
+
+run from the repository root:
+    python benchmarks/bench_transfer.py
+    python benchmarks/bench_transfer.py --buffer-size 65536
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from server import *
+from client import *
+
+
+def legacy_send_file(sock, filename):
+    # copy of the old Client.send_file, kept here as the reference for the benchmark
+    file_size = os.stat(filename).st_size
+    sock.sendall(struct.pack('!I', file_size))
+    sock.sendall(struct.pack('!I', len(filename)))
+    sock.sendall(filename.encode())
+    with open(filename, 'rb') as file:
+        while True:
+            bytes_read = file.read(4096)
+            if not bytes_read:
+                break
+            sock.sendall(bytes_read)
+
+
+def legacy_receive_int(conn):
+    buf = b''
+    while len(buf) < 4:
+        data = conn.recv(4 - len(buf))
+        if not data:
+            return None
+        buf += data
+    return struct.unpack('!I', buf)[0]
+
+
+def legacy_receive_file(conn, file_path):
+    # copy of the old Server.receive_file
+    file_size = legacy_receive_int(conn)
+    filename_size = legacy_receive_int(conn)
+    conn.recv(filename_size)
+    with open(file_path, 'wb') as file:
+        remaining_size = file_size
+        while remaining_size > 0:
+            data = conn.recv(min(4096, remaining_size))
+            if not data:
+                return
+            file.write(data)
+            remaining_size -= len(data)
+
+
+def transfer(src_path, dst_dir, legacy):
+    """
+    upload src_path over loopback, returns the time until the server has written the file
+    """
+    server = Server()
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(("127.0.0.1", 0))
+    server_socket.listen()
+
+    def serve():
+        conn, addr = server_socket.accept()
+        if legacy:
+            legacy_receive_file(conn, os.path.join(dst_dir, "upload.json"))
+        else:
+            server.receive_file(conn, dst_dir, name="upload")
+        server._send_int(conn, 0)    # tell the client the file is written
+        conn.close()
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    client = Client()
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.connect("127.0.0.1", server_socket.getsockname()[1])
+        start = time.perf_counter()
+        if legacy:
+            legacy_send_file(client.client_socket, src_path)
+        else:
+            client.send_file(src_path)
+        client._receive_int()
+        wall_time = time.perf_counter() - start
+        client.disconnect()
+    thread.join()
+    server_socket.close()
+    if os.path.getsize(os.path.join(dst_dir, "upload.json")) != os.path.getsize(src_path):
+        raise RuntimeError("received file has the wrong size")
+    return wall_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback upload throughput of the old and the new framing")
+    parser.add_argument("--buffer-size", type=int, default=Server.buffer_size, help="receive buffer size of the server")
+    parser.add_argument("--repeat", type=int, default=3, help="the best of this many uploads is reported")
+    args = parser.parse_args()
+    Server.buffer_size = args.buffer_size
+    Client.buffer_size = args.buffer_size
+
+    tmp_dir = tempfile.mkdtemp(prefix="awg_bench_")
+    try:
+        print(f"{'size [MB]':>9} {'legacy [MB/s]':>14} {'new [MB/s]':>11} {'speedup':>8}")
+        for size in [2**16, 2**20, 2**24, 2**26]:
+            src_path = os.path.join(tmp_dir, "upload.bin")
+            with open(src_path, "wb") as file:
+                file.write(os.urandom(size))
+            t_legacy = min(transfer(src_path, tmp_dir, legacy=True) for _ in range(args.repeat))
+            t_new = min(transfer(src_path, tmp_dir, legacy=False) for _ in range(args.repeat))
+            print(f"{size / 2**20:>9.2f} {size / t_legacy / 2**20:>14.1f} {size / t_new / 2**20:>11.1f} {t_legacy / t_new:>8.1f}")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,55 @@
 import socket 
 import os
 import struct 
+import json
+
+
+class AWGServerError(Exception):
+    """
+    raised by Client.receive_server_ack when the server answers a command with an error
+    ERROR: class of the error, e.g. "StateError", "NotFoundError", "CompilationError"
+    """
+    def __init__(self, error, message, payload=None):
+        super().__init__(f"{error}: {message}")
+        self.error = error
+        self.message = message
+        self.payload = payload
 
 
 class Client():
 
-    buffer_size = 4096
+    buffer_size = 2**20    # bytes received into one preallocated buffer at a time
     
-    def __init__(self):
+    def __init__(self, pipelined=False, max_in_flight=64, structured=False, verbose=True):
         self.host = None        # 192.168.0.234 by default
         self.port = None        # 8080 by default
+        # in pipelined mode commands are tagged with a request id and sent without waiting for their ack,
+        # wait_all() collects the acks
+        self.pipelined = pipelined
+        self.max_in_flight = max_in_flight
+        self._next_id = 0
+        self._pending = {}      # key: request id, value: command, requests without an ack yet
+        self.responses = {}     # key: request id, value: ack, acks not yet returned by wait_all
+        self._in_batch = False  # commands in a batch are answered by one ack of the whole batch
+        # in structured mode the server answers with JSON responses, receive_server_ack returns their payload
+        self.structured = structured
+        self.verbose = verbose  # print the message of every ack
 
     
     def connect(self, host, port):
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((host, port))
+            # commands are small messages followed by a wait for the ack, don't let Nagle delay them
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.host = host
             self.port = port
             print(f"Connected to server {host} on port {port}")
+            if self.structured:
+                # untagged and before any other request, so the answer is the next string on the socket
+                self.send_string("SET_RESPONSE_FORMAT")
+                self.send_string("json")
+                self._decode_response(self._receive_string())
         except Exception as e:
             print(f"Error connecting to server: {e}") 
     
@@ -45,8 +76,9 @@ class Client():
             raise Exception("Client not connected.")
         
         try:
-            self.send_int(self._utf8len(s))        # send the length of words in bytes
-            self.client_socket.sendall(s.encode())
+            data = s.encode()
+            # the length of s in bytes and s in one send
+            self.client_socket.sendall(struct.pack('!I', len(data)) + data)
         except Exception as e:
             print(f"Error sending string: {e}")   
 
@@ -54,29 +86,52 @@ class Client():
     def send_file(self, filename):
         try:
             file_size = os.stat(filename).st_size
-            self.send_int(file_size)        # send the size of the file
-            self.send_int(len(filename))    # send the size of filename in bytes
-            self.client_socket.sendall(filename.encode())  # send the file name first
-            #continuously read and send the file content until EOF
+            # the size of the file, the size of filename in bytes and the file name in one send
+            self.client_socket.sendall(self._file_header(file_size, filename))
+            # the kernel copies the file content to the socket (falls back to send where sendfile isn't available)
             with open(filename, 'rb') as file:
-                while True:
-                    bytes_read = file.read(Client.buffer_size)
-                    if not bytes_read:
-                        break
-                    self.client_socket.sendall(bytes_read)
+                self.client_socket.sendfile(file)
             print("File has been sent.")
         except Exception as e:
             print(f"Error sending file: {e}")
 
 
+    def send_data(self, data, filename):
+        """
+        send bytes in memory like send_file sends a file called filename, without writing it to disk first
+        """
+        try:
+            self.client_socket.sendall(self._file_header(len(data), filename))
+            self.client_socket.sendall(memoryview(data))
+            print("File has been sent.")
+        except Exception as e:
+            print(f"Error sending file: {e}")
+
+
+    def _file_header(self, size, filename):
+        filename = filename.encode()
+        return struct.pack('!II', size, len(filename)) + filename
+
+
+    def _recv_exact(self, size):
+        """
+        Returns a bytearray of exactly size bytes, or None if the server disconnected
+        """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        while len(view) > 0:
+            n = self.client_socket.recv_into(view, min(len(view), self.buffer_size))
+            if n == 0:
+                return None
+            view = view[n:]
+        return buf
+
+
     def _receive_int(self):
         try:
-            buf = b''
-            while len(buf) < 4:  # Assuming the integer is 4 bytes long
-                data = self.client_socket.recv(4 - len(buf))
-                if not data:
-                    return None
-                buf += data
+            buf = self._recv_exact(4)  # Assuming the integer is 4 bytes long
+            if buf is None:
+                return None
             num = struct.unpack('!I', buf)[0]  # Network byte order (big-endian)
             return num
         except Exception as e:
@@ -89,21 +144,98 @@ class Client():
             if string_size is None:
                 return None
 
-            buf = b''
-            while len(buf) < string_size:
-                data = self.client_socket.recv(min(Client.buffer_size, string_size - len(buf)))
-                if not data:
-                    return None
-                buf += data
+            buf = self._recv_exact(string_size)
+            if buf is None:
+                return None
             return buf.decode()
         except Exception as e:
             print(f"Error receiving string: {e}")
             return None
 
 
+    def _receive_data(self):
+        """
+        bytes sent by the server with their length in front, see Server._send_data
+        """
+        size = self._receive_int()
+        if size is None:
+            return None
+        return self._recv_exact(size)
+
+
+    def send_command(self, command):
+        """
+        returns the request id of the command in pipelined mode, None otherwise
+        """
+        if not self.pipelined or self._in_batch:
+            self.send_string(command)
+            return None
+        request_id = self._next_id
+        self._next_id += 1
+        self.send_string(f"#{request_id} {command}")
+        self._pending[request_id] = command
+        return request_id
+
+
     def receive_server_ack(self):
+        """
+        returns the payload of the response in structured mode (raises AWGServerError if the command failed),
+        the ack string otherwise. Returns None in pipelined mode and in a batch, the acks come later
+        """
+        if self._in_batch:
+            return None
+        if not self.pipelined:
+            ack = self._receive_string()
+            if ack is None:
+                raise Exception("Server disconnected.")
+            if self.structured:
+                response = self._decode_response(ack)
+                if response["status"] != "ok":
+                    raise AWGServerError(response["error"], response["message"], response["payload"])
+                return response["payload"]
+            if self.verbose:
+                print(ack)
+            return ack
+        # don't wait for the ack unless too many requests are in flight
+        while len(self._pending) > self.max_in_flight:
+            self._receive_response()
+        return None
+
+
+    def _decode_response(self, ack):
+        response = json.loads(ack)
+        if self.verbose:
+            print(f"[Server acknowledgement]: {response['message']}")
+        return response
+
+
+    def _receive_response(self):
         ack = self._receive_string()
-        print(ack)
+        if ack is None:
+            raise Exception("Server disconnected with requests in flight.")
+        if self.structured:
+            response = self._decode_response(ack)
+            request_id = response["id"]
+        else:
+            (request_id, _, response) = ack[1:].partition(" ")
+            request_id = int(request_id)
+            if self.verbose:
+                print(response)
+        self._pending.pop(request_id, None)
+        self.responses[request_id] = response
+
+
+    def wait_all(self):
+        """
+        wait for the acks of all requests in flight, returns a dict of request id: ack
+        in structured mode the values are the decoded responses, failed commands don't raise here,
+        their response has status "error"
+        """
+        while len(self._pending) > 0:
+            self._receive_response()
+        responses = self.responses
+        self.responses = {}
+        return responses
 
              
         
\ No newline at end of file
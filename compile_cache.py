@@ -0,0 +1,145 @@
+from collections import OrderedDict
+import hashlib
+
+
+class CompileCache():
+    """
+    LRU cache of compiled programs, so that starting the same program again skips compilation.
+
+    An entry is keyed by a hash over the content of the program config and of every waveform
+    config and envelope file the program uses. Uploading or deleting one of those files
+    invalidates exactly the entries of the programs that depend on it, or, with update, patches them.
+
+    kind of a file is one of "program", "waveform", "envelope"
+    """
+
+
+    def __init__(self, assets, max_entries=16, max_bytes=64 * 2**20):
+        # AssetRegistry of the files, it keeps the digests of their content
+        self.assets = assets
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes    # bound on the total size of the envelope tables and asm
+        # key: content hash, value: (prog_name, compiled, size in bytes), least recently used first
+        self._entries = OrderedDict()
+        # key: prog_name, value: content hash of its entry
+        self._keys = {}
+        # key: prog_name, value: set of (kind, name) of the files the program depends on
+        self._deps = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, prog_name):
+        """
+        returns the cached compiled program or None
+        """
+        key = self._valid_key(prog_name)
+        if key is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][1]
+
+
+    def contains(self, prog_name):
+        """
+        True if get would return the compiled program, without counting a hit or a miss
+        """
+        return self._valid_key(prog_name) is not None
+
+
+    def _valid_key(self, prog_name):
+        """
+        key of the entry of prog_name, None if there is none or its files have changed (then it's dropped)
+        """
+        dependencies = self._deps.get(prog_name)
+        if dependencies is None:
+            return None
+        try:
+            key = self._content_hash(dependencies)
+        except OSError:
+            # a file the program depends on is gone
+            key = None
+        if key != self._keys[prog_name]:
+            self.invalidate("program", prog_name)
+            return None
+        return key
+
+
+    def put(self, prog_name, compiled, dependencies, size):
+        """
+        DEPENDENCIES: set of (kind, name) of all files used to compile prog_name
+        SIZE: size of the compiled program in bytes, used for eviction
+        """
+        self.invalidate("program", prog_name)
+        dependencies = set(dependencies) | {("program", prog_name)}
+        key = self._content_hash(dependencies)
+        self._deps[prog_name] = dependencies
+        self._keys[prog_name] = key
+        self._entries[key] = (prog_name, compiled, size)
+        self.total_bytes += size
+        # evict least recently used entries, the new entry is kept even if it's larger than max_bytes
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            (_, (old_prog_name, _, old_size)) = self._entries.popitem(last=False)
+            self.total_bytes -= old_size
+            del self._keys[old_prog_name]
+            del self._deps[old_prog_name]
+
+
+    def invalidate(self, kind, name):
+        """
+        the file name of kind has changed or was deleted, drop every entry that depends on it
+        """
+        for prog_name, dependencies in list(self._deps.items()):
+            if (kind, name) in dependencies:
+                key = self._keys.pop(prog_name)
+                del self._deps[prog_name]
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.total_bytes -= entry[2]
+
+
+    def update(self, kind, name, patch):
+        """
+        the file name of kind has changed. PATCH(compiled) updates a compiled program in place and returns
+        True, or returns False if the program has to be compiled again, then its entry is dropped
+        returns the names of the patched programs
+        """
+        patched = []
+        for prog_name, dependencies in list(self._deps.items()):
+            if (kind, name) not in dependencies:
+                continue
+            key = self._keys[prog_name]
+            (_, compiled, size) = self._entries[key]
+            try:
+                ok = patch(compiled)
+            except Exception as e:
+                print(f"Can't update program [{prog_name}]: {e}")
+                ok = False
+            if not ok:
+                self.invalidate("program", prog_name)
+                continue
+            # same program, new content
+            del self._entries[key]
+            key = self._content_hash(dependencies)
+            self._keys[prog_name] = key
+            self._entries[key] = (prog_name, compiled, size)
+            patched.append(prog_name)
+        return patched
+
+
+    def clear(self):
+        self._entries.clear()
+        self._keys.clear()
+        self._deps.clear()
+        self.total_bytes = 0
+
+
+    def _content_hash(self, dependencies):
+        h = hashlib.sha256()
+        for (kind, name) in sorted(dependencies):
+            h.update(f"{kind}:{name}:".encode())
+            h.update(self.assets.digest(kind, name))
+        return h.hexdigest()
@@ -0,0 +1,262 @@
+from backend import *
+from compiler import *
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+
+
+def _compile_job(conn, backend, soccfg, prog_name, work_dir, assets):
+    """
+    runs in the worker process, sends ("done", (awg_prog, compiler)) or ("failed", (error message, compile report
+    up to the error or None)) to conn
+    ASSETS: snapshot of the AssetRegistry of the server, None to read the files from the working directory
+    """
+    compiler = None
+    try:
+        # the directories of the assets may be relative to the working directory
+        os.chdir(work_dir)
+        program_class = load_program_class(backend)
+        awg_prog = program_class(soccfg, None)
+        compiler = Compiler(awg_prog, assets=assets)
+        compiler.compile(prog_name)
+        # the worker's copy of the configs isn't needed by the server
+        compiler.assets = None
+        conn.send(("done", (awg_prog, compiler)))
+    except Exception as e:
+        report = None
+        if compiler is not None and compiler.phase is not None:
+            try:
+                report = compiler.compile_report()
+            except Exception:
+                pass
+        conn.send(("failed", (f"Compilation Error: {e}", report)))
+    finally:
+        conn.close()
+
+
+
+class CompileJobs():
+    """
+    Compiles programs in worker processes, so the server keeps answering while a program compiles.
+
+    Every job runs in its own process, at most max_workers at the same time, the others are queued.
+    A running job is cancelled by terminating its process.
+
+    state of a job is one of "queued", "running", "done", "failed", "cancelled"
+    """
+
+    max_finished_jobs = 100     # finished jobs kept for GET_JOB_STATUS, the oldest are forgotten first
+
+
+    def __init__(self, backend, soccfg, max_workers=None, assets=None, metrics=None):
+        self.backend = backend
+        self.soccfg = soccfg    # must be picklable, see backend.worker_soccfg
+        self.assets = assets    # AssetRegistry, a snapshot of it is sent with every job that starts
+        self.metrics = metrics  # Metrics of the server, counts the jobs by result and their compile times
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        # forkserver forks the workers from a clean process, forking the threaded server could deadlock
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self._ctx = multiprocessing.get_context("forkserver")
+            self._ctx.set_forkserver_preload(["compiler"])
+        else:
+            self._ctx = multiprocessing.get_context("spawn")
+        # key: job id, value: dict of the job, see submit
+        self._jobs = {}
+        self._queue = []        # ids of the queued jobs, oldest first
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._monitor = None
+
+
+    def submit(self, prog_name):
+        """
+        returns the job id
+        """
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            self._jobs[job_id] = {"prog_name": prog_name, "state": "queued", "result": None, "error": None, "report": None,
+                                  "stale": False, "collected": False, "process": None, "conn": None,
+                                  "submit_time": time.perf_counter(), "start_time": None, "end_time": None}
+            self._queue.append(job_id)
+            self._start_queued()
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._run_monitor, daemon=True)
+                self._monitor.start()
+        return job_id
+
+
+    def status(self, job_id):
+        """
+        returns a copy of the job without its result, None if job_id is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {key: value for key, value in job.items() if key not in ["result", "process", "conn"]}
+
+
+    def cancel(self, job_id):
+        """
+        returns False if the job is unknown or already finished
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["state"] not in ["queued", "running"]:
+                return False
+            if job["state"] == "queued":
+                self._queue.remove(job_id)
+            else:
+                job["process"].terminate()
+                job["process"].join()
+                job["conn"].close()
+            self._finish(job, "cancelled")
+            self._start_queued()
+            return True
+
+
+    def join(self, job_id):
+        """
+        block until the job is finished, without taking its result
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            while job is not None and job["state"] in ["queued", "running"]:
+                self._changed.wait()
+
+
+    def wait(self, job_id):
+        """
+        block until the job is finished, returns ((awg_prog, compiler), True if a file changed while compiling),
+        raises RuntimeError if the job failed or was cancelled
+        """
+        with self._lock:
+            job = self._jobs[job_id]
+            while job["state"] in ["queued", "running"]:
+                self._changed.wait()
+            if job["state"] != "done":
+                raise RuntimeError(job["error"] if job["error"] is not None else f"Compile job {job_id} was {job['state']}")
+            job["collected"] = True
+            result = job["result"]
+            job["result"] = None
+            return (result, job["stale"])
+
+
+    def collect(self):
+        """
+        returns [(prog_name, (awg_prog, compiler))] of the jobs finished since the last collect,
+        without the jobs whose files changed while they compiled
+        """
+        results = []
+        with self._lock:
+            for job in self._jobs.values():
+                if job["state"] == "done" and not job["collected"]:
+                    job["collected"] = True
+                    if not job["stale"]:
+                        results.append((job["prog_name"], job["result"]))
+                    # the result is in the compile cache or thrown away now, free the memory
+                    job["result"] = None
+        return results
+
+
+    def invalidate(self, kind, name):
+        """
+        the file name of kind has changed, results compiled from the old file must not be cached
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if job["state"] in ["queued"]:
+                    # not started yet, it will read the new file
+                    continue
+                if job["state"] == "running":
+                    # the dependencies of a running job are not known yet
+                    job["stale"] = True
+                elif job["state"] == "done" and job["result"] is not None and (kind, name) in job["result"][1].dependencies:
+                    job["stale"] = True
+
+
+    def shutdown(self):
+        with self._lock:
+            for job_id in list(self._queue):
+                self._finish(self._jobs[job_id], "cancelled")
+            self._queue.clear()
+            for job in list(self._jobs.values()):
+                if job["state"] == "running":
+                    job["process"].terminate()
+                    job["process"].join()
+                    self._finish(job, "cancelled")
+
+
+    def _start_queued(self):
+        # called with self._lock held
+        running = len([job for job in self._jobs.values() if job["state"] == "running"])
+        while running < self.max_workers and len(self._queue) > 0:
+            job = self._jobs[self._queue.pop(0)]
+            (recv_conn, send_conn) = self._ctx.Pipe(duplex=False)
+            # the snapshot is taken when the job starts, so a queued job compiles the files uploaded while it waited
+            assets = self.assets.snapshot() if self.assets is not None else None
+            process = self._ctx.Process(target=_compile_job, daemon=True,
+                                        args=(send_conn, self.backend, self.soccfg, job["prog_name"], os.getcwd(), assets))
+            process.start()
+            # the worker has its own copy of send_conn, close ours so recv notices when the worker dies
+            send_conn.close()
+            job.update(state="running", process=process, conn=recv_conn, start_time=time.perf_counter())
+            running += 1
+        self._changed.notify_all()
+
+
+    def _finish(self, job, state, result=None, error=None, report=None):
+        # called with self._lock held
+        if result is not None:
+            report = result[1].report
+        job.update(state=state, result=result, error=error, report=report, process=None, conn=None,
+                   end_time=time.perf_counter())
+        if self.metrics is not None:
+            self.metrics.inc("compiles_total", label=state)
+            if state != "cancelled":
+                self.metrics.observe("compile_seconds", job["end_time"] - job["start_time"])
+        self._changed.notify_all()
+        # forget the oldest finished jobs, but not a result nobody has taken yet (by wait or collect)
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job["state"] in ["failed", "cancelled"] or (job["state"] == "done" and job["collected"])]
+        for job_id in finished[:max(0, len(finished) - CompileJobs.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+
+    def _run_monitor(self):
+        """
+        receives the results of the running jobs and starts the queued ones
+        """
+        while True:
+            with self._lock:
+                conns = {job["conn"]: job for job in self._jobs.values() if job["state"] == "running"}
+                if len(conns) == 0:
+                    self._changed.wait()
+                    continue
+            # wait without the lock, a timeout to notice jobs started in the meantime
+            try:
+                ready = multiprocessing.connection.wait(list(conns.keys()), timeout=0.1)
+            except (OSError, ValueError):
+                # a job was cancelled and its conn closed
+                continue
+            with self._lock:
+                for conn in ready:
+                    job = conns[conn]
+                    if job["state"] != "running" or job["conn"] is not conn:
+                        # cancelled in the meantime
+                        continue
+                    try:
+                        (state, value) = conn.recv()
+                    except (EOFError, OSError):
+                        (state, value) = ("failed", ("Compilation Error: the compile worker died", None))
+                    conn.close()
+                    job["process"].join()
+                    if state == "done":
+                        self._finish(job, "done", result=value)
+                    else:
+                        self._finish(job, "failed", error=value[0], report=value[1])
+                self._start_queued()
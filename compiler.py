@@ -1,9 +1,13 @@
-from qick import *
-from FPGA_AWG import *
+import os
 import json
-from queue import PriorityQueue
+import heapq
+import bisect
 import numpy as np
-import csv
+import hashlib
+import itertools
+import time
+from prog_parser import *
+from asset_registry import *
 
 
 class Compiler():
@@ -11,16 +15,36 @@ class Compiler():
     """
     Page 
         $0: 0 
-        $1: freq
-        $2: 
-        ...
-        $5: mode code
-        $6: time for this pulse
-        ...
-        $31: not used
+        $1 - $30: register blocks of pulses, each block is
+            +0: freq
+            +1: phase
+            +2: gain
+            +3: mode code
+            +4: envelope memory addr (arb pulses only, const pulses use $0)
+        $31: time register of the page, written right before every set
+
+    Pulses with identical parameters (freq, phase, gain, mode code and addr) share one register block.
+    Blocks are placed into the first page with enough free registers.
+
+    If the blocks don't fit into pages 1-7, the most used blocks stay in registers and the rest are
+    spilled: the last page becomes a page of swap slots, and a spilled block is reloaded into a slot
+    with regwi before the set that needs it. Within a straight-line part of the program (between loop
+    starts/ends) a slot keeps its block, the block that is needed again the latest is evicted first,
+    and the reload is placed right after the last set of the evicted block, so it runs while the tproc
+    would otherwise wait for the pulse time.
+
+    Sweeps (the "sweeps" of the program config) run the whole program once for every sweep point without
+    the host: every sweep is a tproc loop around the program, the first sweep is the outermost. A swept
+    freq, phase or gain stays in the register block of the pulse (swept pulses get a block of their own
+    that is never spilled) and is stepped with mathi after every repetition. Swept wait times and loop
+    counts are kept on page 0 from $31 down, the loop counters take the registers from $1 up.
+
+    Live pulses (the "live_pulses" of the program config) also get a block of their own, their freq, phase
+    and gain are read with memri from the tproc data memory at the start of every repetition, so they can
+    be changed while the program runs by writing the data memory (see live_update).
 
     Rules to play pulses:
-    1. all 6 pulse registers must be on the same page
+    1. all pulse registers must be on the same page
     2. each channel has its own envelope memory
 
     special cases:
@@ -35,17 +59,55 @@ class Compiler():
     # table to indicate which register on which page is used
     NUM_REG = 31    # number of registers per page, excluding $0 for storing value 0
     NUM_PAGE = 8    # page 0 is reserved for loop counter
-    REG_PTR_STEP = 6    # reg pointer increment step size, i.e. number of registers for each pulse
-                        # there are 6 regs per pulse, here the time reg is excluded 
-                        # instead, the last reg of each page is used as the time reg for that channel
-    PAGE_PTR_STEP = 1
+    TIME_REG = 31    # the last reg of each page is the time reg shared by all pulses on that page
+    # offsets of the pulse registers from the first register of the block (reg_LUT)
+    FREQ_REG = 0
+    PHASE_REG = 1
+    GAIN_REG = 2
+    MC_REG = 3
+    ADDR_REG = 4
+    LOOP_PAGE = 0    # register page of the loop counters, $1 is the counter of the outermost loop
+    MAX_PULSE_TIME = 2**16 - 1    # pulse start times relative to the time base are kept below this
+    MAX_SYNCI = 2**30 - 1    # largest immediate value of synci, longer time base advances are split
+    MAX_MATHI = 2**30 - 1    # largest immediate value of mathi, larger sweep steps are split
     NUM_CHANNELS = 7
+    START_DELAY = 200    # clk cycles between the start of the program and the first pulse, to load the registers
+    # pulse fields that can be swept or updated live, key: field, value: offset of the register in the block
+    PULSE_FIELDS = {"freq": FREQ_REG, "phase": PHASE_REG, "gain": GAIN_REG}
+    # a row of the table returned by timeline
+    TIMELINE_DTYPE = np.dtype([("ch", "u1"), ("start", "i8"), ("duration", "u4"), ("pulse", "u2"),
+                               ("loop_path", "u2"), ("page", "u1")])
+    # phases of a compilation, timed by _start_phase: parse (program config, prog lines, sweeps and live pulses),
+    # pulse_cfg (waveform configs), envelopes (envelope data into envelope memory), registers (register blocks
+    # and their placement), scheduling and asm (emitting the asm code)
+    COMPILE_PHASES = ["parse", "pulse_cfg", "envelopes", "registers", "scheduling", "asm"]
 
+    verbose = False    # print a summary of every compilation, compile_report has the same numbers
 
-    def __init__(self, awg_prog):
+
+    def __init__(self, awg_prog, assets=None):
+        """
+        ASSETS: AssetRegistry the programs, waveforms and envelopes are read from. Without one, the files
+        are read from program_cfg, waveform_cfg and envelope_data in the working directory
+        """
         self.awg_prog = awg_prog
-        self._curr_reg_ptr = 1
-        self._curr_page_ptr = 1
+        if assets is None:
+            assets = AssetRegistry({"program": "./program_cfg", "waveform": "./waveform_cfg", "envelope": "./envelope_data"})
+        self.assets = assets
+        # key: page, value: first free register of the page
+        self._page_free_reg = {}
+        # register blocks already allocated. key: (style, parameter values), value: (page, first register)
+        self._block_LUT = {}
+        # register blocks of all pulses. key: (style, parameter values), value: [(offset, value, comment)]
+        self._blocks = {}
+        # key of the register block of every pulse. key: pulse name, value: block key
+        self.block_key_LUT = {}
+        # keys of the blocks that don't fit into the registers and are reloaded when needed
+        self._spilled = set()
+        # (page, first register) of the swap slots for spilled blocks
+        self._swap_slots = []
+        # number of regwi instructions added to reload spilled blocks
+        self.reload_instructions = 0
         # assumes all channels of QickProgram are the same generator, pick 0th gen, get samps_per_clk
         # samps_per_clk is default 16
         self.samps_per_clk = self.awg_prog.soccfg['gens'][0]['samps_per_clk']
@@ -64,128 +126,284 @@ class Compiler():
         # this is used by the scheduler to determine whether the pulse needs to use special addr register
         self.pulse_style_LUT = {}
 
-
-
-    def tokenize(self, prog_line):
+        # envelope memory addr look up table. key: pulse name, value: {channel number: addr}
+        self.addr_LUT = {}
+
+        # waveform config of every pulse. key: pulse name, value: config, used by update
+        self.pulse_cfg_LUT = {}
+
+        # asm code loading the register blocks, used by update to rewrite the values of a block
+        # key: block key, value: [(offset, page, register, index of the first instruction in prog_list, number of instructions)]
+        self._block_loads = {}
+
+        # envelopes already in envelope memory. key: (channel number, hash of I and Q data), value: addr
+        # pulses with the same envelope data (e.g. X and Y) share one copy in envelope memory
+        self.envelope_pool = {}
+
+        # labels of the loops currently open, used to jump back to the start of the loop body
+        self._loop_labels = []
+        self._loop_label_count = 0
+
+        # sweeps of the program, outermost first: [(target, start, step, count)], start and step in register units
+        # target is (pulse name, offset in the block) for a pulse field, (None, register on page 0) for a named sweep
+        self._sweeps = []
+        # swept waits and loop counts. key: name, value: register on page 0
+        self.sweep_vars = {}
+        # key: name of a swept wait or loop count, value: (smallest value, largest value)
+        self._sweep_var_range = {}
+        # swept pulse fields. key: pulse name, value: {field: start value}
+        self.swept_pulses = {}
+        # pulses whose fields are read from the tproc data memory at the start of every repetition, so they
+        # can be changed while the program runs. key: pulse name, value: address of the freq (+ field offset)
+        self.live_pulses = {}
+        # initial content of the data memory. key: address, value: 32 bit value
+        self.live_table = {}
+
+        # the scheduled events the asm code was generated from (see Scheduler), used by timeline
+        self.schedule = []
+
+        # set of (kind, name) of all program, waveform and envelope files used by the compiled program
+        self.dependencies = set()
+        # number of bytes of envelope data added to the envelope memories
+        self.envelope_bytes = 0
+        # number of bytes of envelope data not added because an identical envelope was already there
+        self.envelope_bytes_saved = 0
+
+        # name of the compiled program
+        self.prog_name = None
+        # seconds spent in every phase of the compilation. key: phase, see _start_phase
+        self.timings = {}
+        # phase the compilation is in, None before and after it. A failed compilation stops in its phase
+        self.phase = None
+        self._phase_start = None
+        # the report of the compilation (see compile_report), made at its end
+        self.report = None
+        # [kind, name] of the files changed since the compilation, the program was updated in place for them (see update)
+        self.patched = []
+
+
+
+    def parse(self, prog_line):
         """
-        parse the prog_line into a list of string "X", "Y" (pulse names)
-        e.g.
+        parse the prog_line into a tuple of Pulse, Wait and Loop nodes, e.g.
         INPUT: "[loop(2,[X, loop(3,[10, Y]),Y,Z]), X]"
-        OUTPUT: ['loop', '2', '[X,loop(3,[10,Y]),Y,Z]', 'X']
+        OUTPUT: (Loop(2, [Pulse('X'), Loop(3, [Wait(10), Pulse('Y')]), Pulse('Y'), Pulse('Z')]), Pulse('X'))
+
+        the result is cached per program line, see prog_parser.parse_program_line
+        """
+        return parse_program_line(prog_line)
 
-        INPUT: "[loop(10, [X, Y, X, Y, Y, X, Y, X]), X]"
-        OUTPUT: ['loop', '10', '[X,Y,X,Y,Y,X,Y,X]', 'X']
 
-        INPUT: "[X, Y, X, Y, Y, X, Y, X]"
-        OUTPUT: ['X', 'Y', 'X', 'Y', 'Y', 'X', 'Y', 'X']
+    def list_all_pulses(self, pulse_set, nodes):
         """
-        # add special character "\n" to indicate end of the line
-        EOL_char = '\n'
-        prog_line = prog_line.strip("[]").replace(" ", "") + EOL_char
-        prog_line = iter(prog_line)
-        in_loop = False
-        curr_token = ""
-        open_parenthesis = 0
-        result = []
-        for c in prog_line:
-            if not in_loop:
-                if c == ",":
-                    if curr_token != "":
-                        result.append(curr_token)
-                        curr_token = ""   
-                    # the case where it just come out of the loop
-                    else:
-                        pass
-                elif curr_token == "loop":
-                    # c must be "("
-                    result.append("loop")
-                    curr_token = ""
-                    in_loop = True
-                    open_parenthesis += 1
-                else:
-                    # detect end of prog_line
-                    if c == EOL_char:
-                        if curr_token != "":
-                            result.append(curr_token)
-                    # otherwise just accumulate curr_token
-                    else:
-                        curr_token += c                    
-            else:
-                # read loop count until the first "," in loop
-                while c != ",":
-                    curr_token += c
-                    c = next(prog_line)
-                result.append(curr_token)    # save loop count
-                curr_token = ""
-                # read until there are no open parenthesis, then we are out of the loop
-                for c in prog_line:
-                    if c == "(":
-                        open_parenthesis += 1
-                    elif c == ")":
-                        open_parenthesis -= 1
-                        
-                    if open_parenthesis > 0:
-                        curr_token += c
-                    else:
-                        result.append(curr_token)
-                        curr_token = ""
-                        in_loop = False
-                        break
-        return result
+        PULSE_SET: a set to store all pulse names
+        NODES: the output of parse (for one channel)
 
+        Modifies pulse_set by adding the name of every pulse in nodes (including loop bodies)
+        """
+        for node in nodes:
+            if isinstance(node, Loop):
+                self.list_all_pulses(pulse_set, node.body)
+            elif isinstance(node, Pulse):
+                pulse_set.add(node.name)
 
-    def _is_loop_body(self, token):
-        # checks if token is loop body, i.e. []
-        return token.startswith('[') and token.endswith(']')
 
 
-    def list_all_pulses(self, tokens_set, tokens):
+    def _alloc_block(self, size, num_pages=NUM_PAGE):
         """
-        TOKENS_SET: an empty set to store all pulse names
-        TOKENS_LST: the output of tokenize (for one channel)
+        find size free registers on one of the pages below num_pages (first fit), 
+        returns (page, first register) or None if no page has enough free registers
+        """
+        for page in range(Compiler.LOOP_PAGE + 1, num_pages):
+            free_reg = self._page_free_reg.get(page, 1)
+            if free_reg + size <= Compiler.TIME_REG:
+                self._page_free_reg[page] = free_reg + size
+                return page, free_reg
+        return None
+
 
-        Modifies tokens_set by adding pulse name from tokens_lst into tokens_set
+    def assign_registers(self, block_uses):
         """
-        for t in tokens:
-            # loop body is not tokenize, so it needs to be further tokenized
-            if self._is_loop_body(t):
-                self.list_all_pulses(tokens_set, self.tokenize(t))
-            else:
-                # if t is a number, this means to wait, so don't save it in the set
-                if not t.isnumeric() and t != "loop":
-                    tokens_set.add(t)
+        BLOCK_USES: key: block key, value: number of times the block is used (loop counts included)
+
+        place every register block and generate asm code to load them. If they don't fit, 
+        the most used blocks are placed and the rest are spilled to the swap slots on the last page
+        """
+        block_keys = sorted(self._blocks, key=lambda key: block_uses.get(key, 0), reverse=True)
+        sizes = {key: max(offset for (offset, _, _) in self._blocks[key]) + 1 for key in block_keys}
+        for key in block_keys:
+            block_ptr = self._alloc_block(sizes[key])
+            if block_ptr is None:
+                break
+            self._block_LUT[key] = block_ptr
+        else:
+            block_keys = []
+
+        if len(block_keys) > 0:
+            # not enough registers: keep the last page for swap slots and spill the least used blocks
+            self._page_free_reg = {}
+            self._block_LUT = {}
+            swap_page = Compiler.NUM_PAGE - 1
+            slot_size = Compiler.ADDR_REG + 1
+            self._swap_slots = [(swap_page, reg) for reg in range(1, Compiler.TIME_REG - slot_size + 1, slot_size)]
+            self._page_free_reg[swap_page] = Compiler.TIME_REG
+            for key in block_keys:
+                block_ptr = self._alloc_block(sizes[key], num_pages=swap_page)
+                if block_ptr is None:
+                    self._spilled.add(key)
+                else:
+                    self._block_LUT[key] = block_ptr
+
+        # load all params to registers
+        for key, (page, reg) in self._block_LUT.items():
+            self.load_block(key, page, reg)
+        for pulse_name, key in self.block_key_LUT.items():
+            if key in self._block_LUT:
+                # save the first register pointer to LUT
+                # save the register page associated to this pulse
+                (self.page_LUT[pulse_name], self.reg_LUT[pulse_name]) = self._block_LUT[key]
 
 
+    def load_block(self, block_key, page, reg):
+        """
+        Generate asm code to load the register block of block_key into reg on page
+        """
+        p = self.awg_prog
+        for (offset, value, comment) in self._blocks[block_key]:
+            start = len(p.prog_list)
+            self._load_register(p, page, reg + offset, value, comment)
+            self._block_loads.setdefault(block_key, []).append((offset, page, reg + offset, start, len(p.prog_list) - start))
+
 
-    def _step_reg_ptr(self):
+    def _load_register(self, p, page, reg, value, comment):
         """
-        if next 6 registers exceeds the number of registers per page, 
-        increment page pointer
+        like safe_regwi (see qick.asm_v1), immediate values have 30 bits so larger values are shifted in.
+        Unlike safe_regwi a large value always takes 3 instructions, so update can rewrite the value in place
         """
-        if self._curr_reg_ptr + Compiler.REG_PTR_STEP >= Compiler.NUM_REG:
-            self._curr_reg_ptr = 1
-            self._step_page_ptr()
+        if abs(value) < 2**30:
+            p.regwi(page, reg, value, comment=comment)
         else:
-            self._curr_reg_ptr  = self._curr_reg_ptr + Compiler.REG_PTR_STEP
+            p.regwi(page, reg, value >> 2, comment=comment)
+            p.bitwi(page, reg, reg, '<<', 2)
+            p.mathi(page, reg, reg, '+', value % 4)
+
+
+    def _block_uses(self, events):
+        """
+        count how often every register block is used by the scheduled events, a use in a loop counts loop count times
+        (the largest count of a swept loop count). The blocks of swept pulses must stay in registers, they count as
+        used infinitely often, like the blocks of live pulses
+        """
+        block_uses = {}
+        weight = 1
+        weights = []
+        for event in events:
+            if event[0] == "loop_start":
+                weights.append(weight)
+                loop_count = event[2]
+                if isinstance(loop_count, str):
+                    loop_count = self._sweep_var_range[loop_count][1]
+                weight *= loop_count
+            elif event[0] == "loop_end":
+                weight = weights.pop()
+            elif event[0] == "pulse":
+                key = self.block_key_LUT[event[3]]
+                block_uses[key] = block_uses.get(key, 0) + weight
+        for pulse_name in self.block_key_LUT:
+            if self._changes_registers(pulse_name):
+                block_uses[self.block_key_LUT[pulse_name]] = float("inf")
+        return block_uses
+
+
+    def _place_spilled_blocks(self, events):
+        """
+        insert ["load", block key, (page, reg)] events to reload spilled blocks into swap slots, 
+        and append the (page, reg) of the slot to the pulse events that use a spilled block.
+        Slots are forgotten at every loop start and end, so every loop iteration reloads what it needs
+        """
+        if len(self._spilled) == 0:
+            return events
+        result = []
+        segment = []
+        for event in events:
+            if event[0] == "loop_start" or event[0] == "loop_end":
+                result.extend(self._place_spilled_blocks_in_segment(segment))
+                result.append(event)
+                segment = []
+            else:
+                segment.append(event)
+        result.extend(self._place_spilled_blocks_in_segment(segment))
+        return result
 
 
-    def _step_page_ptr(self):
+    def _place_spilled_blocks_in_segment(self, segment):
+        # key: block key, value: indices of the events in segment that use the block
+        uses = {}
+        for i, event in enumerate(segment):
+            if event[0] == "pulse":
+                key = self.block_key_LUT[event[3]]
+                if key in self._spilled:
+                    uses.setdefault(key, []).append(i)
+        if len(uses) == 0:
+            return segment
+        next_use = {key: 0 for key in uses}    # index into uses[key] of the next use
+
+        slots = [None] * len(self._swap_slots)     # block key in every slot
+        slot_last_use = [-1] * len(self._swap_slots)    # index of the event that last used the slot
+        # key: index of an event (-1 is the start of the segment), value: load events to insert after it
+        loads = {}
+        segment = list(segment)
+        for i, event in enumerate(segment):
+            if event[0] != "pulse":
+                continue
+            key = self.block_key_LUT[event[3]]
+            if key not in self._spilled:
+                continue
+            next_use[key] += 1
+            if key in slots:
+                s = slots.index(key)
+            elif None in slots:
+                s = slots.index(None)
+            else:
+                # evict the block that is needed again the latest
+                def next_use_time(s):
+                    key_uses = uses[slots[s]]
+                    n = next_use[slots[s]]
+                    return key_uses[n] if n < len(key_uses) else len(segment)
+                s = max(range(len(slots)), key=next_use_time)
+            if slots[s] != key:
+                # reload right after the last set that used the slot
+                loads.setdefault(slot_last_use[s], []).append(["load", key, self._swap_slots[s]])
+                slots[s] = key
+            slot_last_use[s] = i
+            segment[i] = event + [self._swap_slots[s]]
+
+        result = loads.get(-1, [])
+        for i, event in enumerate(segment):
+            result.append(event)
+            result.extend(loads.get(i, []))
+        return result
+
+
+    def register_usage(self):
         """
-        increment the page pointer, if overflow, raise error
+        returns {page: number of used registers} of the pages with pulse registers, including the time register
         """
-        if self._curr_page_ptr + Compiler.PAGE_PTR_STEP > Compiler.NUM_PAGE:
-            raise RuntimeError(f"Compilation Error: No available registers left (page: {self._curr_page_ptr}, reg: {self._curr_reg_ptr})")
-        self._curr_page_ptr = self._curr_page_ptr + Compiler.PAGE_PTR_STEP
+        return {page: free_reg for page, free_reg in sorted(self._page_free_reg.items())}
 
 
     def compile(self, prog_name):
         """
         Compilation consists of the following steps:
-        tokenize pulses, create prog IR (intermediate representation), load pulse param 
+        parse prog lines into an AST, create prog IR (intermediate representation), load pulse param 
         into registers, schedule pulse play time
         """
+        self.prog_name = prog_name
+        t_start = time.perf_counter()
+        self.timings = {phase: 0.0 for phase in Compiler.COMPILE_PHASES}
+        self._start_phase("parse")
         prog_cfg = self.load_program_cfg(prog_name)
-        prog_structure = prog_cfg["prog_structure"]
+        self.dependencies.add(("program", prog_name))
         nqz_dict = prog_cfg.get("nqz")
 
         if nqz_dict != None:
@@ -193,212 +411,875 @@ class Compiler():
             for ch, nqz in nqz_dict.items():
                 ch_number = ch[-1]
                 self.awg_prog.declare_gen(ch=ch_number, nqz=int(nqz))
-        
-        # create a set of pulse names across all channels for allocating pulse param registers
-        token_set = set()
-        tokens_dict = {}
-        for ch, prog_line in prog_structure.items():
-            tokens = self.tokenize(prog_line)    # tokenize each prog line 
-            # list_all_pulses also recursively tokenize loop bodies
-            self.list_all_pulses(token_set, tokens)    # list all appeared pulse names in token_set
-            tokens_dict[ch] = tokens    # saves tokens at each ch for scheduler
-        
+
+        self._parse_sweeps(prog_cfg)
+
+        # create a set of pulse names for each channel for allocating pulse param registers
+        # key: pulse name, value: set of channel numbers the pulse is played on
+        pulse_channels = {}
+        ast_dict = {}
+        for ch, nodes in self.assets.program_ast(prog_name).items():    # the parsed prog lines
+            pulse_set = set()
+            self.list_all_pulses(pulse_set, nodes)    # list all appeared pulse names in pulse_set
+            for pulse_name in pulse_set - set(self.sweep_vars):    # the names of swept waits are not pulses
+                pulse_channels.setdefault(pulse_name, set()).add(int(ch[-1]))
+            ast_dict[ch] = nodes    # saves the parsed prog line at each ch for scheduler
+
+        self._parse_live_pulses(prog_cfg)
+        for pulse_name in list(self.swept_pulses) + list(self.live_pulses):
+            if pulse_name not in pulse_channels:
+                raise RuntimeError(f"Compilation Error: {'swept' if pulse_name in self.swept_pulses else 'live'} pulse "
+                                   f"{pulse_name} is not played by the program")
+
         # generate asm code for allocate registers for each pulse that appeared across all channels
-        for pulse_name in token_set:
-            pulse_cfg = self.load_pulses_cfg(pulse_name)
+        for pulse_name, channels in pulse_channels.items():
+            self._start_phase("pulse_cfg")
+            # the config is shared with the asset registry, copy it before adding the name
+            pulse_cfg = dict(self.load_pulses_cfg(pulse_name))
+            self.dependencies.add(("waveform", pulse_name))
             # save the pulse length to LUT
             self.pulse_length_LUT[pulse_name] = pulse_cfg["length"]
             self.pulse_style_LUT[pulse_name] = pulse_cfg["style"]
+            # the waveform is called by the name it was uploaded with
+            pulse_cfg["name"] = pulse_name
+            # swept fields start at the start value of the sweep
+            pulse_cfg.update(self.swept_pulses.get(pulse_name, {}))
+            self.pulse_cfg_LUT[pulse_name] = pulse_cfg
             # generate asm code
-            self.alloc_registers(pulse_cfg)
+            self._start_phase("registers")
+            self.alloc_registers(pulse_cfg, sorted(channels))
+
+        # the live pulses start with the values of their waveform configs
+        for pulse_name, addr in self.live_pulses.items():
+            for offset in Compiler.PULSE_FIELDS.values():
+                self.live_table[addr + offset] = self._block_value(self.block_key_LUT[pulse_name], offset) % 2**32
+
+        # run the scheduler to get the events for running pulses according to prog structure
+        self._start_phase("scheduling")
+        scheduler = Scheduler(self, ast_dict)
+        events = list(scheduler.schedule_next())
+
+        # place the register blocks, the most used ones stay in registers if they don't all fit
+        self._start_phase("registers")
+        self.assign_registers(self._block_uses(events))
+        for pulse_name, key in self.block_key_LUT.items():
+            if self._changes_registers(pulse_name) and key in self._spilled:
+                raise RuntimeError(f"Compilation Error: not enough registers to keep the swept or live pulse {pulse_name} in registers")
+        events = self._place_spilled_blocks(events)
 
         # wait for all the pulse params to be loaded
-        self.awg_prog.synci(200)
-
-        # run the scheduler to generate asm code for running pulses according to prog structure
-        scheduler = Scheduler(self, tokens_dict)
-        scheduler_generator = scheduler.schedule_next()
-        for fire_pulse_params in scheduler_generator:
-            [ch, start_time, pulse_name] = fire_pulse_params
-            self.fire_pulse(ch, start_time, pulse_name)
+        self._start_phase("asm")
+        self.awg_prog.synci(Compiler.START_DELAY)
+        self.schedule = events
+
+        # generate asm code for the scheduled events
+        for event in events:
+            if event[0] == "pulse":
+                self.fire_pulse(*event[1:])
+            elif event[0] == "load":
+                [_, block_key, (page, reg)] = event
+                self.load_block(block_key, page, reg)
+                self.reload_instructions += len(self._blocks[block_key])
+            elif event[0] == "sync":
+                self.advance_time(event[1])
+            elif event[0] == "loop_start":
+                [_, depth, loop_count] = event
+                self.begin_loop(depth, loop_count)
+            elif event[0] == "loop_end":
+                [_, depth, body_length] = event
+                self.end_loop(depth, body_length)
+            elif event[0] == "sweep_wait":
+                self.sweep_wait(event[1])
+            elif event[0] == "sweep_reset":
+                self.reset_sweep(event[1])
+            elif event[0] == "sweep_step":
+                self.step_sweep(event[1])
+            elif event[0] == "read_live":
+                self.read_live_pulses()
 
         self.awg_prog.end()
+        self._start_phase(None)
+        self.timings["compile"] = time.perf_counter() - t_start
+        self.report = self.compile_report()
+        if Compiler.verbose:
+            self._print_summary()
+
+
+    def _print_summary(self):
+        usage = self.register_usage()
+        print(f"Registers: {len(self._blocks)} register blocks for {len(self.block_key_LUT)} pulses, "
+              f"{sum(usage.values())} registers used on {len(usage)} pages ({usage})")
+        if len(self._sweeps) > 0:
+            print(f"Sweeps: {len(self._sweeps)} sweeps, {int(np.prod([sweep[3] for sweep in self._sweeps]))} sweep points")
+        print(f"Envelope memory: {self.envelope_bytes} bytes loaded, {self.envelope_bytes_saved} bytes saved by sharing identical envelopes")
+        if len(self._spilled) > 0:
+            print(f"Spilled registers: {len(self._spilled)} register blocks are reloaded when needed, "
+                  f"{self.reload_instructions} extra regwi instructions")
+        print(f"Compiled in {self.timings['compile'] * 1e3:.1f} ms ("
+              + ", ".join(f"{phase} {seconds * 1e3:.1f} ms" for phase, seconds in self.timings.items() if phase != "compile")
+              + f"), {self.report['instructions']} of {self.report['instruction_capacity']} instructions")
+
+
+    def _start_phase(self, phase):
+        """
+        the compilation enters phase (see COMPILE_PHASES, None at the end), the time since the previous phase
+        started is added to the timing of that phase
+        """
+        now = time.perf_counter()
+        if self.phase is not None:
+            self.timings[self.phase] = self.timings.get(self.phase, 0.0) + now - self._phase_start
+        self.phase = phase
+        self._phase_start = now
 
 
-
-    def fire_pulse(self, ch, start_time, pulse_name):
+    def compile_report(self):
+        """
+        time spent in every phase (seconds) and hardware resources used by the compiled program, also works
+        on a failed compilation, then phase is the phase it failed in
+            instructions, instruction_capacity    length of the asm code and size of the tproc program memory
+            registers                             registers used on the register pages ({page: number}) and in total,
+                                                  register blocks, spilled blocks and the regwi reloading them
+            envelope_memory                       {channels: [{ch, samples, capacity}] of every generator with envelopes,
+                                                   envelope_bytes: bytes loaded, envelope_bytes_saved: bytes not loaded
+                                                   because an identical envelope is on the channel already}
+            max_time_value                        largest value written into a time register (at most MAX_PULSE_TIME)
+            end_time                              clk cycle the last pulse ends, from the start of the program
+            patched                               [kind, name] of the files the program was updated in place for
+        """
+        p = self.awg_prog
+        usage = self.register_usage()
+        channels = []
+        for ch, envelopes in enumerate(p.envelopes):
+            if len(envelopes) == 0:
+                continue
+            gen = p.soccfg['gens'][ch]
+            samples = max(envelope["addr"] * gen['samps_per_clk'] + len(envelope["data"]) for envelope in envelopes.values())
+            channels.append({"ch": ch, "samples": samples, "capacity": gen['maxlen']})
+        end_time = 0
+        if len(self.schedule) > 0:
+            (nodes, _) = self._schedule_tree(0, {name: 0 for name in self.pulse_length_LUT}, {"": 0}, "", itertools.count())
+            values = {self._sweep_var_name(target[1]): sweep_start for (target, sweep_start, _, _) in self._sweeps
+                      if target[0] is None}
+            end = self._schedule_end(nodes, values)[1]
+            end_time = Compiler.START_DELAY + end if end is not None else 0
+        timings = dict(self.timings)
+        if self.phase is not None:
+            # the phase the compilation failed in
+            timings[self.phase] = timings.get(self.phase, 0.0) + time.perf_counter() - self._phase_start
+        return {"program": self.prog_name, "phase": self.phase, "timings": timings,
+                "instructions": len(p.prog_list), "instruction_capacity": p.soccfg['tprocs'][0]['pmem_size'],
+                "registers": {"used": sum(usage.values()), "capacity": (Compiler.NUM_PAGE - 1) * Compiler.NUM_REG,
+                              "pages": usage, "register_blocks": len(self._blocks), "spilled_blocks": len(self._spilled),
+                              "reload_instructions": self.reload_instructions},
+                "envelope_memory": {"channels": channels, "envelope_bytes": self.envelope_bytes,
+                                    "envelope_bytes_saved": self.envelope_bytes_saved},
+                "max_time_value": max((event[2] for event in self.schedule if event[0] == "pulse"), default=0),
+                "end_time": end_time, "patched": list(self.patched)}
+
+
+
+    def fire_pulse(self, ch, start_time, pulse_name, block_ptr=None):
         """
         Generate asm code for firing pulse at ch at start_time
+        BLOCK_PTR: (page, first register) of the swap slot if the register block of the pulse is spilled
         """
         # get correct addr register
         # correctly set start_time register
         p = self.awg_prog
         pulse_style = self.pulse_style_LUT[pulse_name]
-        pulse_reg_ptr = self.reg_LUT[pulse_name]
-        pulse_page_ptr = self.page_LUT[pulse_name]
+        if block_ptr is None:
+            pulse_reg_ptr = self.reg_LUT[pulse_name]
+            pulse_page_ptr = self.page_LUT[pulse_name]
+        else:
+            (pulse_page_ptr, pulse_reg_ptr) = block_ptr
 
-        freq_reg = pulse_reg_ptr
-        phase_reg = pulse_reg_ptr + 1
-        gain_reg = pulse_reg_ptr + 3
+        freq_reg = pulse_reg_ptr + Compiler.FREQ_REG
+        phase_reg = pulse_reg_ptr + Compiler.PHASE_REG
+        gain_reg = pulse_reg_ptr + Compiler.GAIN_REG
 
         if pulse_style == "const":
             addr_reg = 0
         else: 
-            addr_reg = pulse_reg_ptr + 2
+            addr_reg = pulse_reg_ptr + Compiler.ADDR_REG
         
-        mc_reg = pulse_reg_ptr + 4
-        time_reg = pulse_reg_ptr + 5
+        mc_reg = pulse_reg_ptr + Compiler.MC_REG
+        time_reg = Compiler.TIME_REG
+
+        ch_number = int(ch[-1])
+        if pulse_style == "arb" and len(set(self.addr_LUT[pulse_name].values())) > 1:
+            addr = self.addr_LUT[pulse_name][ch_number]
+            p.safe_regwi(pulse_page_ptr, addr_reg, addr, comment=f"pulse {pulse_name} mem addr = {addr}")
 
         p.safe_regwi(pulse_page_ptr, time_reg, start_time, comment=f'time = {start_time}')       
         
-        ch_number = int(ch[-1])
         p.set(ch_number, pulse_page_ptr, freq_reg, phase_reg, addr_reg, gain_reg, mc_reg, time_reg)
 
 
-    def alloc_registers(self, pulse_cfg):
+    def begin_loop(self, depth, loop_count):
         """
-        alloc registers at curr_reg_ptr and curr_page_ptr for a specific pulse
-        It allocates freq, phase, gain, phrst, mode, outsel, stdysel, and load memory data to
-        addr of every ch (all channels 0-7), it does not populate the t register 
+        Generate asm code for the start of a loop. The loop counter of nesting level depth is 
+        register $(depth + 1) on page 0. LOOP_COUNT is a number or the name of a swept loop count
+        """
+        p = self.awg_prog
+        counter_reg = depth + 1
+        # the registers above the counters hold the swept waits and loop counts
+        if counter_reg > Compiler.NUM_REG - len(self.sweep_vars):
+            raise RuntimeError(f"Compilation Error: loops are nested too deep (depth: {depth})")
+        label = f"LOOP_{self._loop_label_count}"
+        self._loop_label_count += 1
+        self._loop_labels.append(label)
+        # loopnz jumps back as long as the counter is not 0, so the body runs loop_count times
+        if isinstance(loop_count, str):
+            p.mathi(Compiler.LOOP_PAGE, counter_reg, self.sweep_vars[loop_count], '-', 1, comment=f"loop count = {loop_count}")
+        else:
+            p.safe_regwi(Compiler.LOOP_PAGE, counter_reg, loop_count - 1, comment=f"loop count = {loop_count}")
+        p.label(label)
+
+
+    def end_loop(self, depth, body_length):
+        """
+        Generate asm code for the end of a loop: advance the time base to the start of the 
+        next iteration and jump back to the start of the loop body
+        """
+        p = self.awg_prog
+        label = self._loop_labels.pop()
+        self.advance_time(body_length)
+        p.loopnz(Compiler.LOOP_PAGE, depth + 1, label)
+
+
+    def advance_time(self, cycles):
+        """
+        Generate asm code to advance the time base by cycles
+        """
+        while cycles > 0:
+            self.awg_prog.synci(min(cycles, Compiler.MAX_SYNCI))
+            cycles -= Compiler.MAX_SYNCI
+
+
+    def sweep_wait(self, name):
+        """
+        Generate asm code to advance the time base by the current value of the swept wait name
+        """
+        self.awg_prog.sync(Compiler.LOOP_PAGE, self.sweep_vars[name], comment=f"wait {name}")
+
+
+    def reset_sweep(self, depth):
+        """
+        Generate asm code to load the start value of the sweep of nesting level depth
+        """
+        (target, start, step, count) = self._sweeps[depth]
+        (page, reg) = self._sweep_register(target)
+        self._load_register(self.awg_prog, page, reg, start, comment=f"sweep {depth} start = {start}")
+
+
+    def step_sweep(self, depth):
+        """
+        Generate asm code to add the step to the swept value of nesting level depth, steps that don't fit
+        into the immediate value of mathi take several instructions
+        """
+        (target, start, step, count) = self._sweeps[depth]
+        (page, reg) = self._sweep_register(target)
+        op = '+' if step >= 0 else '-'
+        step = abs(step)
+        while step > 0:
+            imm = min(step, Compiler.MAX_MATHI)
+            self.awg_prog.mathi(page, reg, reg, op, imm, comment=f"sweep {depth} step")
+            step -= imm
+
+
+    def read_live_pulses(self):
+        """
+        Generate asm code to read the fields of the live pulses from the data memory into their registers
+        """
+        p = self.awg_prog
+        for pulse_name, addr in self.live_pulses.items():
+            for field, offset in Compiler.PULSE_FIELDS.items():
+                p.memri(self.page_LUT[pulse_name], self.reg_LUT[pulse_name] + offset, addr + offset, comment=f"{pulse_name} {field}")
+
+
+    def live_update(self, pulse_name, params):
+        """
+        PARAMS: new values of the fields of a live pulse, e.g. {"gain": 2000, "phase": 90} (freq in MHz, phase in deg)
+        returns {data memory address: 32 bit value} to write into the tproc data memory
+        """
+        if pulse_name not in self.live_pulses:
+            raise RuntimeError(f"Pulse {pulse_name} is not a live pulse of the program, add it to live_pulses of the program")
+        p = self.awg_prog
+        table = {}
+        for field, value in params.items():
+            if field not in Compiler.PULSE_FIELDS:
+                raise RuntimeError(f"Field {field} can't be updated, only {list(Compiler.PULSE_FIELDS)}")
+            if field == "freq":
+                value = p.freq2reg(f=value)
+            elif field == "phase":
+                value = p.deg2reg(deg=value)
+            elif not isinstance(value, int) or not -2**15 <= value < 2**15:
+                raise RuntimeError(f"Gain must be an integer from -2^15 to 2^15-1, got {value}")
+            table[self.live_pulses[pulse_name] + Compiler.PULSE_FIELDS[field]] = value % 2**32
+        return table
+
+
+    def _parse_live_pulses(self, prog_cfg):
+        """
+        read the live_pulses of the program config, a list of pulse names, e.g. "live_pulses": ["X", "Y"]
+        """
+        for pulse_name in prog_cfg.get("live_pulses", []):
+            if pulse_name in self.swept_pulses:
+                raise RuntimeError(f"Compilation Error: pulse {pulse_name} can't be swept and live")
+            if pulse_name not in self.live_pulses:
+                self.live_pulses[pulse_name] = len(self.live_pulses) * len(Compiler.PULSE_FIELDS)
+
+
+    def _sweep_register(self, target):
+        """
+        (page, register) of the swept value of target, see _sweeps
+        """
+        (pulse_name, offset) = target
+        if pulse_name is None:
+            return (Compiler.LOOP_PAGE, offset)
+        return (self.page_LUT[pulse_name], self.reg_LUT[pulse_name] + offset)
+
+
+    def _parse_sweeps(self, prog_cfg):
+        """
+        read the sweeps of the program config, e.g.
+            "sweeps": [{"pulse": "X", "field": "gain", "start": 0, "step": 1000, "count": 11},
+                       {"name": "tau", "start": 100, "step": 10, "count": 50}]
+        A pulse sweep changes the freq (MHz), phase (deg) or gain of a pulse. A named sweep is a wait time
+        (clk cycles) or a loop count used by its name in prog_structure, e.g. "[X, tau, Y]" or "loop(tau, [X])".
+        The first sweep is the outermost, the last one changes after every repetition of the program
+        """
+        p = self.awg_prog
+        for sweep in prog_cfg.get("sweeps", []):
+            if any(key not in sweep for key in ["start", "step", "count"]):
+                raise RuntimeError(f"Compilation Error: sweep {sweep} needs a start, a step and a count")
+            (start, step, count) = (sweep["start"], sweep["step"], sweep["count"])
+            if not isinstance(count, int) or count < 1:
+                raise RuntimeError(f"Compilation Error: sweep count must be a positive integer, got {count}")
+            last = start + (count - 1) * step
+            if "pulse" in sweep:
+                (pulse_name, field) = (sweep["pulse"], sweep.get("field"))
+                if field not in Compiler.PULSE_FIELDS:
+                    raise RuntimeError(f"Compilation Error: swept field of pulse {pulse_name} must be one of "
+                                       f"{list(Compiler.PULSE_FIELDS)}, got {field}")
+                if field in self.swept_pulses.get(pulse_name, {}):
+                    raise RuntimeError(f"Compilation Error: {field} of pulse {pulse_name} is swept twice")
+                if field == "freq":
+                    (start_reg, step_reg) = (p.freq2reg(f=start), p.freq2reg(f=abs(step)))
+                elif field == "phase":
+                    (start_reg, step_reg) = (p.deg2reg(deg=start), p.deg2reg(deg=abs(step)))
+                else:
+                    if not isinstance(start, int) or not isinstance(step, int) or not -2**15 <= min(start, last) <= max(start, last) < 2**15:
+                        raise RuntimeError(f"Compilation Error: swept gain of pulse {pulse_name} must be integers from -2^15 to 2^15-1")
+                    (start_reg, step_reg) = (start, abs(step))
+                if step < 0:
+                    step_reg = -step_reg
+                if field != "gain":
+                    # freq and phase registers wrap around, step the shorter way
+                    step_reg = (step_reg + 2**31) % 2**32 - 2**31
+                self.swept_pulses.setdefault(pulse_name, {})[field] = start
+                target = (pulse_name, Compiler.PULSE_FIELDS[field])
+            elif "name" in sweep:
+                name = sweep["name"]
+                if name in self.sweep_vars:
+                    raise RuntimeError(f"Compilation Error: {name} is swept twice")
+                if not isinstance(start, int) or not isinstance(step, int) or not 0 <= min(start, last) <= max(start, last) < 2**31:
+                    raise RuntimeError(f"Compilation Error: swept wait or loop count {name} must be integers from 0 to 2^31-1")
+                self.sweep_vars[name] = Compiler.NUM_REG - len(self.sweep_vars)
+                self._sweep_var_range[name] = (min(start, last), max(start, last))
+                (start_reg, step_reg) = (start, step)
+                target = (None, self.sweep_vars[name])
+            else:
+                raise RuntimeError(f"Compilation Error: sweep {sweep} needs a pulse and a field or a name")
+            self._sweeps.append((target, start_reg, step_reg, count))
+
+
+    def alloc_registers(self, pulse_cfg, channels):
+        """
+        make the register block for a specific pulse
+        It computes freq, phase, gain, phrst, mode, outsel, stdysel, and load memory data to
+        addr of every ch in channels (the channel numbers the pulse is played on), it does not 
+        populate the t register. The block is placed into registers by assign_registers
         """
         p = self.awg_prog
         pulse_name = pulse_cfg["name"]
         style = pulse_cfg["style"]
-        freq = p.freq2reg(f=pulse_cfg["freq"])
-        phase = p.deg2reg(deg=pulse_cfg["phase"])
-        gain = pulse_cfg["gain"]
-        phrst = pulse_cfg.get("phrst")    # is None if not defined
-        mode = pulse_cfg.get("mode")
-        outsel = pulse_cfg.get("outsel")
-        stdysel = pulse_cfg.get("stdysel")
-        length = pulse_cfg["length"]        # length in number of clock cycles (2.6ns)
         i_data_name = pulse_cfg.get("i_data_name")
         q_data_name = pulse_cfg.get("q_data_name")
+        self._start_phase("envelopes")
         if i_data_name is not None:
+            self.dependencies.add(("envelope", i_data_name))
             i_data = self.load_envelope_data(i_data_name)
             env_length = len(i_data) // self.samps_per_clk
         else:
             i_data = None
         if q_data_name is not None:
+            self.dependencies.add(("envelope", q_data_name))
             q_data = self.load_envelope_data(q_data_name)
             env_length = len(q_data) // self.samps_per_clk
         else:
             q_data = None
 
-        # load all params to registers
-        # safe_regwi make sure successful write if a number is more than 30 bits (see qick.asm_v1)
-        p.safe_regwi(self._curr_page_ptr, self._curr_reg_ptr, freq, comment=f"freq = {freq}")
-        p.safe_regwi(self._curr_page_ptr, self._curr_reg_ptr + 1, phase, comment=f"phase = {phase}")
-        p.safe_regwi(self._curr_page_ptr, self._curr_reg_ptr + 3, gain, comment=f"gain = {gain}")
+        if style == 'arb':
+            # add evelope to all channels that uses this pulse
+            # for a single pulse on different ch, every ch has a different addr
+            self.addr_LUT[pulse_name] = {}
+            env_hash = self._envelope_hash(i_data, q_data)
+            # envelope memory stores I and Q of every sample as int16
+            env_bytes = 4 * env_length * self.samps_per_clk
+            for ch in channels:
+                if (ch, env_hash) in self.envelope_pool:
+                    # the same envelope data is already loaded for another pulse on this ch
+                    self.addr_LUT[pulse_name][ch] = self.envelope_pool[(ch, env_hash)]
+                    self.envelope_bytes_saved += env_bytes
+                    continue
+                # add_envelope will round data elements to integers
+                # this line calculates the memory addr for each ch
+                p.add_envelope(ch=ch, name=pulse_name, idata=i_data, qdata=q_data)
+                self.envelope_bytes += env_bytes
+                # addr = p.envelopes[ch]['envs'][pulse_name]["addr"]
+                self.addr_LUT[pulse_name][ch] = p.envelopes[ch][pulse_name]["addr"]
+                self.envelope_pool[(ch, env_hash)] = self.addr_LUT[pulse_name][ch]
+        else:
+            env_length = None
+        self._start_phase("registers")
+
+        block = self._make_block(pulse_cfg, env_length)
+
+
+
+        """
+        smallest pulse length is 3 clk cycles (48 envelope points), number of points / 16 must be the number of clk cycles
+        """
+
+
+
+        """I decide to not include flat_top as it requires 4 registers to define (addr_ramp_down, three reg for phrst|stdysel|mode|outsel)
+        each page can only have 31 registers ($0 reserved for the literal 0), each pulse needs up to 5 reg plus the time reg of the page
+        But the SET instruction can only take registers on the same page, so correctly allocating the registers for flat_top is 
+        not straightforward. On the other hand, one can just define three pulses and put them together to form the flat_top pulse.
+        """
+        # pulses with the same register values share one block, the addr of every channel has to match as well
+        # the block is placed into registers by assign_registers
+        block_key = self._block_key(pulse_name, block)
+        self._blocks.setdefault(block_key, block)
+        self.block_key_LUT[pulse_name] = block_key
+
+
+    def _block_key(self, pulse_name, block):
+        style = self.pulse_cfg_LUT[pulse_name]["style"]
+        key = (style, tuple(value for (_, value, _) in block), tuple(sorted(self.addr_LUT.get(pulse_name, {}).items())))
+        if self._changes_registers(pulse_name):
+            # the registers change while the program runs, they can't be shared
+            key += (pulse_name,)
+        return key
+
+
+    def _changes_registers(self, pulse_name):
+        """
+        True for swept and live pulses, their registers change while the program runs
+        """
+        return pulse_name in self.swept_pulses or pulse_name in self.live_pulses
+
+
+    def _make_block(self, pulse_cfg, env_length=None):
+        """
+        returns the register block of a pulse: [(offset from the first register, value, comment)]
+        ENV_LENGTH: length of the envelope in clk cycles, for arb pulses. Their envelopes must be in addr_LUT already
+        """
+        p = self.awg_prog
+        pulse_name = pulse_cfg["name"]
+        style = pulse_cfg["style"]
+        freq = p.freq2reg(f=pulse_cfg["freq"])
+        phase = p.deg2reg(deg=pulse_cfg["phase"])
+        gain = pulse_cfg["gain"]
+        phrst = pulse_cfg.get("phrst")    # is None if not defined
+        mode = pulse_cfg.get("mode")
+        outsel = pulse_cfg.get("outsel")
+        stdysel = pulse_cfg.get("stdysel")
+        length = pulse_cfg["length"]        # length in number of clock cycles (2.6ns)
+
+        # (offset from the first register, value, comment) of every register of the pulse
+        block = [(Compiler.FREQ_REG, freq, f"freq = {freq}"),
+                 (Compiler.PHASE_REG, phase, f"phase = {phase}"),
+                 (Compiler.GAIN_REG, gain, f"gain = {gain}")]
 
         # set 
         if style == 'const':
             # use addr 0 if style is const
-            addr_reg = 0
             # make the mode code
             mc = self._get_mode_code(phrst=phrst, stdysel=stdysel, mode=mode, outsel="dds", length=length)
-            p.safe_regwi(self._curr_page_ptr, self._curr_reg_ptr + 4, mc, comment=f'phrst| stdysel | mode | | outsel = 0b{mc//2**16:>05b} | length = {mc % 2**16} ')
+            block.append((Compiler.MC_REG, mc, f'phrst| stdysel | mode | | outsel = 0b{mc//2**16:>05b} | length = {mc % 2**16} '))
         elif style == 'arb':
-            # add evelope to all channels that uses this pulse
-            # for a single pulse on different ch, every ch has a different addr
-            for ch in range(Compiler.NUM_CHANNELS):
-                # add_envelope will round data elements to integers
-                # this line calculates the memory addr for each ch
-                p.add_envelope(ch=ch, name=pulse_name, idata=i_data, qdata=q_data)
-                                               
-            # addr = p.envelopes[0]['envs'][pulse_name]["addr"]
-            addr = p.envelopes[0][pulse_name]["addr"]
-            print(f"this is the addr: {addr}")
-            # write the correct addr to register
-            p.safe_regwi(self._curr_page_ptr, self._curr_reg_ptr + 2, addr, comment=f"pulse {pulse_name} mem addr = {addr}")
-    
             # make the mode code
             mc = self._get_mode_code(phrst=phrst, stdysel=stdysel, mode=mode, outsel=outsel, length=env_length)
-            p.safe_regwi(self._curr_page_ptr, self._curr_reg_ptr + 4, mc, comment=f'phrst| stdysel | mode | | outsel = 0b{mc//2**16:>05b} | length = {mc % 2**16} ')
+            block.append((Compiler.MC_REG, mc, f'phrst| stdysel | mode | | outsel = 0b{mc//2**16:>05b} | length = {mc % 2**16} '))
+            # write the addr of the first channel to register, if the addr differs between channels
+            # fire_pulse rewrites the addr register before every set
+            addr = next(iter(self.addr_LUT[pulse_name].values()))
+            block.append((Compiler.ADDR_REG, addr, f"pulse {pulse_name} mem addr = {addr}"))
 
         # add flat envelope to allow pulse length not equal to a multiple of one clk cycle (2.6ns)
         elif style == 'buffer':
             # 
             pass 
-            
-            
-            
-            
-            
-
+        return block
 
 
+    def update(self, kind, name):
         """
-        smallest pulse length is 3 clk cycles (48 envelope points), number of points / 16 must be the number of clk cycles
+        the waveform or the envelope name has changed, update the compiled program in place. Only the
+        register blocks of the pulses of the waveform, or the envelope memory of the envelope, are rebuilt.
+        returns False if the change needs a new compilation (e.g. a pulse length changed, so the schedule
+        changes), the program is left unchanged then. Otherwise the report describes the updated program
         """
+        if kind == "waveform":
+            ok = self._update_waveform(name)
+        elif kind == "envelope":
+            ok = self._update_envelope(name)
+        else:
+            ok = False
+        if ok:
+            if [kind, name] not in self.patched:
+                self.patched.append([kind, name])
+            self.report = self.compile_report()
+        return ok
+
+
+    def _update_waveform(self, pulse_name):
+        old_cfg = self.pulse_cfg_LUT.get(pulse_name)
+        if old_cfg is None or self._changes_registers(pulse_name):
+            return False
+        pulse_cfg = dict(self.load_pulses_cfg(pulse_name))
+        pulse_cfg["name"] = pulse_name
+        if any(pulse_cfg.get(key) != old_cfg.get(key) for key in ["style", "length", "i_data_name", "q_data_name"]):
+            # the schedule or the envelope memory changes
+            return False
+        old_key = self.block_key_LUT[pulse_name]
+        if [name for name, key in self.block_key_LUT.items() if key == old_key] != [pulse_name]:
+            # the block is shared with other pulses
+            return False
+        # the envelope is unchanged, so is its length in the mode code
+        env_length = self._block_value(old_key, Compiler.MC_REG) % 2**16 if pulse_cfg["style"] == "arb" else None
+        block = self._make_block(pulse_cfg, env_length)
+        new_key = self._block_key(pulse_name, block)
+        if new_key != old_key:
+            if new_key in self._blocks:
+                # another pulse has the same values now, the blocks would be merged by a compilation
+                return False
+            patches = self._reload_block(old_key, block)
+            if patches is None:
+                return False
+            for (start, instructions) in patches:
+                self.awg_prog.prog_list[start:start + len(instructions)] = instructions
+            # the block keeps its registers under the new key
+            del self._blocks[old_key]
+            self._blocks[new_key] = block
+            if old_key in self._block_LUT:
+                self._block_LUT[new_key] = self._block_LUT.pop(old_key)
+            if old_key in self._spilled:
+                self._spilled.remove(old_key)
+                self._spilled.add(new_key)
+            self._block_loads[new_key] = self._block_loads.pop(old_key)
+            self.block_key_LUT[pulse_name] = new_key
+        self.pulse_cfg_LUT[pulse_name] = pulse_cfg
+        return True
+
+
+    def _block_value(self, block_key, offset):
+        return next(value for (o, value, _) in self._blocks[block_key] if o == offset)
+
+
+    def _reload_block(self, block_key, block):
+        """
+        returns [(index in prog_list, instructions)] that load the values of block instead of the block of
+        block_key into its registers, None if they don't take the same number of instructions
+        """
+        values = {offset: (value, comment) for (offset, value, comment) in block}
+        # a program of the same class only to generate the instructions
+        scratch = type(self.awg_prog)(self.awg_prog.soccfg, None)
+        patches = []
+        for (offset, page, reg, start, count) in self._block_loads.get(block_key, []):
+            n = len(scratch.prog_list)
+            self._load_register(scratch, page, reg, *values[offset])
+            instructions = scratch.prog_list[n:]
+            if len(instructions) != count:
+                return None
+            patches.append((start, instructions))
+        return patches
+
+
+    def _update_envelope(self, env_name):
+        p = self.awg_prog
+        pulses = [pulse_name for pulse_name, cfg in self.pulse_cfg_LUT.items()
+                  if cfg["style"] == "arb" and env_name in (cfg.get("i_data_name"), cfg.get("q_data_name"))]
+        if len(pulses) == 0:
+            return False
+        # the envelopes are added to a program of the same class, their data then replaces the old data
+        scratch = type(p)(p.soccfg, None)
+        # key: (ch, addr), value: (hash of the new envelope, envelope added to scratch)
+        segments = {}
+        for pulse_name in pulses:
+            cfg = self.pulse_cfg_LUT[pulse_name]
+            i_data = self.load_envelope_data(cfg["i_data_name"]) if cfg.get("i_data_name") is not None else None
+            q_data = self.load_envelope_data(cfg["q_data_name"]) if cfg.get("q_data_name") is not None else None
+            env_length = len(i_data if i_data is not None else q_data) // self.samps_per_clk
+            if env_length != self._block_value(self.block_key_LUT[pulse_name], Compiler.MC_REG) % 2**16:
+                # the envelopes after it would move
+                return False
+            env_hash = self._envelope_hash(i_data, q_data)
+            for ch, addr in self.addr_LUT[pulse_name].items():
+                if (ch, addr) in segments:
+                    if segments[(ch, addr)][0] != env_hash:
+                        # pulses that shared the envelope have different envelopes now
+                        return False
+                    continue
+                scratch.add_envelope(ch=ch, name=pulse_name, idata=i_data, qdata=q_data)
+                segments[(ch, addr)] = (env_hash, scratch.envelopes[ch][pulse_name])
+        for pulse_name, addrs in self.addr_LUT.items():
+            if pulse_name not in pulses and any((ch, addr) in segments for ch, addr in addrs.items()):
+                # a pulse that doesn't use env_name shares the envelope memory
+                return False
+
+        for (ch, addr), (env_hash, envelope) in segments.items():
+            # the envelope is stored under the name of the pulse that added it first
+            name = next(name for name, old in p.envelopes[ch].items() if old["addr"] == addr)
+            envelope = dict(envelope)
+            envelope["addr"] = addr
+            p.envelopes[ch][name] = envelope
+            for key in [key for key, pool_addr in self.envelope_pool.items() if key[0] == ch and pool_addr == addr]:
+                del self.envelope_pool[key]
+            self.envelope_pool.setdefault((ch, env_hash), addr)
+        return True
 
+    
 
-
-        """I decide to not include flat_top as it requires 4 registers to define (addr_ramp_down, three reg for phrst|stdysel|mode|outsel)
-        each page can only have 31 registers ($0 reserved for the literal 0), each pulse needs 6 reg, so each page has a spare reg $31
-        But the SET instruction can only take registers on the same page, so correctly allocating the registers for flat_top is 
-        not straightforward. On the other hand, one can just define three pulses and put them together to form the flat_top pulse.
+    def timeline(self, start=None, stop=None):
+        """
+        every pulse the compiled program plays, in order of start time, with loops and sweeps expanded.
+        returns (table, info), table is a NumPy structured array of TIMELINE_DTYPE:
+            ch          channel number
+            start       start time in clk cycles from the start of the program
+            duration    length of the pulse in clk cycles
+            pulse       id of the pulse, info["pulses"][id] is its name
+            loop_path   id of the loops around the pulse, info["loop_paths"][id] is e.g. "LOOP_0/LOOP_2"
+                        (the labels of the loops in the asm code, outermost first)
+            page        register page of the pulse
+        only the rows start:stop are returned if given, info["rows"] is the number of rows of the whole table
+        """
+        info = {"pulses": sorted(self.pulse_length_LUT)}
+        pulse_ids = {name: i for i, name in enumerate(info["pulses"])}
+        # key: loop path, value: id
+        path_ids = {"": 0}
+        (nodes, _) = self._schedule_tree(0, pulse_ids, path_ids, "", itertools.count())
+        info["loop_paths"] = list(path_ids)
+        # named sweeps start at their start value
+        values = {}
+        for (target, sweep_start, step, count) in self._sweeps:
+            if target[0] is None:
+                values[self._sweep_var_name(target[1])] = sweep_start
+        (table, _) = self._expand_schedule(nodes, values)
+        table["start"] += Compiler.START_DELAY
+        info["rows"] = len(table)
+        return table[start:stop], info
+
+
+    def _sweep_var_name(self, reg):
+        return next(name for name, var_reg in self.sweep_vars.items() if var_reg == reg)
+
+
+    def _schedule_tree(self, i, pulse_ids, path_ids, path, loop_numbers):
+        """
+        the events of schedule from index i to the end of the loop they are in as a list of nodes
+            ("pulse", row of TIMELINE_DTYPE with the start relative to the time base)
+            ("sync", cycles), ("wait", name of the swept wait)
+            ("loop", depth, count, body nodes, cycles to advance at the end of every iteration)
+        returns (nodes, index of the event after the loop end)
+        """
+        nodes = []
+        while i < len(self.schedule):
+            event = self.schedule[i]
+            i += 1
+            if event[0] == "pulse":
+                pulse_name = event[3]
+                page = event[4][0] if len(event) > 4 else self.page_LUT[pulse_name]
+                nodes.append(("pulse", (int(event[1][-1]), event[2], self.pulse_length_LUT[pulse_name],
+                                        pulse_ids[pulse_name], path_ids[path], page)))
+            elif event[0] == "sync":
+                nodes.append(("sync", event[1]))
+            elif event[0] == "sweep_wait":
+                nodes.append(("wait", event[1]))
+            elif event[0] == "loop_start":
+                # loops are labeled in the order they start, like begin_loop does
+                label = f"LOOP_{next(loop_numbers)}"
+                body_path = f"{path}/{label}" if path else label
+                path_ids.setdefault(body_path, len(path_ids))
+                (body, i) = self._schedule_tree(i, pulse_ids, path_ids, body_path, loop_numbers)
+                nodes.append(("loop", event[1], event[2], body, self.schedule[i - 1][2]))
+            elif event[0] == "loop_end":
+                return (nodes, i)
+        return (nodes, i)
+
+
+    def _expand_schedule(self, nodes, values):
+        """
+        the rows of TIMELINE_DTYPE of nodes (see _schedule_tree) with start times relative to the start
+        of nodes, and the time base at the end of nodes. VALUES: current value of every swept wait and loop count
+        """
+        parts = []
+        rows = []
+        time_base = 0
+        for node in nodes:
+            if node[0] == "pulse":
+                row = node[1]
+                rows.append(row[:1] + (time_base + row[1],) + row[2:])
+                continue
+            if node[0] == "sync":
+                time_base += node[1]
+                continue
+            if node[0] == "wait":
+                time_base += values[node[1]]
+                continue
+            (_, depth, count, body, end_cycles) = node
+            parts.append(np.array(rows, dtype=Compiler.TIMELINE_DTYPE))
+            rows = []
+            sweep = self._sweeps[depth] if depth < len(self._sweeps) else None
+            if sweep is not None and sweep[0][0] is None:
+                # every point of a named sweep has its own timing
+                (target, sweep_start, step, count) = sweep
+                name = self._sweep_var_name(target[1])
+                for k in range(count):
+                    (body_table, body_time) = self._expand_schedule(body, dict(values, **{name: sweep_start + k * step}))
+                    body_table["start"] += time_base
+                    parts.append(body_table)
+                    time_base += body_time + end_cycles
+                continue
+            if isinstance(count, str):
+                count = values[count]
+            (body_table, body_time) = self._expand_schedule(body, values)
+            period = body_time + end_cycles
+            table = np.tile(body_table, count)
+            table["start"] += time_base + np.repeat(np.arange(count, dtype=np.int64) * period, len(body_table))
+            parts.append(table)
+            time_base += count * period
+        parts.append(np.array(rows, dtype=Compiler.TIMELINE_DTYPE))
+        return (np.concatenate(parts), time_base)
+
+
+    def _schedule_end(self, nodes, values):
+        """
+        like _expand_schedule without the rows: (time base at the end of nodes, end of the last pulse of nodes
+        or None if nodes play no pulse), relative to the start of nodes
+        """
+        time_base = 0
+        end = None
+        for node in nodes:
+            if node[0] == "pulse":
+                end = max(end if end is not None else 0, time_base + node[1][1] + node[1][2])
+                continue
+            if node[0] == "sync":
+                time_base += node[1]
+                continue
+            if node[0] == "wait":
+                time_base += values[node[1]]
+                continue
+            (_, depth, count, body, end_cycles) = node
+            sweep = self._sweeps[depth] if depth < len(self._sweeps) else None
+            if sweep is not None and sweep[0][0] is None:
+                (target, sweep_start, step, count) = sweep
+                name = self._sweep_var_name(target[1])
+                for k in range(count):
+                    (body_time, body_end) = self._schedule_end(body, dict(values, **{name: sweep_start + k * step}))
+                    if body_end is not None:
+                        end = max(end if end is not None else 0, time_base + body_end)
+                    time_base += body_time + end_cycles
+                continue
+            if isinstance(count, str):
+                count = values[count]
+            (body_time, body_end) = self._schedule_end(body, values)
+            period = body_time + end_cycles
+            if body_end is not None and count > 0:
+                end = max(end if end is not None else 0, time_base + (count - 1) * period + body_end)
+            time_base += count * period
+        return (time_base, end)
+
+
+    def _envelope_hash(self, i_data, q_data):
+        """
+        hash of the content of an envelope, i_data or q_data may be None
         """
-        # save the first register pointer to LUT
-        # time register should be $6, $12, $18, $24, $30
-        self.reg_LUT[pulse_name] = self._curr_reg_ptr
-        # save the register page associated to this pulse
-        self.page_LUT[pulse_name] = self._curr_page_ptr
-        # increment the register and page pointer
-        self._step_reg_ptr()
+        h = hashlib.sha256()
+        for data in (i_data, q_data):
+            if data is None:
+                h.update(b"none")
+            else:
+                # add_envelope rounds the data to integers
+                h.update(b"data")
+                data = np.asarray(data)
+                if not np.issubdtype(data.dtype, np.integer):
+                    data = np.round(data)
+                h.update(data.astype(np.int64).tobytes())
+        return h.digest()
+
 
-    
 
     def load_program_cfg(self, prog_name):
         """
-        Load program.json to a dict
+        the program config as a dict, parsed by the asset registry
         """
-        #directory_path = FPGA_AWG.program_dir_path
-        directory_path = "./program_cfg"
-        file_path = os.path.join(directory_path, prog_name + '.json').replace('\\', '/')
-        with open(file_path, 'rb') as file:
-            prog_cfg = json.load(file)
-        return prog_cfg    # a list of numbers
+        return self.assets.program(prog_name)
 
 
 
     def load_envelope_data(self, env_name):
         """
-        Load env data (.csv) to a python list
+        the envelope as an int16 array (a python list for legacy .csv files). Envelopes are stored as .npy
+        (FPGA_AWG converts uploaded .csv files), the asset registry keeps the recently used ones in memory
         """
-        #directory_path = FPGA_AWG.envelope_dir_path
-        directory_path = "./envelope_data"
-        file_path = os.path.join(directory_path, env_name + '.csv').replace('\\', '/')
-        envelope = []
-        # Open the CSV file in read mode
-        with open(file_path, mode='r') as file:
-            reader = csv.reader(file)            
-            # Read each row and append the number to the list
-            for row in reader:
-                # Convert the number from string to int (or float, if needed)
-                envelope.append(int(row[0]))
-        return envelope
+        return self.assets.envelope(env_name)
 
 
     def load_pulses_cfg(self, pulse_name):
         """
-        read pulse.json and load it into a dictionary
+        the waveform config as a dict, parsed by the asset registry
         """
-        #directory_path = FPGA_AWG.waveform_dir_path
-        directory_path = "./waveform_cfg"
-        file_path = os.path.join(directory_path, pulse_name + '.json').replace('\\', '/')
-        with open(file_path, 'rb') as file:
-            pulse_cfg = json.load(file)
-        return pulse_cfg
+        return self.assets.waveform(pulse_name)
 
 
     def reset(self):
-        self._curr_reg_ptr = 1
-        self._curr_page_ptr = 1
+        self._page_free_reg = {}
+        self._block_LUT = {}
+        self._blocks = {}
+        self.block_key_LUT = {}
+        self._spilled = set()
+        self._swap_slots = []
+        self.reload_instructions = 0
         self.reg_LUT = {}
         self.page_LUT = {}
         self.pulse_length_LUT = {}
         self.pulse_style_LUT = {}
+        self.addr_LUT = {}
+        self.pulse_cfg_LUT = {}
+        self._block_loads = {}
+        self.envelope_pool = {}
+        self._loop_labels = []
+        self._loop_label_count = 0
+        self._sweeps = []
+        self.sweep_vars = {}
+        self._sweep_var_range = {}
+        self.swept_pulses = {}
+        self.live_pulses = {}
+        self.live_table = {}
+        self.schedule = []
+        self.dependencies = set()
+        self.envelope_bytes = 0
+        self.envelope_bytes_saved = 0
+        self.prog_name = None
+        self.timings = {}
+        self.phase = None
+        self._phase_start = None
+        self.report = None
+        self.patched = []
 
     
     def _get_mode_code(self, length, mode=None, outsel=None, stdysel=None, phrst=None):
@@ -454,6 +1335,9 @@ class Compiler():
     
     
 
+    
+    
+
 class Scheduler():
     """
     contains a list of channels
@@ -462,96 +1346,347 @@ class Scheduler():
     channel. time is the time at which the next pulse is played immediately
 
     need to sort all events based on their start time across diff channels
+
+    loops are lowered to tproc loops (counter register on page 0, synci by the length of the 
+    loop body at the end of every iteration, loopnz back to the start of the body). A loop
+    can only be lowered if every channel that has something to play while the loop runs
+    plays an identical loop (same start time, loop count and body length); those channels
+    share one tproc loop. All other loops are unrolled.
+
+    pulse start times are kept relative to a time base that follows the program: whenever the next
+    pulse would start more than Compiler.MAX_PULSE_TIME after the time base, the time base is moved 
+    to the start of that pulse with synci. Pulses are scheduled in order of start time, so no 
+    channel has a pending pulse before the new time base. Inside a loop body the time base starts 
+    at the start of the iteration, so the times in a loop don't grow with the loop count.
+
+    swept waits and loops with a swept wait or a swept loop count in them change the time of everything
+    after them while the program runs, so they split the program into segments that are scheduled one
+    after another: a swept wait or loop must start at the same time on every channel that plays something
+    after it. The sweeps of the compiler are loops around the whole program.
+
+    schedule_next yields the following events, times are relative to the current time base:
+        ["pulse", ch, start_time, pulse_name]
+        ["sync", cycles]                  advance the time base by cycles
+        ["sweep_wait", name]              advance the time base by the swept wait name
+        ["loop_start", depth, count]      count is a number or the name of a swept loop count
+        ["loop_end", depth, cycles]       advance the time base by cycles, jump back to loop_start
+        ["sweep_reset", depth]            load the start value of the sweep of nesting level depth
+        ["sweep_step", depth]             step the value of the sweep of nesting level depth
+        ["read_live"]                     read the fields of the live pulses, at the start of every repetition
     """
 
 
-    def __init__(self, compiler, tokens_dict):
+    def __init__(self, compiler, ast_dict):
 
         self.compiler = compiler
-        # key: ch, value: tokens 
-        self.tokens_dict = tokens_dict
-        # dict to keep track of current pulse start time at each channel
-        # key: ch, value: start time of next pulse 
-        self.curr_times = {}
-        for ch in self.tokens_dict:
-            self.curr_times[ch] = 0
-        # dict that stores one generator for each channel
-        self.gen_dict = {}
-        # create next pulse generator for each channel
-        for ch, tokens in self.tokens_dict.items():
-            self.gen_dict[ch] = self.next_pulse(tokens)
+        # key: ch, value: parsed prog line (tuple of Pulse, Wait and Loop nodes)
+        self.ast_dict = ast_dict
+        # key: id of a loop body, value: (loop body, length of the loop body)
+        self._body_length_cache = {}
+        # ids of the loops that contain a swept wait or have a swept loop count
+        self._swept_loops = set()
+        # key: ch, value: list of Pulse, Wait and Loop nodes
+        self.items_dict = {}
+        for ch, nodes in self.ast_dict.items():
+            self.items_dict[ch] = self._build_items(nodes)
 
     
     def schedule_next(self):
         """
-        when called, gives the name of the next pulse,
-        time it is played, and the channel it is played on
-        this should update all channel timers 
-        returns the one with the smallest timer value
-        
-        loop:
-        calls next_pulse on each channel and save them to priority queue
-        advance timer on each channel
-        dequeue once and make asm
-        enqueue the next one
+        yields the asm events of the whole program, see the class docstring
+        """
+        num_sweeps = len(self.compiler._sweeps)
+        for depth, (_, _, _, count) in enumerate(self.compiler._sweeps):
+            yield ["sweep_reset", depth]
+            yield ["loop_start", depth, count]
+        if len(self.compiler.live_pulses) > 0:
+            yield ["read_live"]
+        remaining = yield from self._schedule_region(self.items_dict, depth=num_sweeps)
+        # the next sweep point starts at the end of the program
+        for depth in reversed(range(num_sweeps)):
+            yield ["sweep_step", depth]
+            yield ["loop_end", depth, remaining]
+            remaining = 0
+
+
+    def _build_items(self, nodes):
+        """
+        copy the parsed prog line into a list of items the scheduler can rearrange without 
+        touching the cached AST. loops with count 0 are dropped and loops with count 1 are inlined,
+        the names of swept waits become Wait items with the name as length. Waits of 0 clk cycles are
+        dropped, so a loop of only such waits is empty and dropped too
+        """
+        items = []
+        for node in nodes:
+            if isinstance(node, Loop):
+                loop_body = tuple(self._build_items(node.body))
+                if isinstance(node.count, str):
+                    sweep_range = self.compiler._sweep_var_range.get(node.count)
+                    if sweep_range is None:
+                        raise RuntimeError(f"Compilation Error: loop count '{node.count}' is not a number or a swept loop count")
+                    if sweep_range[0] < 1:
+                        raise RuntimeError(f"Compilation Error: swept loop count {node.count} must be at least 1")
+                    if len(loop_body) > 0:
+                        loop = Loop(node.count, loop_body, node.pos)
+                        self._swept_loops.add(id(loop))
+                        items.append(loop)
+                elif node.count == 1:
+                    items.extend(loop_body)
+                elif node.count > 1 and len(loop_body) > 0:
+                    loop = Loop(node.count, loop_body, node.pos)
+                    if any(self._is_swept(item) for item in loop_body):
+                        self._swept_loops.add(id(loop))
+                    items.append(loop)
+            elif isinstance(node, Pulse) and node.name in self.compiler.sweep_vars:
+                items.append(Wait(node.name, node.pos))
+            elif isinstance(node, Wait) and node.length == 0:
+                continue
+            else:
+                items.append(node)
+        return items
 
-        yields (ch, start_time, next_pulse_name)
-        
+
+    def _is_swept(self, item):
         """
-        q = PriorityQueue()
-        for ch, next_pulse_gen in self.gen_dict.items():
-            # enqueue the first token that's not a wait time, which is a pulse name
-            for token in next_pulse_gen:                
-                if token.isnumeric():    # if it's a number, it's a wait time
-                    self.curr_times[ch] += int(token)
-                else:    # if it's a pulse name
-                    q.put((self.curr_times[ch], (ch, token)))
-                    break        
-        while True:
-            # get the earliest pulse (q.get() returns (prio, item))
-            (ch, pulse_name) = q.get()[1]
-            # yield channel, start time, pulse name
-            yield [ch, self.curr_times[ch], pulse_name]
-            # update new pulse start time
-            self.curr_times[ch] += self.compiler.pulse_length_LUT[pulse_name]            
-
-            # on the current channel enqueue the first token that's not a wait time, which is a pulse name
-            for token in self.gen_dict[ch]:                
-                if token.isnumeric():    # if it's a number, it's a wait time
-                    self.curr_times[ch] += int(token)
-                else:    # if it's a pulse name
-                    q.put((self.curr_times[ch], (ch, token)))
-                    break
-            if q.empty():
-                break
+        True if the length of item changes while the program runs
+        """
+        if isinstance(item, Wait):
+            return isinstance(item.length, str)
+        return isinstance(item, Loop) and id(item) in self._swept_loops
+
 
-                    
-    def next_token(self, line_token_lst): 
+    def _duration(self, items):
         """
-        Helper function to convert a token list to a generator
+        length of a list of items in number of clk cycles
         """
-        for token in line_token_lst:
-            yield token
+        duration = 0
+        for item in items:
+            if isinstance(item, Wait):
+                duration += item.length
+            elif isinstance(item, Pulse):
+                duration += self.compiler.pulse_length_LUT[item.name]
+            else:
+                duration += item.count * self._body_length(item.body)
+        return duration
+
 
-    def next_pulse(self, tokens):
+    def _body_length(self, loop_body):
         """
-        Gives the next pulse for just one channel. Unwraps nested loops
-        uses yield instead of return so that the for loop can be continued
-        yields the string name of the pulse to be played or the wait time
+        cached length of a loop body
         """
-        tokens = iter(tokens)
+        cached = self._body_length_cache.get(id(loop_body))
+        if cached is None:
+            cached = (loop_body, self._duration(loop_body))
+            self._body_length_cache[id(loop_body)] = cached
+        return cached[1]
+
 
-        for t in tokens:
-            if t == "loop":
-                # make generator step next to get loop_count
-                loop_count = int(next(tokens))
-                # loop body should be a string rep of list
-                loop_body_tokens = self.compiler.tokenize(next(tokens))
-                # use yield instead of return so that for loop can be continued
-                for _ in range(loop_count):
-                    yield from self.next_pulse(loop_body_tokens)
+    def _timeline(self, items):
+        """
+        returns a list of (start_time, index, item) of all pulses and loops in items (not recursive)
+        and the total length of items
+        """
+        timeline = []
+        curr_time = 0
+        for i, item in enumerate(items):
+            if isinstance(item, Wait):
+                curr_time += item.length
+                continue
+            timeline.append((curr_time, i, item))
+            if isinstance(item, Pulse):
+                curr_time += self.compiler.pulse_length_LUT[item.name]
             else:
-                # handle pulse 
-                yield t
+                curr_time += item.count * self._body_length(item.body)
+        return timeline, curr_time
 
-        
+
+    def _loop_keys(self, timeline):
+        """
+        key of every loop of a timeline of _timeline: (start time, number of loops before it with the same
+        start time). A loop with a zero-length body starts at the same time as the item after it, so the
+        start time alone doesn't tell the loops apart. Loops of different channels with the same key run
+        together if they are aligned
+        """
+        keys = {}
+        prev = (None, 0)
+        for (start_time, i, item) in timeline:
+            if isinstance(item, Loop):
+                prev = (start_time, prev[1] + 1 if prev[0] == start_time else 0)
+                keys[i] = prev
+        return keys
+
+
+    def _align_loops(self, items_dict):
+        """
+        unroll every loop that can't share a tproc loop with the other channels until all 
+        remaining loops are aligned. Returns the new items_dict
+        """
+        items_dict = dict(items_dict)
+        while True:
+            timelines = {ch: self._timeline(items)[0] for ch, items in items_dict.items()}
+            start_times = {ch: [event[0] for event in timeline] for ch, timeline in timelines.items()}
+            loop_keys = {ch: self._loop_keys(timeline) for ch, timeline in timelines.items()}
+            # key: loop key (see _loop_keys), value: {ch: (loop_count, body_length)} of all loops with that key
+            loops = {}
+            for ch, timeline in timelines.items():
+                for (start_time, i, item) in timeline:
+                    if isinstance(item, Loop):
+                        loops.setdefault(loop_keys[ch][i], {})[ch] = (item.count, self._body_length(item.body))
+
+            # key: ch, value: list of index of the loops to unroll
+            to_unroll = {}
+            for ch, timeline in timelines.items():
+                for (start_time, i, item) in timeline:
+                    if not isinstance(item, Loop):
+                        continue
+                    group = loops[loop_keys[ch][i]]
+                    (loop_count, body_length) = group[ch]
+                    end_time = start_time + loop_count * body_length
+                    aligned = True
+                    for other_ch, times in start_times.items():
+                        if other_ch == ch:
+                            continue
+                        if other_ch in group:
+                            # the other channel must play exactly the same loop
+                            aligned = group[other_ch] == group[ch]
+                        else:
+                            # the other channel must be idle while the loop is running
+                            aligned = bisect.bisect_left(times, start_time) == bisect.bisect_left(times, end_time)
+                        if not aligned:
+                            break
+                    if not aligned:
+                        to_unroll.setdefault(ch, []).append(i)
+
+            if len(to_unroll) == 0:
+                return items_dict
+            for ch, indices in to_unroll.items():
+                items = items_dict[ch]
+                new_items = []
+                prev = 0
+                for i in indices:
+                    loop = items[i]
+                    new_items.extend(items[prev:i])
+                    new_items.extend(loop.body * loop.count)
+                    prev = i + 1
+                new_items.extend(items[prev:])
+                items_dict[ch] = new_items
+
+
+    def _split_at_sweeps(self, items_dict):
+        """
+        split the items of every channel at its swept waits and loops. Returns a list of
+        (segment, swept) where segment is an items_dict of the items before the swept wait or loop
+        and swept is {ch: swept wait or loop that follows the segment}. A channel ends in the 
+        segment after its last swept wait or loop, so it is only in the first segments
+        """
+        # key: ch, value: [(items, swept item or None)]
+        parts = {}
+        for ch, items in items_dict.items():
+            parts[ch] = []
+            segment = []
+            for item in items:
+                if self._is_swept(item):
+                    parts[ch].append((segment, item))
+                    segment = []
+                else:
+                    segment.append(item)
+            parts[ch].append((segment, None))
+        segments = []
+        for i in range(max((len(ch_parts) for ch_parts in parts.values()), default=1)):
+            segment = {}
+            swept = {}
+            for ch, ch_parts in parts.items():
+                if i < len(ch_parts):
+                    segment[ch] = ch_parts[i][0]
+                    if ch_parts[i][1] is not None:
+                        swept[ch] = ch_parts[i][1]
+            segments.append((segment, swept))
+        return segments
+
+
+    def _check_swept(self, segment, swept):
+        """
+        the swept waits or loops that follow segment must start at the same time and be the same wait
+        or loop (count) on every channel that has them, the other channels must be done before.
+        returns the start time
+        """
+        lengths = {ch: self._duration(items) for ch, items in segment.items()}
+        (first_ch, first) = next(iter(swept.items()))
+        name = first.length if isinstance(first, Wait) else f"loop({first.count}, ...)"
+        for ch, item in swept.items():
+            if lengths[ch] != lengths[first_ch]:
+                raise RuntimeError(f"Compilation Error: swept {name} must start at the same time on every channel "
+                                   f"that plays after it ({first_ch} at {lengths[first_ch]}, {ch} at {lengths[ch]})")
+            if type(item) != type(first) or (isinstance(item, Wait) and item.length != first.length) or \
+                    (isinstance(item, Loop) and item.count != first.count):
+                raise RuntimeError(f"Compilation Error: swept {name} of {first_ch} doesn't line up with {ch}")
+        for ch, length in lengths.items():
+            if ch not in swept and length > lengths[first_ch]:
+                raise RuntimeError(f"Compilation Error: {ch} plays during swept {name} of {first_ch}, "
+                                   f"add it to {ch} at {lengths[first_ch]} or end {ch} before")
+        return lengths[first_ch]
+
+
+    def _schedule_region(self, items_dict, depth):
+        """
+        schedule a region of the program in which all channels start at time 0 (program start
+        or start of a loop body). Yields asm events and returns the number of clk cycles from the 
+        time base at the end of the region to the end of the region
+        """
+        for (segment, swept) in self._split_at_sweeps(items_dict):
+            time_base = yield from self._schedule_segment(segment, depth)
+            if len(swept) == 0:
+                return max((self._duration(items) for items in segment.values()), default=0) - time_base
+            start_time = self._check_swept(segment, swept)
+            if start_time > time_base:
+                yield ["sync", start_time - time_base]
+            item = next(iter(swept.values()))
+            if isinstance(item, Wait):
+                yield ["sweep_wait", item.length]
+                continue
+            yield ["loop_start", depth, item.count]
+            remaining = yield from self._schedule_region({ch: loop.body for ch, loop in swept.items()}, depth + 1)
+            yield ["loop_end", depth, remaining]
+
+
+    def _schedule_segment(self, items_dict, depth):
+        """
+        schedule a part of the program without swept waits and loops, in which all channels start at time 0.
+        Yields asm events and returns the time base at the end of the segment
+        """
+        items_dict = self._align_loops(items_dict)
+        timelines = []
+        # key: loop key (see _loop_keys), value: {ch: loop}
+        loop_groups = {}
+        for ch, items in items_dict.items():
+            timeline = self._timeline(items)[0]
+            loop_keys = self._loop_keys(timeline)
+            timelines.append([(start_time, ch, item, loop_keys.get(i)) for (start_time, i, item) in timeline])
+            for (start_time, i, item) in timeline:
+                if isinstance(item, Loop):
+                    loop_groups.setdefault(loop_keys[i], {})[ch] = item
+
+        # time base of the segment, pulse start times are relative to it
+        time_base = 0
+        # merge the sorted timelines of all channels into one sorted stream
+        for (start_time, ch, item, loop_key) in heapq.merge(*timelines, key=lambda event: event[0]):
+            if isinstance(item, Pulse):
+                if start_time - time_base > Compiler.MAX_PULSE_TIME:
+                    # rebase so the start time fits into the time register
+                    yield ["sync", start_time - time_base]
+                    time_base = start_time
+                yield ["pulse", ch, start_time - time_base, item.name]
+                continue
+            
+            # all channels of the loop group are handled when the first of them comes up
+            group = loop_groups.pop(loop_key, None)
+            if group is None:
+                continue
+            body_length = self._body_length(item.body)
+            if start_time > time_base:
+                yield ["sync", start_time - time_base]
+            yield ["loop_start", depth, item.count]
+            remaining = yield from self._schedule_region({ch: loop.body for ch, loop in group.items()}, depth + 1)
+            yield ["loop_end", depth, remaining]
+            time_base = start_time + item.count * body_length
+        return time_base
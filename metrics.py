@@ -0,0 +1,147 @@
+import bisect
+import os
+import threading
+import time
+
+
+class Metrics():
+    """
+    counters, gauges and latency histograms of the server, cheap enough to be updated on every command.
+
+    Every metric is described once with describe, with its kind, a help text and the name of its label
+    if it has one (a metric has at most one label, e.g. the command):
+        counter      a total that only grows, inc
+        gauge        a value that goes up and down, inc with a negative value
+        histogram    durations in seconds counted in BUCKETS, observe
+        timer        seconds spent with every label value, switch changes the label (e.g. the time spent in every state)
+
+    snapshot returns all values as a JSON serializable dict, prometheus in the Prometheus text format
+    """
+
+    # upper bounds in seconds of the histogram buckets, the last bucket has no bound
+    BUCKETS = [1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30]
+
+
+    def __init__(self, prefix="awg"):
+        self.prefix = prefix    # of the metric names in the Prometheus text format
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        # key: name, value: (kind, help, label name or None)
+        self._descriptions = {}
+        # key: (name, label value or None), value: number, for histograms [bucket counts, sum, max]
+        self._values = {}
+        # key: name of a timer, value: (current label value, time.perf_counter() of the switch)
+        self._timers = {}
+
+
+    def describe(self, name, kind, help, label=None):
+        if kind not in ["counter", "gauge", "histogram", "timer"]:
+            raise RuntimeError(f"Unknown metric kind: {kind}")
+        self._descriptions[name] = (kind, help, label)
+
+
+    def inc(self, name, value=1, label=None):
+        key = (name, label)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+    def observe(self, name, seconds, label=None):
+        key = (name, label)
+        # buckets count the values <= their bound, like Prometheus
+        i = bisect.bisect_left(Metrics.BUCKETS, seconds)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [[0] * (len(Metrics.BUCKETS) + 1), 0.0, 0.0]
+            histogram[0][i] += 1
+            histogram[1] += seconds
+            if seconds > histogram[2]:
+                histogram[2] = seconds
+
+
+    def switch(self, name, label):
+        """
+        the timer name counts the time for label from now on
+        """
+        now = time.perf_counter()
+        with self._lock:
+            (old_label, since) = self._timers.get(name, (None, now))
+            if old_label is not None:
+                self._values[(name, old_label)] = self._values.get((name, old_label), 0.0) + now - since
+            self._timers[name] = (label, now)
+
+
+    def snapshot(self):
+        """
+        {"uptime": seconds, "buckets": BUCKETS, "metrics": {name: value}}, the value of a metric with a label is
+        {label value: value}. The value of a histogram is {"count", "sum", "max", "buckets": count of every bucket}
+        """
+        now = time.perf_counter()
+        with self._lock:
+            values = {key: ([list(value[0])] + value[1:] if isinstance(value, list) else value)
+                      for key, value in self._values.items()}
+            # the time since the last switch
+            for name, (label, since) in self._timers.items():
+                values[(name, label)] = values.get((name, label), 0.0) + now - since
+        metrics = {name: (0 if kind in ["counter", "gauge"] else {}) if label_name is None else {}
+                   for name, (kind, _, label_name) in self._descriptions.items()}
+        for (name, label), value in sorted(values.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            if isinstance(value, list):
+                value = {"count": sum(value[0]), "sum": value[1], "max": value[2], "buckets": value[0]}
+            if label is None:
+                metrics[name] = value
+            else:
+                metrics.setdefault(name, {})[label] = value
+        return {"uptime": time.time() - self.start_time, "buckets": list(Metrics.BUCKETS), "metrics": metrics}
+
+
+    def prometheus(self):
+        """
+        all metrics in the Prometheus text format, timers are counters of seconds
+        """
+        metrics = self.snapshot()["metrics"]
+        lines = [f"# HELP {self.prefix}_uptime_seconds seconds since the server started",
+                 f"# TYPE {self.prefix}_uptime_seconds gauge",
+                 f"{self.prefix}_uptime_seconds {time.time() - self.start_time}"]
+        for name, (kind, help, label_name) in self._descriptions.items():
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {'counter' if kind == 'timer' else kind}")
+            value = metrics[name]
+            if label_name is not None:
+                series = value.items()
+            else:
+                # a histogram without observations has no value
+                series = [(None, value)] if value != {} else []
+            for label, value in series:
+                labels = []
+                if label is not None:
+                    label = str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                    labels.append(f'{label_name}="{label}"')
+                if kind != "histogram":
+                    lines.append(f"{full_name}{self._labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(Metrics.BUCKETS + ["+Inf"], value["buckets"]):
+                    cumulative += count
+                    le = 'le="' + str(bound) + '"'
+                    lines.append(f"{full_name}_bucket{self._labels(labels + [le])} {cumulative}")
+                lines.append(f"{full_name}_sum{self._labels(labels)} {value['sum']}")
+                lines.append(f"{full_name}_count{self._labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+    def write_prometheus(self, path):
+        """
+        write the Prometheus text format to path, e.g. for the textfile collector of the node exporter.
+        The file is replaced at once, so a reader never sees half of it
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+    def _labels(self, labels):
+        return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
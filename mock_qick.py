@@ -0,0 +1,308 @@
+import time
+import numpy as np
+
+
+class MockTProc():
+    """
+    the data memory of the tproc, written by the host with single_write and read by the program with memri
+    """
+
+    DMEM_SIZE = 2**12    # words of 32 bits
+    WRITE_TIME = 2e-6    # estimated seconds of one single_write
+
+
+    def __init__(self, soc):
+        self.soc = soc
+        # key: address, value: 32 bit word
+        self.dmem = {}
+
+
+    def single_write(self, addr=0, data=0):
+        if not 0 <= addr < MockTProc.DMEM_SIZE:
+            raise RuntimeError(f"Data memory address {addr} is out of range")
+        self.dmem[addr] = data % 2**32
+        self.soc._spend(MockTProc.WRITE_TIME)
+
+
+    def single_read(self, addr=0):
+        return self.dmem.get(addr, 0)
+
+
+
+class MockSoc():
+    """
+    Software stand-in for QickSoc, so the server, the compiler and the benchmarks run without an FPGA.
+    It also serves as the soccfg (like QickSoc does).
+
+    It keeps the program and envelopes loaded by config_all and counts what a real board would
+    have to do. The costs are estimates of a ZCU111 and are only slept if realtime is True
+    """
+
+    # estimated costs of the hardware calls
+    INSTRUCTION_WRITE_TIME = 1e-6    # seconds to write one instruction into tproc program memory
+    ENVELOPE_WRITE_RATE = 200e6      # bytes per second written into the envelope memories
+    HARDWARE_CALL_TIME = 100e-6      # seconds of start_src, start_tproc and reset_gens
+
+    NUM_GENS = 8
+
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self._cfg = {
+            'gens': [{'samps_per_clk': 16, 'maxv': 32766, 'maxlen': 65536, 'f_dds': 6144.0,
+                      'b_dds': 32, 'f_fabric': 384.0} for _ in range(MockSoc.NUM_GENS)],
+            'tprocs': [{'pmem_size': 2**13, 'f_time': 384.0}],
+        }
+        # the program loaded by config_all
+        self.program = None
+        self.trig_mode = None
+        self.tproc_running = False
+        # counters of everything the board has done
+        self.instructions_written = 0
+        self.envelope_bytes_written = 0
+        self.config_count = 0
+        self.start_count = 0
+        self.busy_time = 0.0    # estimated time in seconds spent in hardware calls
+        self.tproc = MockTProc(self)
+
+
+    def __getitem__(self, key):
+        return self._cfg[key]
+
+
+    def _spend(self, seconds):
+        self.busy_time += seconds
+        if self.realtime:
+            time.sleep(seconds)
+
+
+    def load_program(self, program):
+        """
+        called by MockProgram.config_all
+        """
+        pmem_size = self._cfg['tprocs'][0]['pmem_size']
+        if len(program.prog_list) > pmem_size:
+            raise RuntimeError(f"Program of {len(program.prog_list)} instructions does not fit into tproc program memory ({pmem_size})")
+        envelope_bytes = 0
+        for ch_envelopes in program.envelopes:
+            for envelope in ch_envelopes.values():
+                # I and Q of every sample are int16
+                envelope_bytes += 4 * len(envelope['data'])
+        self.program = program
+        self.instructions_written += len(program.prog_list)
+        self.envelope_bytes_written += envelope_bytes
+        self.config_count += 1
+        self._spend(len(program.prog_list) * MockSoc.INSTRUCTION_WRITE_TIME + envelope_bytes / MockSoc.ENVELOPE_WRITE_RATE)
+
+
+    def start_src(self, src):
+        if src != "internal" and src != "external":
+            raise RuntimeError(f"Unknown trigger source: {src}")
+        self.trig_mode = src
+        self._spend(MockSoc.HARDWARE_CALL_TIME)
+
+
+    def start_tproc(self):
+        if self.program is None:
+            raise RuntimeError("No program loaded")
+        self.tproc_running = True
+        self.start_count += 1
+        self._spend(MockSoc.HARDWARE_CALL_TIME)
+
+
+    def stop_tproc(self):
+        self.tproc_running = False
+        self._spend(MockSoc.HARDWARE_CALL_TIME)
+
+
+    def reset_gens(self):
+        # like QickSoc, this loads a program that drives the generators with 0 into the tproc
+        self.program = None
+        self.tproc_running = False
+        self._spend(MockSoc.HARDWARE_CALL_TIME)
+
+
+
+class MockProgram():
+    """
+    Software stand-in for AWGProgram (QickProgram of tproc v1), implements the subset of the asm
+    the compiler uses. Instructions are recorded in prog_list like QickProgram does, run() executes
+    them and returns the pulses the generators would play
+    """
+
+    def __init__(self, soccfg, cfg=None):
+        self.soccfg = soccfg
+        self.cfg = cfg
+        self.prog_list = []
+        self.labels = {}
+        self._label_next = None
+        # envelopes of every generator. key: name, value: {"data": complex envelope, "addr": addr}
+        self.envelopes = [{} for _ in soccfg['gens']]
+        self._next_addr = [0 for _ in soccfg['gens']]
+        # key: ch, value: nyquist zone
+        self.gen_nqz = {}
+
+
+    def _add_instruction(self, name, args, comment=None):
+        if self._label_next is not None:
+            self.labels[self._label_next] = len(self.prog_list)
+            self._label_next = None
+        self.prog_list.append({'name': name, 'args': args, 'comment': comment})
+
+
+    def declare_gen(self, ch, nqz=1):
+        self.gen_nqz[int(ch)] = nqz
+
+
+    def freq2reg(self, f, gen_ch=0, ro_ch=None):
+        gen = self.soccfg['gens'][gen_ch]
+        return int(np.round(f / gen['f_dds'] * 2**gen['b_dds'])) % 2**gen['b_dds']
+
+
+    def deg2reg(self, deg, gen_ch=0):
+        return int(np.round(deg / 360 * 2**32)) % 2**32
+
+
+    def add_envelope(self, ch, name, idata=None, qdata=None):
+        gen = self.soccfg['gens'][ch]
+        length = len(idata) if idata is not None else len(qdata)
+        if length % gen['samps_per_clk'] != 0:
+            raise RuntimeError(f"Envelope length {length} is not a multiple of {gen['samps_per_clk']}")
+        if self._next_addr[ch] * gen['samps_per_clk'] + length > gen['maxlen']:
+            raise RuntimeError(f"Envelope memory of generator {ch} is full")
+        data = np.zeros(length, dtype=complex)
+        if idata is not None:
+            data += np.round(idata)
+        if qdata is not None:
+            data += 1j * np.round(qdata)
+        if np.max(np.abs(data.real)) > gen['maxv'] or np.max(np.abs(data.imag)) > gen['maxv']:
+            raise RuntimeError(f"Envelope {name} exceeds maxv = {gen['maxv']}")
+        # addr is in units of clk cycles (samps_per_clk samples)
+        self.envelopes[ch][name] = {"data": data, "addr": self._next_addr[ch]}
+        self._next_addr[ch] += length // gen['samps_per_clk']
+
+
+    def label(self, name):
+        if self._label_next is not None:
+            raise RuntimeError("label already defined for the next line")
+        self._label_next = name
+
+
+    def regwi(self, rp, reg, imm, comment=None):
+        self._add_instruction('regwi', (rp, reg, imm), comment)
+
+
+    def safe_regwi(self, rp, reg, imm, comment=None):
+        # immediate values can only be 30 bits, like QickProgram split larger values into 3 instructions
+        if abs(imm) < 2**30:
+            self.regwi(rp, reg, imm, comment)
+        else:
+            self.regwi(rp, reg, imm >> 2, comment)
+            self.bitwi(rp, reg, reg, '<<', 2)
+            if imm % 4 != 0:
+                self.mathi(rp, reg, reg, '+', imm % 4)
+
+
+    def bitwi(self, rp, rd, rs, op, imm, comment=None):
+        self._add_instruction('bitwi', (rp, rd, rs, op, imm), comment)
+
+
+    def mathi(self, rp, rd, rs, op, imm, comment=None):
+        self._add_instruction('mathi', (rp, rd, rs, op, imm), comment)
+
+
+    def set(self, ch, rp, rf, rph, ra, rg, rm, rt, comment=None):
+        self._add_instruction('set', (ch, rp, rf, rph, ra, rg, rm, rt), comment)
+
+
+    def memri(self, rp, reg, addr, comment=None):
+        self._add_instruction('memri', (rp, reg, addr), comment)
+
+
+    def synci(self, t, comment=None):
+        self._add_instruction('synci', (t,), comment)
+
+
+    def sync(self, rp, r, comment=None):
+        self._add_instruction('sync', (rp, r), comment)
+
+
+    def loopnz(self, rp, reg, label, comment=None):
+        self._add_instruction('loopnz', (rp, reg, label), comment)
+
+
+    def condj(self, rp, r1, op, r2, label, comment=None):
+        self._add_instruction('condj', (rp, r1, op, r2, label), comment)
+
+
+    def end(self, comment=None):
+        self._add_instruction('end', (), comment)
+
+
+    def asm(self):
+        lines = []
+        labels = {i: name for name, i in self.labels.items()}
+        for i, instruction in enumerate(self.prog_list):
+            label = f"{labels[i]}:" if i in labels else ""
+            args = ", ".join(str(arg) for arg in instruction['args'])
+            comment = f"    // {instruction['comment']}" if instruction['comment'] else ""
+            lines.append(f"{label:<12}{instruction['name']} {args};{comment}")
+        return "\n".join(lines)
+
+
+    def config_all(self, soc):
+        soc.load_program(self)
+
+
+    def run(self, max_instructions=10**8, dmem=None):
+        """
+        execute the program, returns a list of (ch, start time in clk cycles, {register values of the set})
+        registers have 32 bits like on the tproc, values are kept modulo 2**32
+        DMEM: the data memory of the tproc ({address: value}, see MockTProc), empty if None
+        """
+        if dmem is None:
+            dmem = {}
+        regs = {}
+        time_base = 0
+        pulses = []
+        pc = 0
+        for _ in range(max_instructions):
+            if pc >= len(self.prog_list):
+                return pulses
+            name = self.prog_list[pc]['name']
+            args = self.prog_list[pc]['args']
+            pc += 1
+            if name == 'regwi':
+                (rp, reg, imm) = args
+                regs[(rp, reg)] = imm % 2**32
+            elif name == 'bitwi' or name == 'mathi':
+                (rp, rd, rs, op, imm) = args
+                value = regs.get((rp, rs), 0)
+                regs[(rp, rd)] = {'<<': value << imm, '>>': value >> imm, '+': value + imm, '-': value - imm,
+                                  '*': value * imm, '&': value & imm, '|': value | imm}[op] % 2**32
+            elif name == 'memri':
+                (rp, reg, addr) = args
+                regs[(rp, reg)] = dmem.get(addr, 0) % 2**32
+            elif name == 'synci':
+                time_base += args[0]
+            elif name == 'sync':
+                (rp, r) = args
+                time_base += regs.get((rp, r), 0)
+            elif name == 'set':
+                (ch, rp, rf, rph, ra, rg, rm, rt) = args
+                values = {key: (regs.get((rp, r), 0) if r != 0 else 0) for key, r in
+                          [('freq', rf), ('phase', rph), ('addr', ra), ('gain', rg), ('mode', rm), ('time', rt)]}
+                pulses.append((ch, time_base + values['time'], values))
+            elif name == 'loopnz':
+                (rp, reg, label) = args
+                if regs.get((rp, reg), 0) != 0:
+                    regs[(rp, reg)] -= 1
+                    pc = self.labels[label]
+            elif name == 'condj':
+                (rp, r1, op, r2, label) = args
+                (v1, v2) = (regs.get((rp, r1), 0), regs.get((rp, r2), 0))
+                if {'<': v1 < v2, '>': v1 > v2, '==': v1 == v2, '!=': v1 != v2, '>=': v1 >= v2, '<=': v1 <= v2}[op]:
+                    pc = self.labels[label]
+            elif name == 'end':
+                return pulses
+        raise RuntimeError(f"Program did not end after {max_instructions} instructions")
@@ -0,0 +1,156 @@
+import functools
+
+
+class Pulse():
+    """
+    play the pulse called name
+    """
+    def __init__(self, name, pos):
+        self.name = name
+        self.pos = pos    # position of the node in the program line
+
+    def __repr__(self):
+        return f"Pulse({self.name!r})"
+
+
+class Wait():
+    """
+    wait for length clk cycles
+    """
+    def __init__(self, length, pos):
+        self.length = length
+        self.pos = pos
+
+    def __repr__(self):
+        return f"Wait({self.length})"
+
+
+class Loop():
+    """
+    play body (a tuple of nodes) count times, count is a number or the name of a swept loop count
+    """
+    def __init__(self, count, body, pos):
+        self.count = count
+        self.body = body
+        self.pos = pos
+
+    def __repr__(self):
+        return f"Loop({self.count}, {list(self.body)!r})"
+
+
+
+class Parser():
+    """
+    Single pass recursive descent parser for one line of prog_structure, e.g.
+    "[X_half, 200, loop(2, [X, 400, Y, 400]), X_half]"
+
+    grammar:
+        line := "[" [item ("," item)* [","]] "]"
+        item := loop | NUMBER | NAME
+        loop := "loop" "(" (NUMBER | NAME) "," line ")"
+
+    NUMBER is a wait time in clk cycles, NAME is the name of a pulse (any characters except
+    brackets, parentheses, commas and whitespace). A NAME can also be a swept wait time or loop count
+    declared in the sweeps of the program, the compiler tells them apart. A trailing comma before "]" is
+    allowed, like the old tokenizer did. The parser reads every 
+    character once, so parsing is linear in the length of the line regardless of nesting depth and loop counts
+    """
+
+    DELIMITERS = "[](),"
+
+
+    def __init__(self, prog_line):
+        self.prog_line = prog_line
+        self.pos = 0
+
+
+    def parse(self):
+        """
+        returns the program line as a tuple of Pulse, Wait and Loop nodes
+        """
+        nodes = self._parse_line()
+        self._skip_whitespace()
+        if self.pos != len(self.prog_line):
+            self._error("unexpected characters after the end of the program")
+        return nodes
+
+
+    def _error(self, msg):
+        raise RuntimeError(f"Compilation Error: {msg} at position {self.pos} of '{self.prog_line}'")
+
+
+    def _skip_whitespace(self):
+        while self.pos < len(self.prog_line) and self.prog_line[self.pos].isspace():
+            self.pos += 1
+
+
+    def _expect(self, c):
+        self._skip_whitespace()
+        if self.pos >= len(self.prog_line) or self.prog_line[self.pos] != c:
+            self._error(f"expected '{c}'")
+        self.pos += 1
+
+
+    def _peek(self):
+        self._skip_whitespace()
+        if self.pos >= len(self.prog_line):
+            return None
+        return self.prog_line[self.pos]
+
+
+    def _read_word(self):
+        self._skip_whitespace()
+        start = self.pos
+        while (self.pos < len(self.prog_line) and not self.prog_line[self.pos].isspace()
+               and self.prog_line[self.pos] not in Parser.DELIMITERS):
+            self.pos += 1
+        if start == self.pos:
+            self._error("expected a pulse name, a wait time or a loop")
+        return start, self.prog_line[start:self.pos]
+
+
+    def _parse_line(self):
+        self._expect("[")
+        nodes = []
+        if self._peek() == "]":
+            self.pos += 1
+            return tuple(nodes)
+        while True:
+            nodes.append(self._parse_item())
+            c = self._peek()
+            if c == ",":
+                self.pos += 1
+                if self._peek() == "]":
+                    self.pos += 1
+                    return tuple(nodes)
+            elif c == "]":
+                self.pos += 1
+                return tuple(nodes)
+            else:
+                self._error("expected ',' or ']'")
+
+
+    def _parse_item(self):
+        start, word = self._read_word()
+        if word == "loop" and self._peek() == "(":
+            self.pos += 1
+            _, count = self._read_word()
+            if count.isdecimal():
+                count = int(count)
+            self._expect(",")
+            body = self._parse_line()
+            self._expect(")")
+            return Loop(count, body, start)
+        if word.isdecimal():
+            return Wait(int(word), start)
+        return Pulse(word, start)
+
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_program_line(prog_line):
+    """
+    parse prog_line into a tuple of nodes. The result is cached per program line and shared
+    between compilations, so it must not be modified
+    """
+    return Parser(prog_line).parse()
@@ -1,8 +1,28 @@
 from FPGA_AWG import *
+import argparse
 
 
 
 
 if __name__ == '__main__':
-    awg = FPGA_AWG()
-    awg.run_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the FPGA AWG server")
+    parser.add_argument("--backend", choices=BACKENDS, default="qick",
+                        help="qick runs on the FPGA, mock is a software stand-in for testing without a board")
+    parser.add_argument("--root", default=None,
+                        help="directory to store waveform_cfg, envelope_data and program_cfg in (default: /home/xilinx/FPGA_AWG)")
+    parser.add_argument("--port", type=int, default=FPGA_AWG.port)
+    parser.add_argument("--buffer-size", type=int, default=FPGA_AWG.buffer_size,
+                        help="size in bytes of the buffer uploads are received into")
+    args = parser.parse_args()
+
+    if args.root is not None:
+        # the assets are read from these paths, the working directory doesn't matter
+        root = os.path.abspath(args.root)
+        FPGA_AWG.waveform_dir_path = os.path.join(root, "waveform_cfg")
+        FPGA_AWG.envelope_dir_path = os.path.join(root, "envelope_data")
+        FPGA_AWG.program_dir_path = os.path.join(root, "program_cfg")
+    FPGA_AWG.port = args.port
+    FPGA_AWG.buffer_size = args.buffer_size
+
+    awg = FPGA_AWG(backend=args.backend)
+    awg.run_server()
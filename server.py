@@ -1,14 +1,65 @@
 import socket
 import os 
 import struct
+import threading
+import time
+import json
+from metrics import *
 
 class Server():
     host = '0.0.0.0'
     port = 8080
-    buffer_size = 4096    
+    buffer_size = 2**20    # bytes received into one preallocated buffer at a time
     
     def __init__(self, ):
         self.is_running = False  
+        # requests of different connections are handled in different threads, the state of the
+        # request being handled is kept per thread
+        self._local = threading.local()
+        # key: conn, value: "text" or "json", see set_response_format
+        self._response_formats = {}
+        # counters and latency histograms, see GET_METRICS
+        self.metrics = Metrics()
+        self.metrics.describe("received_bytes_total", "counter", "bytes of the files received")
+        self.metrics.describe("files_received_total", "counter", "files received")
+        self.metrics.describe("sent_bytes_total", "counter", "bytes sent to the clients")
+        self.metrics.describe("errors_total", "counter", "commands answered with an error", label="error")
+
+
+    @property
+    def _request_id(self):
+        """
+        id of the request being processed, acks are tagged with it. None for requests without an id
+        """
+        return getattr(self._local, "request_id", None)
+
+    @_request_id.setter
+    def _request_id(self, request_id):
+        self._local.request_id = request_id
+
+
+    @property
+    def _request_start(self):
+        """
+        time.perf_counter() when the request being processed was received
+        """
+        return getattr(self._local, "request_start", None)
+
+    @_request_start.setter
+    def _request_start(self, t):
+        self._local.request_start = t
+
+
+    @property
+    def _batch_acks(self):
+        """
+        acks of the commands of a BATCH are collected here and sent as one combined ack
+        """
+        return getattr(self._local, "batch_acks", None)
+
+    @_batch_acks.setter
+    def _batch_acks(self, acks):
+        self._local.batch_acks = acks
     
 
     def shutdown_server(self):
@@ -30,14 +81,57 @@ class Server():
         print(f"Server listening on port {Server.port}...")
         
     
+    def _recv_into(self, conn, view):
+        """
+        fill the memoryview VIEW from conn, returns False if the client disconnected
+        """
+        while len(view) > 0:
+            n = conn.recv_into(view)
+            if n == 0:
+                return False
+            view = view[n:]
+        return True
+
+
+    def _recv_exact(self, conn, size):
+        """
+        Returns a bytearray of exactly size bytes, or None if the client disconnected
+        """
+        buf = bytearray(size)
+        if not self._recv_into(conn, memoryview(buf)):
+            return None
+        return buf
+
+
+    async def _async_recv_exact(self, loop, conn, size):
+        """
+        like _recv_exact for a non-blocking conn served by the asyncio event loop
+        """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        while len(view) > 0:
+            n = await loop.sock_recv_into(conn, view)
+            if n == 0:
+                return None
+            view = view[n:]
+        return buf
+
+
+    async def _async_receive_string(self, loop, conn):
+        buf = await self._async_recv_exact(loop, conn, 4)
+        if buf is None:
+            return None
+        buf = await self._async_recv_exact(loop, conn, struct.unpack('!I', buf)[0])
+        if buf is None:
+            return None
+        return buf.decode()
+
+
     def receive_int(self, conn):
         try:
-            buf = b''
-            while len(buf) < 4:  # Assuming the integer is 4 bytes long
-                data = conn.recv(4 - len(buf))
-                if not data:
-                    return None
-                buf += data
+            buf = self._recv_exact(conn, 4)  # Assuming the integer is 4 bytes long
+            if buf is None:
+                return None
             num = struct.unpack('!I', buf)[0]  # Network byte order (big-endian)
             return num
         except Exception as e:
@@ -51,12 +145,9 @@ class Server():
             if string_size is None:
                 return None
 
-            buf = b''
-            while len(buf) < string_size:
-                data = conn.recv(min(Server.buffer_size, string_size - len(buf)))
-                if not data:
-                    return None
-                buf += data
+            buf = self._recv_exact(conn, string_size)
+            if buf is None:
+                return None
             return buf.decode()
         except Exception as e:
             print(f"Error receiving string: {e}")
@@ -74,37 +165,65 @@ class Server():
             filename_size = self.receive_int(conn)
             if filename_size is None:
                 return None
-            filename = conn.recv(filename_size).decode()
+            filename = self._recv_exact(conn, filename_size)
             if not filename:
                 print("Filename not received.")
                 return None
 
-            filename = os.path.basename(filename)  # Convert abs path to just the file name
+            filename = os.path.basename(filename.decode())  # Convert abs path to just the file name
             if name != None:
                 dir_path = os.path.join(dir_path, name + file_type).replace('\\', '/')
             else:
                 # Ensure the directory path ends with a separator
                 dir_path = os.path.join(dir_path, filename).replace('\\', '/')
             # 'wb' mode ensures that an existing file will be overwritten by the newly sent file
+            # receive into one preallocated buffer and write it out whenever it is full
+            buf = memoryview(bytearray(min(self.buffer_size, file_size)))
             with open(dir_path, 'wb') as file:
                 remaining_size = file_size
                 while remaining_size > 0:
-                    data = conn.recv(min(Server.buffer_size, remaining_size))
-                    if not data:
+                    view = buf[:min(len(buf), remaining_size)]
+                    if not self._recv_into(conn, view):
                         print("Client disconnected during file transfer.")
                         return None
-                    file.write(data)
-                    remaining_size -= len(data)
+                    file.write(view)
+                    remaining_size -= len(view)
+            self.metrics.inc("files_received_total")
+            self.metrics.inc("received_bytes_total", file_size)
             return filename
         except Exception as e:
+            # the caller answers with a TransferError ack
             print(f"Error receiving file: {e}")
-            try:
-                conn.sendall("Failed to receive file.".encode())
-            except:
-                pass
             return None  
 
 
+    def discard_file(self, conn):
+        """
+        receive a file and throw it away, used when an upload is refused so the next request is read correctly
+        """
+        file_size = self.receive_int(conn)
+        filename_size = self.receive_int(conn)
+        if file_size is None or filename_size is None or self._recv_exact(conn, filename_size) is None:
+            return
+        buf = memoryview(bytearray(min(self.buffer_size, file_size)))
+        remaining_size = file_size
+        while remaining_size > 0:
+            view = buf[:min(len(buf), remaining_size)]
+            if not self._recv_into(conn, view):
+                return
+            remaining_size -= len(view)
+
+
+    def _parse_request(self, request):
+        """
+        a request is "COMMAND" or "#<id> COMMAND", returns (id, COMMAND), id is None if not given
+        """
+        if request.startswith("#"):
+            (request_id, _, command) = request[1:].partition(" ")
+            return (request_id, command)
+        return (None, request)
+
+
     def empty_recv_buffer(self, conn):
         """
         Used to empty socket buffer when there's an error
@@ -112,7 +231,7 @@ class Server():
         try:
             conn.settimeout(0.1)
             while True:
-                data = sock.recv(4096)
+                data = conn.recv(self.buffer_size)
                 if not data:
                     break
         except socket.timeout:
@@ -147,16 +266,71 @@ class Server():
             print("Client not connected.")
         
         try:
-            self._send_int(conn, self._utf8len(s))        # send the length of s in bytes
-            conn.sendall(s.encode())
+            data = s.encode()
+            # the length of s in bytes and s in one send
+            conn.sendall(struct.pack('!I', len(data)) + data)
+            self.metrics.inc("sent_bytes_total", 4 + len(data))
         except Exception as e:
             print(f"Error sending server acknowledgement: {e}")   
     
 
-    def _send_server_ack(self, conn, msg):
+    def _send_data(self, conn, data):
+        """
+        send bytes prefixed with their length, like _send_string
+        """
+        try:
+            conn.sendall(struct.pack('!I', len(data)))
+            conn.sendall(memoryview(data))
+            self.metrics.inc("sent_bytes_total", 4 + len(data))
+        except Exception as e:
+            print(f"Error sending data: {e}")
+
+
+    def set_response_format(self, conn):
+        """
+        "text": acks are "[Server acknowledgement]: msg" strings (the default)
+        "json": acks are JSON objects, see _send_server_ack
+        """
+        response_format = self.receive_string(conn)
+        if response_format not in ["text", "json"]:
+            msg = f"Response format can only be 'text' or 'json'."
+            self._send_server_ack(conn, msg, error="InvalidArgumentError")
+            return
+        self._response_formats[conn] = response_format
+        msg = f"Response format is set to {response_format}."
+        self._send_server_ack(conn, msg, payload={"format": response_format})
+
+
+    def _send_server_ack(self, conn, msg, payload=None, error=None):
+        """
+        MSG: human readable result of the command
+        PAYLOAD: machine readable result of the command, must be JSON serializable
+        ERROR: None if the command succeeded, otherwise the class of the error, e.g. "StateError"
+
+        clients that asked for JSON responses receive
+            {"id": request id or None, "status": "ok" or "error", "error": ERROR, "message": MSG,
+             "payload": PAYLOAD, "timing": {"server_time": seconds since the request was received}}
+        """
         try:
             s = f"[Server acknowledgement]: {msg}"
             print(s)
+            if error is not None:
+                self.metrics.inc("errors_total", label=error)
+            request_id = self._request_id
+            if request_id is not None and request_id.isdecimal():
+                request_id = int(request_id)
+            response = {"id": request_id, "status": "ok" if error is None else "error", "error": error,
+                        "message": msg, "payload": payload}
+            if self._batch_acks is not None:
+                self._batch_acks.append(response)
+                return
+            if self._response_formats.get(conn) == "json":
+                if self._request_start is not None:
+                    response["timing"] = {"server_time": time.perf_counter() - self._request_start}
+                self._send_string(conn, json.dumps(response, separators=(",", ":")))
+                return
+            if self._request_id is not None:
+                s = f"#{self._request_id} {s}"
             self._send_string(conn, s)
         except Exception as e:
             print(f"Error sending server acknowledgement: {e}")
@@ -0,0 +1,213 @@
+import numpy as np
+
+
+class WaveformSimulator():
+    """
+    renders the samples the DACs would output for a compiled program, to check a program offline without a scope.
+
+    The pulses are (ch, start time in clk cycles, {register values of the set}) like MockProgram.run returns
+    them, from_compiler makes them from the timeline of a Compiler instead. Every pulse is played like the
+    signal generator does:
+        - the DDS phase accumulator runs with the freq of the last pulse of the channel (0 before the first
+          pulse) and is set to 0 at the start of a pulse with phrst
+        - the phase register is added to the accumulator
+        - outsel "product": gain / maxv * envelope * DDS, "dds": gain * DDS, "input": gain / maxv * real part
+          of the envelope, "zero": 0
+        - a periodic pulse repeats until the next pulse of the channel starts
+        - after a oneshot pulse the output is 0, with stdysel "last" it stays at the last sample of the pulse
+        - a pulse that starts before the previous pulse of the channel ended waits for it
+    The samples are computed with NumPy in chunks (see render), so long programs render in bounded memory.
+    The DAC outputs the real part of the complex samples
+    """
+
+    CHUNK = 2**16    # default number of clk cycles rendered at once
+
+
+    def __init__(self, prog, pulses=None, dmem=None):
+        """
+        PROG: the compiled program (MockProgram), its soccfg and envelope memories are used
+        PULSES: [(ch, start in clk cycles, {"freq", "phase", "addr", "gain", "mode"})], prog.run(dmem=dmem) if None
+        """
+        self.prog = prog
+        # key: ch, value: dict of the arrays of the pulses of the channel, see _add_channel
+        self.channels = {}
+        if pulses is None:
+            pulses = prog.run(dmem=dmem)
+        rows = {}
+        for (ch, t, regs) in pulses:
+            rows.setdefault(ch, []).append((t, regs["freq"], regs["phase"], regs["addr"], regs["gain"], regs["mode"]))
+        for ch, ch_rows in rows.items():
+            self._add_channel(ch, *np.array(ch_rows, dtype=np.int64).T)
+
+
+    @classmethod
+    def from_compiler(cls, compiler):
+        """
+        the simulator of the program compiled by compiler. The pulses are taken from its timeline and register
+        blocks, which is much faster than running the program. Programs with swept or live pulses are run
+        (with the initial data memory), their registers change while the program runs
+        """
+        prog = compiler.awg_prog
+        if compiler.swept_pulses or compiler.live_pulses:
+            return cls(prog, dmem=compiler.live_table)
+        (table, info) = compiler.timeline()
+        # registers of every pulse id, the envelope addr differs between channels
+        values = np.zeros((len(info["pulses"]), 4), dtype=np.int64)
+        addrs = np.zeros((len(info["pulses"]), len(prog.soccfg['gens'])), dtype=np.int64)
+        for i, pulse_name in enumerate(info["pulses"]):
+            block_key = compiler.block_key_LUT[pulse_name]
+            values[i] = [compiler._block_value(block_key, offset) for offset in
+                         [compiler.FREQ_REG, compiler.PHASE_REG, compiler.GAIN_REG, compiler.MC_REG]]
+            for ch, addr in compiler.addr_LUT.get(pulse_name, {}).items():
+                addrs[i, ch] = addr
+        sim = cls(prog, pulses=[])
+        for ch in np.unique(table["ch"]):
+            rows = table[table["ch"] == ch]
+            (freq, phase, gain, mc) = values[rows["pulse"]].T
+            sim._add_channel(int(ch), rows["start"], freq, phase, addrs[rows["pulse"], ch], gain, mc)
+        return sim
+
+
+    def _add_channel(self, ch, start, freq, phase, addr, gain, mc):
+        """
+        the pulses of channel ch, every argument is an array with one value per pulse, start in clk cycles
+        """
+        gen = self.prog.soccfg['gens'][ch]
+        spc = gen['samps_per_clk']
+        order = np.argsort(start, kind="stable")
+        (start, freq, phase, addr, gain, mc) = (np.asarray(a, dtype=np.int64)[order] for a in (start, freq, phase, addr, gain, mc))
+        # negative gains are kept modulo 2**32 in the registers
+        gain = np.where(gain >= 2**31, gain - 2**32, gain)
+        # see Compiler._get_mode_code
+        code = mc >> 16
+        length = (mc & 0xffff) * spc
+        periodic = (code & 0b00100) != 0
+        # positions in samples from the start of the program
+        start = start * spc
+        end = start + length
+        if np.any((start[1:] < end[:-1]) & ~periodic[:-1]):
+            # the generator plays the pulses one after the other
+            for k in range(1, len(start)):
+                if not periodic[k - 1] and start[k] < end[k - 1]:
+                    start[k] = end[k - 1]
+                    end[k] = start[k] + length[k]
+
+        # phase accumulator at the start of every pulse. The uint64 sums wrap at 2**64, a multiple of 2**b_dds
+        freq = freq.astype(np.uint64)
+        steps = np.zeros(len(start), dtype=np.uint64)
+        steps[1:] = freq[:-1] * (np.diff(start) & 0xffffffff).astype(np.uint64)
+        acc = np.cumsum(steps, dtype=np.uint64)
+        last_reset = np.maximum.accumulate(np.where((code & 0b10000) != 0, np.arange(len(start)), 0))
+        acc = (acc - acc[last_reset]) & np.uint64(2**gen['b_dds'] - 1)
+        outsel = code & 0b11
+        # the DDS phase at the start of every pulse, "input" and "zero" don't use the DDS
+        rotation = np.where(outsel <= 1, np.exp(2j * np.pi * (acc / 2**gen['b_dds'] + phase / 2**32)), 1)
+
+        # the envelope memory of the generator, addr is in clk cycles
+        memory = np.zeros(gen['maxlen'], dtype=complex)
+        for envelope in self.prog.envelopes[ch].values():
+            memory[envelope['addr'] * spc:envelope['addr'] * spc + len(envelope['data'])] = envelope['data']
+
+        # pulses with the same registers (but phase) have the same samples up to the rotation, these are
+        # computed once for every shape and stored one after the other in templates
+        length = np.maximum(length, 1)
+        columns = np.stack([freq.astype(np.int64), gain, addr * spc, outsel, length], axis=1)
+        # np.unique(axis=0) is slow, the shapes are numbered in lexsort order instead
+        order = np.lexsort(columns.T)
+        new_shape = np.ones(len(order), dtype=bool)
+        new_shape[1:] = np.any(columns[order[1:]] != columns[order[:-1]], axis=1)
+        shapes = columns[order[new_shape]]
+        shape = np.empty(len(order), dtype=np.int64)
+        shape[order] = np.cumsum(new_shape) - 1
+        offsets = np.cumsum(shapes[:, 4]) - shapes[:, 4]
+        rel = np.arange(shapes[:, 4].sum(), dtype=np.int64) - np.repeat(offsets, shapes[:, 4])
+        (s_freq, s_gain, s_addr, s_outsel, _) = (np.repeat(column, shapes[:, 4]) for column in shapes.T)
+        templates = self._pulse_samples(gen, memory, s_freq.astype(np.uint64), s_gain, s_addr, s_outsel, rel, rel)
+
+        # every pulse outputs samples from its start to its end, or to the start of the next pulse if it is
+        # periodic or holds its last sample, the output is 0 outside of these regions
+        holds = periodic | ((code & 0b01000) == 0)
+        stop = np.where(holds, np.append(start[1:], np.iinfo(np.int64).max), end)
+
+        self.channels[ch] = {"start": start, "stop": stop, "end": end, "length": length, "rotation": rotation,
+                             "offset": offsets[shape], "templates": templates, "periodic": periodic, "memory": memory,
+                             "freq": freq, "gain": gain, "addr": addr * spc, "outsel": outsel}
+
+
+    def end(self, ch):
+        """
+        clk cycle at which the last pulse of channel ch ends, 0 if it plays no pulse
+        """
+        c = self.channels.get(ch)
+        if c is None or len(c["end"]) == 0:
+            return 0
+        return int(-(-c["end"].max() // self.prog.soccfg['gens'][ch]['samps_per_clk']))
+
+
+    def render(self, ch, start=0, stop=None, chunk=CHUNK, iq=False):
+        """
+        generator of the samples of channel ch from clk cycle start to stop (the end of its last pulse if None),
+        in arrays of at most chunk clk cycles. The samples are the real DAC output, complex I + jQ with iq=True
+        """
+        spc = self.prog.soccfg['gens'][ch]['samps_per_clk']
+        if stop is None:
+            stop = self.end(ch)
+        for a in range(start * spc, stop * spc, chunk * spc):
+            samples = self._samples(ch, a, min(a + chunk * spc, stop * spc))
+            yield samples if iq else samples.real
+
+
+    def waveform(self, ch, start=0, stop=None, iq=False):
+        """
+        all samples of channel ch from clk cycle start to stop as one array, see render
+        """
+        chunks = list(self.render(ch, start, stop, iq=iq))
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=complex if iq else float)
+        return np.concatenate(chunks)
+
+
+    def _samples(self, ch, a, b):
+        """
+        complex samples a to b (in samples from the start of the program) of channel ch
+        """
+        gen = self.prog.soccfg['gens'][ch]
+        c = self.channels.get(ch)
+        out = np.zeros(b - a, dtype=complex)
+        if c is None:
+            return out
+        # the pulses that output samples between a and b, their regions don't overlap
+        first = np.searchsorted(c["stop"], a, side="right")
+        last = np.searchsorted(c["start"], b, side="left")
+        if first >= last:
+            return out
+        k = np.arange(first, last)
+        lo = np.maximum(c["start"][k], a)
+        counts = np.minimum(c["stop"][k], b) - lo
+        # the sample numbers of all regions and the pulse of every sample
+        offsets = np.cumsum(counts) - counts
+        k = np.repeat(k, counts)
+        n = np.arange(len(k), dtype=np.int64) + np.repeat(lo - offsets, counts)
+        rel = n - c["start"][k]
+        length = c["length"][k]
+        # after a oneshot pulse its last sample is held
+        samples = c["templates"][c["offset"][k] + np.minimum(rel, length - 1)]
+        periodic = c["periodic"][k]
+        if np.any(periodic):
+            # the envelope repeats, the DDS runs on
+            (pk, prel) = (k[periodic], rel[periodic])
+            samples[periodic] = self._pulse_samples(gen, c["memory"], c["freq"][pk], c["gain"][pk], c["addr"][pk],
+                                                    c["outsel"][pk], prel, prel % length[periodic])
+        out[n - a] = samples * c["rotation"][k]
+        return out
+
+
+    def _pulse_samples(self, gen, memory, freq, gain, addr, outsel, rel, env_rel):
+        """
+        samples of pulses that start with the DDS phase 0, one value per sample of every argument
+        REL: sample since the start of the pulse, ENV_REL: sample of the envelope
+        """
+        dds = np.exp(2j * np.pi * ((freq * (rel & 0xffffffff).astype(np.uint64)) & np.uint64(2**gen['b_dds'] - 1)) / 2**gen['b_dds'])
+        envelope = memory[np.where((outsel == 0) | (outsel == 2), addr + env_rel, 0)]
+        samples = np.select([outsel == 0, outsel == 1, outsel == 2], [envelope * dds, gen['maxv'] * dds, envelope.real + 0j], 0j)
+        return gain / gen['maxv'] * samples
@@ -0,0 +1,86 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from asset_registry import *
+from compile_cache import *
+
+
+@pytest.fixture
+def assets(tmp_path):
+    dir_paths = {kind: str(tmp_path / kind) for kind in ["program", "waveform", "envelope"]}
+    for path in dir_paths.values():
+        os.makedirs(path)
+    assets = AssetRegistry(dir_paths)
+    for name in ["X", "Y"]:
+        write_waveform(assets, name, 100)
+    np.save(f"{dir_paths['envelope']}/E.npy", np.zeros(16, dtype=np.int16))
+    assets.add("envelope", "E")
+    for name in ["A", "B", "C"]:
+        with open(f"{dir_paths['program']}/{name}.json", "w") as file:
+            json.dump({"prog_structure": {"ch6": "[X]"}}, file)
+        assets.add("program", name)
+    return assets
+
+
+def write_waveform(assets, name, freq):
+    with open(f"{assets.dir_paths['waveform']}/{name}.json", "w") as file:
+        json.dump({"style": "const", "freq": freq, "gain": 1000, "phase": 0, "length": 10}, file)
+    assets.add("waveform", name)
+
+
+def test_get_and_put(assets):
+    cache = CompileCache(assets)
+    assert cache.get("A") is None
+    cache.put("A", "compiled A", {("waveform", "X")}, 10)
+    assert cache.get("A") == "compiled A"
+    assert (cache.hits, cache.misses, cache.total_bytes) == (1, 1, 10)
+    # a new compilation replaces the entry
+    cache.put("A", "compiled A again", {("waveform", "X")}, 20)
+    assert cache.get("A") == "compiled A again" and cache.total_bytes == 20
+
+    # a file with new content misses even if nobody invalidated the entry
+    write_waveform(assets, "X", 200)
+    assert cache.get("A") is None and cache.total_bytes == 0
+    cache.put("A", "compiled A", {("waveform", "X")}, 10)
+    os.remove(assets.path("waveform", "X"))
+    assets.remove("waveform", "X")
+    assert cache.get("A") is None
+
+
+def test_invalidate_drops_only_the_dependents(assets):
+    cache = CompileCache(assets)
+    cache.put("A", "compiled A", {("waveform", "X"), ("envelope", "E")}, 10)
+    cache.put("B", "compiled B", {("waveform", "X"), ("waveform", "Y")}, 10)
+    cache.put("C", "compiled C", {("waveform", "Y")}, 10)
+    cache.invalidate("envelope", "E")
+    assert [cache.get(name) for name in "ABC"] == [None, "compiled B", "compiled C"]
+    cache.invalidate("waveform", "X")
+    assert [cache.get(name) for name in "ABC"] == [None, None, "compiled C"]
+    assert cache.total_bytes == 10
+    # a file nobody uses
+    cache.invalidate("waveform", "Z")
+    assert cache.get("C") == "compiled C"
+
+
+def test_least_recently_used_are_evicted(assets):
+    cache = CompileCache(assets, max_entries=2)
+    cache.put("A", "compiled A", set(), 10)
+    cache.put("B", "compiled B", set(), 10)
+    # A is used, so B is the least recently used now
+    cache.get("A")
+    cache.put("C", "compiled C", set(), 10)
+    assert [cache.get(name) for name in "ABC"] == ["compiled A", None, "compiled C"]
+
+    cache = CompileCache(assets, max_bytes=100)
+    cache.put("A", "compiled A", set(), 60)
+    cache.put("B", "compiled B", set(), 30)
+    cache.put("C", "compiled C", set(), 20)
+    assert [cache.get(name) for name in "ABC"] == [None, "compiled B", "compiled C"]
+    assert cache.total_bytes == 50
+    # an entry larger than max_bytes is kept alone
+    cache.put("A", "compiled A", set(), 200)
+    assert [cache.get(name) for name in "ABC"] == ["compiled A", None, None]
+    assert cache.total_bytes == 200
@@ -0,0 +1,366 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from compiler import *
+from mock_qick import *
+from prog_parser import *
+from simulator import *
+
+
+def time_values(p):
+    return [ins['args'][2] for ins in p.prog_list if ins['name'] == "regwi" and ins['args'][1] == Compiler.TIME_REG]
+
+
+def start_times(p):
+    return sorted((ch, t) for (ch, t, regs) in p.run())
+
+
+def count(p, name):
+    return len([ins for ins in p.prog_list if ins['name'] == name])
+
+
+@pytest.fixture
+def compile_program(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("program_cfg")
+    os.makedirs("waveform_cfg")
+    for name, length in [("X", 10), ("Y", 20)]:
+        with open(f"waveform_cfg/{name}.json", "w") as file:
+            json.dump({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": length}, file)
+
+    def compile_program(prog_structure):
+        with open("program_cfg/test.json", "w") as file:
+            json.dump({"prog_structure": prog_structure}, file)
+        p = MockProgram(MockSoc())
+        Compiler(p).compile("test")
+        return p
+    return compile_program
+
+
+def test_long_waits_are_rebased(compile_program):
+    p = compile_program({"ch6": "[X, 100000, Y, 3000000, X]", "ch7": "[70000, Y]"})
+    assert max(time_values(p)) <= Compiler.MAX_PULSE_TIME
+    # the 200 cycles are the synci after loading the registers
+    assert start_times(p) == [(6, 200), (6, 200 + 100010), (6, 200 + 3100030), (7, 200 + 70000)]
+
+
+def test_loop_times_do_not_grow(compile_program):
+    p = compile_program({"ch6": "[X, loop(1000, [Y, 50000, X, 100])]"})
+    assert max(time_values(p)) <= Compiler.MAX_PULSE_TIME
+    # the loop body is emitted once
+    assert count(p, "set") == 3
+    pulses = start_times(p)
+    assert len(pulses) == 1 + 2 * 1000
+    assert pulses[-1] == (6, 200 + 10 + 999 * 50130 + 50020)
+
+
+def test_aligned_loops_share_one_loop(compile_program):
+    p = compile_program({"ch6": "[loop(10, [X, 10])]", "ch7": "[loop(10, [Y])]"})
+    assert count(p, "loopnz") == 1
+    assert start_times(p) == sorted([(6, 200 + 20 * i) for i in range(10)] + [(7, 200 + 20 * i) for i in range(10)])
+
+
+def test_misaligned_loops_are_unrolled(compile_program):
+    p = compile_program({"ch6": "[loop(10, [X, 10])]", "ch7": "[5, loop(3, [Y])]"})
+    assert start_times(p) == sorted([(6, 200 + 20 * i) for i in range(10)] + [(7, 205 + 20 * i) for i in range(3)])
+
+
+def expand(nodes, lengths, t=0):
+    """
+    (ch-less) start times and names of the pulses of a parsed program line, every loop unrolled
+    """
+    pulses = []
+    for node in nodes:
+        if isinstance(node, Loop):
+            for _ in range(node.count):
+                (body_pulses, t) = expand(node.body, lengths, t)
+                pulses += body_pulses
+        elif isinstance(node, Wait):
+            t += node.length
+        else:
+            pulses.append((t, node.name))
+            t += lengths[node.name]
+    return (pulses, t)
+
+
+def test_nested_loops_are_not_unrolled(compile_program):
+    p = compile_program({"ch6": "[X, loop(3, [Y, loop(4, [X, 5]), 10])]", "ch7": "[X, loop(3, [Y, 60, 10])]"})
+    assert count(p, "loopnz") == 2
+    assert count(p, "set") == 5
+    assert len(start_times(p)) == 2 + 3 * (2 + 4)
+
+
+def test_loops_match_a_naive_expansion(compile_program):
+    for prog_structure in [{"ch6": "[X, loop(3, [Y, loop(4, [X, 5]), 10]), Y]", "ch7": "[X, loop(3, [Y, 70, 10]), Y]"},
+                           {"ch6": "[loop(10, [X, 10])]", "ch7": "[5, loop(3, [Y])]"},
+                           {"ch6": "[loop(2, [loop(3, [X]), Y])]", "ch7": "[loop(2, [Y, loop(3, [X])])]"},
+                           {"ch6": "[loop(0, [X]), loop(1, [Y, 3]), loop(2, [X, loop(2, [5])])]"},
+                           {"ch6": "[loop(2, [0]), loop(3, [X])]", "ch7": "[loop(2, [loop(4, [0])]), loop(3, [X])]"}]:
+        p = compile_program(prog_structure)
+        expected = []
+        for ch, prog_line in prog_structure.items():
+            (pulses, _) = expand(parse_program_line(prog_line), {"X": 10, "Y": 20})
+            expected += [(int(ch[2:]), 200 + t) for (t, name) in pulses]
+        assert start_times(p) == sorted(expected), prog_structure
+
+
+def test_zero_length_loop_before_a_loop(compile_program):
+    p = compile_program({"ch6": "[loop(2, [0]), loop(3, [X])]"})
+    assert start_times(p) == [(6, 200), (6, 210), (6, 220)]
+    assert count(p, "loopnz") == 1 and count(p, "set") == 1
+
+
+def test_npy_and_csv_envelopes_match(compile_program):
+    os.makedirs("envelope_data")
+    data = np.round(1000 * np.sin(np.pi * np.arange(48) / 48)).astype(np.int16)
+    np.save("envelope_data/env_npy.npy", data)
+    np.savetxt("envelope_data/env_csv.csv", data, fmt="%d")
+    for name in ["npy", "csv"]:
+        with open(f"waveform_cfg/A_{name}.json", "w") as file:
+            json.dump({"style": "arb", "freq": 100, "gain": 1000, "phase": 0, "length": 3,
+                       "i_data_name": f"env_{name}", "q_data_name": f"env_{name}"}, file)
+    p = compile_program({"ch6": "[A_npy, 10, A_csv]"})
+    # identical data, so the second pulse shares the envelope of the first
+    assert len(p.envelopes[6]) == 1
+    (envelope,) = p.envelopes[6].values()
+    assert np.array_equal(envelope["data"], data + 1j * data)
+
+
+def test_envelopes_are_loaded_once_per_channel(compile_program):
+    os.makedirs("envelope_data")
+    sine = np.round(1000 * np.sin(np.pi * np.arange(48) / 48)).astype(np.int16)
+    for name, data in [("env_a", sine), ("env_b", sine), ("env_c", np.full(48, 500, dtype=np.int16))]:
+        np.save(f"envelope_data/{name}.npy", data)
+    for name, env in [("A", "env_a"), ("B", "env_b"), ("C", "env_c")]:
+        with open(f"waveform_cfg/{name}.json", "w") as file:
+            json.dump({"style": "arb", "freq": 100, "gain": 1000, "phase": 0, "length": 3,
+                       "i_data_name": env, "q_data_name": env}, file)
+    p = MockProgram(MockSoc())
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": {"ch5": "[X]", "ch6": "[A, 10, B]", "ch7": "[C, 10, A]"}}, file)
+    compiler = Compiler(p)
+    compiler.compile("test")
+    # B has the same data as A, so A and B play one copy. No channel has envelopes it doesn't play
+    loaded = {ch: sorted(envelopes) for ch, envelopes in enumerate(p.envelopes) if len(envelopes) > 0}
+    assert loaded in [{6: ["A"], 7: ["A", "C"]}, {6: ["B"], 7: ["A", "C"]}]
+    addrs = {(ch, t): regs["addr"] for (ch, t, regs) in p.run()}
+    assert addrs[(6, 213)] == addrs[(6, 200)] == p.envelopes[6][loaded[6][0]]["addr"]
+    assert addrs[(7, 213)] == p.envelopes[7]["A"]["addr"] != addrs[(7, 200)]
+    # 48 samples of I and Q as int16 each, B on ch6 is saved
+    assert (compiler.envelope_bytes, compiler.envelope_bytes_saved) == (3 * 4 * 48, 4 * 48)
+    envelope_memory = compiler.compile_report()["envelope_memory"]
+    assert envelope_memory["envelope_bytes_saved"] > 0
+    assert envelope_memory["envelope_bytes"] == compiler.envelope_bytes
+
+
+def test_identical_pulses_share_a_register_block(compile_program):
+    with open("waveform_cfg/X2.json", "w") as file:
+        json.dump({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}, file)
+    p = MockProgram(MockSoc())
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": {"ch5": "[X]", "ch6": "[X, 10, X2]", "ch7": "[5, X]"}}, file)
+    compiler = Compiler(p)
+    compiler.compile("test")
+    registers = compiler.compile_report()["registers"]
+    # 4 registers of the block and the time register
+    assert (registers["register_blocks"], registers["used"], registers["pages"]) == (1, 5, {1: 5})
+    assert count(p, "regwi") - len(time_values(p)) == 4
+
+
+def test_register_blocks_are_packed_first_fit(compile_program):
+    os.makedirs("envelope_data")
+    np.save("envelope_data/env.npy", np.full(48, 100, dtype=np.int16))
+    # the most used blocks are placed first: 4 const blocks of 4 registers, 3 arb blocks of 5 and a const block
+    names = ["C1", "C2", "C3", "C4", "A1", "A2", "A3", "C5"]
+    for i, name in enumerate(names):
+        cfg = {"style": "const", "freq": 100 + i, "gain": 1000, "phase": 0, "length": 10}
+        if name.startswith("A"):
+            cfg.update(style="arb", length=3, i_data_name="env")
+        with open(f"waveform_cfg/{name}.json", "w") as file:
+            json.dump(cfg, file)
+    p = MockProgram(MockSoc())
+    prog_line = "[" + ", ".join(f"loop({9 - i}, [{name}])" for i, name in enumerate(names[:-1])) + ", C5]"
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": {"ch6": prog_line}}, file)
+    compiler = Compiler(p)
+    compiler.compile("test")
+    # page 1 has the registers 1 to 30: A3 doesn't fit after 4 * 4 + 2 * 5 of them, but C5 does
+    assert compiler.page_LUT == {"C1": 1, "C2": 1, "C3": 1, "C4": 1, "A1": 1, "A2": 1, "A3": 2, "C5": 1}
+    assert compiler.compile_report()["registers"]["pages"] == {1: 31, 2: 6}
+    assert compiler.compile_report()["registers"]["used"] == 37
+    played = [regs["freq"] for (ch, t, regs) in sorted(p.run(), key=lambda pulse: pulse[1])]
+    assert played == [p.freq2reg(100 + i) for i in range(len(names)) for _ in range(9 - i if i < 7 else 1)]
+
+
+def test_spilled_register_blocks(compile_program):
+    # 60 blocks of 4 registers, 7 fit on a page. Only 6 pages are left for them with the swap page
+    cfgs = {f"P{i}": {"style": "const", "freq": 100 + i, "gain": 100 + i, "phase": 0, "length": 10 + i % 5} for i in range(60)}
+    for name, cfg in cfgs.items():
+        with open(f"waveform_cfg/{name}.json", "w") as file:
+            json.dump(cfg, file)
+    line = lambda first: ", ".join(f"P{i}, 5" for i in range(first, first + 20))
+    # the loops on ch5 and ch6 are aligned, ch4 plays after them and reuses pulses of the loops
+    prog_structure = {"ch4": f"[1020, {line(0)}, P20, loop(4, [P45, P0, 3])]",
+                      "ch5": f"[loop(3, [{line(20)}])]",
+                      "ch6": f"[loop(3, [{line(40)}])]"}
+    p = MockProgram(MockSoc())
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": prog_structure}, file)
+    compiler = Compiler(p)
+    compiler.compile("test")
+    registers = compiler.compile_report()["registers"]
+    assert (registers["register_blocks"], registers["spilled_blocks"]) == (60, 60 - 6 * 7)
+    assert registers["reload_instructions"] == compiler.reload_instructions > 0
+    assert count(p, "loopnz") == 2
+
+    expected = []
+    for ch, prog_line in prog_structure.items():
+        (pulses, _) = expand(parse_program_line(prog_line), {name: cfg["length"] for name, cfg in cfgs.items()})
+        expected += [(int(ch[2:]), 200 + t, name) for (t, name) in pulses]
+    played = sorted(p.run(), key=lambda pulse: pulse[:2])
+    assert [(ch, t) for (ch, t, regs) in played] == [(ch, t) for (ch, t, name) in sorted(expected)]
+    for ((ch, t, regs), (_, _, name)) in zip(played, sorted(expected)):
+        cfg = cfgs[name]
+        assert (regs["freq"], regs["gain"], regs["mode"] & 0xffff) == (p.freq2reg(cfg["freq"]), cfg["gain"], cfg["length"]), (ch, t, name)
+
+
+def test_assets_are_read_from_memory(compile_program):
+    os.makedirs("envelope_data")
+    for name in ["env_a", "env_b"]:
+        np.save(f"envelope_data/{name}.npy", np.full(48, 100, dtype=np.int16))
+    with open("waveform_cfg/A.json", "w") as file:
+        json.dump({"style": "arb", "freq": 100, "gain": 1000, "phase": 0, "length": 3,
+                   "i_data_name": "env_a", "q_data_name": "env_b"}, file)
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": {"ch6": "[A, 10, X]"}}, file)
+    # room for one envelope
+    assets = AssetRegistry({"program": "program_cfg", "waveform": "waveform_cfg", "envelope": "envelope_data"},
+                           max_envelope_bytes=96)
+    assets.envelope("env_a")
+    assets.envelope("env_b")
+    assert assets.envelope_bytes == 96 and list(assets._envelopes) == ["env_b"]
+
+    # the configs are parsed, the compiler doesn't need the files any more
+    for name in ["A", "X"]:
+        os.remove(f"waveform_cfg/{name}.json")
+    os.remove("program_cfg/test.json")
+    p = MockProgram(MockSoc())
+    Compiler(p, assets=assets).compile("test")
+    assert start_times(p) == [(6, 200), (6, 210 + 3)]
+
+
+def test_update_matches_a_new_compilation(compile_program):
+    prog_structure = {"ch6": "[X, loop(10, [Y, 10, X])]", "ch7": "[Y, 5, X]"}
+    compile_program(prog_structure)
+    p = MockProgram(MockSoc())
+    compiler = Compiler(p)
+    compiler.compile("test")
+    with open("waveform_cfg/X.json", "w") as file:
+        json.dump({"style": "const", "freq": 250, "gain": 2000, "phase": 30, "length": 10}, file)
+    compiler.assets.add("waveform", "X")
+    assert compiler.update("waveform", "X")
+    assert p.prog_list == compile_program(prog_structure).prog_list
+
+    # a longer pulse moves the pulses after it
+    with open("waveform_cfg/X.json", "w") as file:
+        json.dump({"style": "const", "freq": 250, "gain": 2000, "phase": 30, "length": 15}, file)
+    compiler.assets.add("waveform", "X")
+    assert not compiler.update("waveform", "X")
+
+
+def test_sweep_points_run_from_one_program(compile_program):
+    compile_program({"ch6": "[X]"})
+    sweeps = [{"name": "tau", "start": 10, "step": 5, "count": 4},
+              {"pulse": "X", "field": "gain", "start": -1000, "step": 10, "count": 250}]
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": {"ch6": "[X, 20, tau, Y, 100]", "ch7": "[Y]"}, "sweeps": sweeps}, file)
+    p = MockProgram(MockSoc())
+    Compiler(p).compile("test")
+    # the program doesn't grow with the number of sweep points
+    assert count(p, "set") == 3
+
+    expected = []
+    t = 200
+    for i in range(4):
+        tau = 10 + 5 * i
+        for j in range(250):
+            expected += [(6, t, (-1000 + 10 * j) % 2**32), (7, t, 1000), (6, t + 30 + tau, 1000)]
+            t += 150 + tau
+    assert sorted((ch, t, regs["gain"]) for (ch, t, regs) in p.run()) == sorted(expected)
+
+    # a swept wait shifts everything after it, the other channels must not play across it
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": {"ch6": "[X, tau, Y]", "ch7": "[Y]"}, "sweeps": sweeps}, file)
+    compiler = Compiler(MockProgram(MockSoc()))
+    with pytest.raises(RuntimeError, match="ch7 plays during swept tau"):
+        compiler.compile("test")
+
+
+def test_swept_loop_count_and_phase(compile_program):
+    compile_program({"ch6": "[X]"})
+    sweeps = [{"name": "n", "start": 1, "step": 2, "count": 3},
+              {"pulse": "Y", "field": "phase", "start": 0, "step": 90, "count": 8}]
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": {"ch6": "[loop(n, [X, 10]), Y]"}, "sweeps": sweeps}, file)
+    p = MockProgram(MockSoc())
+    Compiler(p).compile("test")
+    pulses = p.run()
+    assert len(pulses) == 8 * (1 + 3 + 5) + 24
+    for i in range(3):
+        for k in range(8):
+            n = 1 + 2 * i
+            (point, pulses) = (pulses[:n + 1], pulses[n + 1:])
+            assert [regs["phase"] for (ch, t, regs) in point] == [0] * n + [p.deg2reg(90 * k)]
+            assert point[-1][1] - point[0][1] == 20 * n
+
+
+def test_timeline_matches_the_played_pulses(compile_program):
+    compile_program({"ch6": "[X]"})
+    sweeps = [{"name": "tau", "start": 100, "step": 50, "count": 3},
+              {"pulse": "Y", "field": "gain", "start": 0, "step": 100, "count": 4}]
+    with open("program_cfg/test.json", "w") as file:
+        json.dump({"prog_structure": {"ch6": "[X, loop(3, [tau, Y, tau]), 70000, X]", "ch5": "[X, loop(3, [tau, 20, tau])]"},
+                   "sweeps": sweeps}, file)
+    p = MockProgram(MockSoc())
+    compiler = Compiler(p)
+    compiler.compile("test")
+    (table, info) = compiler.timeline()
+    assert [(int(ch), int(t)) for (ch, t, regs) in p.run()] == list(zip(table["ch"].tolist(), table["start"].tolist()))
+    assert info["rows"] == len(table) == 12 * (3 + 3)
+    y = table[np.array(info["pulses"])[table["pulse"]] == "Y"]
+    assert np.all(y["duration"] == 20) and np.all(y["page"] == compiler.page_LUT["Y"])
+    assert set(np.array(info["loop_paths"])[y["loop_path"]]) == {"LOOP_0/LOOP_1/LOOP_2"}
+    assert np.array_equal(compiler.timeline(5, 8)[0], table[5:8])
+
+
+def test_simulated_samples(compile_program):
+    with open("waveform_cfg/R.json", "w") as file:
+        json.dump({"style": "const", "freq": 100, "gain": -500, "phase": 90, "length": 10, "phrst": 1}, file)
+    os.makedirs("envelope_data")
+    np.save("envelope_data/env.npy", np.full(48, 2000, dtype=np.int16))
+    with open("waveform_cfg/A.json", "w") as file:
+        json.dump({"style": "arb", "freq": 100, "gain": 16383, "phase": 0, "length": 3, "i_data_name": "env",
+                   "stdysel": "last", "outsel": "input"}, file)
+    p = compile_program({"ch6": "[X, 10, X, 30, R, loop(100, [A, 20])]"})
+    sim = WaveformSimulator(p)
+    samples = sim.waveform(6)
+    f = p.freq2reg(100) / 2**32
+    n = np.arange(160)
+    # the DDS runs on between the pulses, R resets its phase
+    assert np.allclose(samples[200 * 16:210 * 16], 1000 * np.cos(2 * np.pi * f * n))
+    assert np.allclose(samples[220 * 16:230 * 16], 1000 * np.cos(2 * np.pi * f * (n + 320)))
+    assert np.all(samples[210 * 16:220 * 16] == 0)
+    assert np.allclose(samples[260 * 16:270 * 16], -500 * np.cos(2 * np.pi * (f * n + 0.25)))
+    # the last sample of A is held until the next A
+    assert np.allclose(samples[270 * 16:], 2000 * 16383 / p.soccfg['gens'][6]['maxv'])
+    assert sim.end(6) == 270 + 100 * 23 - 20
+
+    # the samples don't depend on the chunks, the timeline gives the same samples as running the program
+    compiler = Compiler(MockProgram(MockSoc()))
+    compiler.compile("test")
+    chunks = list(WaveformSimulator.from_compiler(compiler).render(6, chunk=7, iq=True))
+    assert max(len(chunk) for chunk in chunks) == 7 * 16
+    assert np.allclose(np.concatenate(chunks).real, samples)
@@ -0,0 +1,43 @@
+import pytest
+
+from prog_parser import *
+
+
+def test_parse_nested_loops():
+    nodes = parse_program_line("[X_half, 200, loop(2, [X, 400, loop(n, [ Y ])]), X_half]")
+    assert repr(nodes) == "(Pulse('X_half'), Wait(200), Loop(2, [Pulse('X'), Wait(400), Loop(n, [Pulse('Y')])]), Pulse('X_half'))"
+    # positions of the nodes in the line
+    assert [node.pos for node in nodes] == [1, 9, 14, 49]
+    assert parse_program_line("[]") == ()
+    assert parse_program_line(" [ loop ( 3 , [ ] ) ] ")[0].count == 3
+
+
+def test_trailing_commas_are_accepted():
+    assert repr(parse_program_line("[X, 10,]")) == "(Pulse('X'), Wait(10))"
+    assert repr(parse_program_line("[loop(2, [X, ]), ]")) == "(Loop(2, [Pulse('X')]),)"
+
+
+@pytest.mark.parametrize("prog_line, msg", [
+    ("[X, 10", "expected ',' or ']' at position 6"),
+    ("[X,, Y]", "expected a pulse name, a wait time or a loop at position 3"),
+    ("[X] Y", "unexpected characters after the end of the program at position 4"),
+    ("X, Y]", "expected '\\[' at position 0"),
+    ("[loop(2, X)]", "expected '\\[' at position 9"),
+    ("[loop(2, [X]]", "expected '\\)' at position 12"),
+])
+def test_errors_have_positions(prog_line, msg):
+    with pytest.raises(RuntimeError, match=f"Compilation Error: {msg} of '"):
+        Parser(prog_line).parse()
+
+
+def test_program_lines_are_parsed_once():
+    parse_program_line.cache_clear()
+    nodes = parse_program_line("[X, loop(5, [Y, 10])]")
+    # the cached AST is shared, not parsed again
+    assert parse_program_line("[X, loop(5, [Y, 10])]") is nodes
+    assert parse_program_line.cache_info().hits == 1
+    # errors are not cached
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            parse_program_line("[X")
+    assert parse_program_line.cache_info().currsize == 1
@@ -0,0 +1,527 @@
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from FPGA_AWG import *
+from FPGA_AWG_client import *
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def awg(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(FPGA_AWG, "waveform_dir_path", str(tmp_path / "waveform_cfg"))
+    monkeypatch.setattr(FPGA_AWG, "envelope_dir_path", str(tmp_path / "envelope_data"))
+    monkeypatch.setattr(FPGA_AWG, "program_dir_path", str(tmp_path / "program_cfg"))
+    monkeypatch.setattr(FPGA_AWG, "port", free_port())
+    monkeypatch.setattr(FPGA_AWG, "compile_workers", 4)
+    awg = FPGA_AWG(backend="mock")
+    threading.Thread(target=awg.run_server, daemon=True).start()
+    # wait for the server to listen
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", FPGA_AWG.port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return awg
+
+
+def connect(pipelined=True, structured=True):
+    client = FPGA_AWG_client(pipelined=pipelined, structured=structured)
+    client.connect("127.0.0.1", FPGA_AWG.port)
+    client.client_socket.settimeout(10)
+    return client
+
+
+def test_many_pollers_while_uploading(awg, tmp_path):
+    num_pollers = 32
+    num_polls = 25
+    results = [None] * num_pollers
+
+    def poll(i):
+        client = connect()
+        acks = []
+        for _ in range(num_polls):
+            client.get_state()
+            acks += client.wait_all().values()
+        client.disconnect()
+        results[i] = acks
+    pollers = [threading.Thread(target=poll, args=(i,)) for i in range(num_pollers)]
+    for thread in pollers:
+        thread.start()
+
+    # meanwhile another client sets up and runs a program
+    client = connect()
+    for i in range(20):
+        path = tmp_path / f"P{i}.json"
+        path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": i, "length": 10}))
+        client.upload_waveform_cfg(str(path), f"P{i}")
+    path = tmp_path / "prog.json"
+    path.write_text(json.dumps({"prog_structure": {"ch6": "[" + ", ".join(f"P{i}, 10" for i in range(20)) + "]"}}))
+    client.upload_program(str(path), "prog")
+    client.start_program("prog")
+    client.stop_program()
+    acks = list(client.wait_all().values())
+    client.disconnect()
+
+    for thread in pollers:
+        thread.join()
+    assert all(ack["status"] == "ok" for ack in acks)
+    assert acks[-2]["payload"]["program"] == "prog"
+    assert acks[-1]["payload"] == {"state": "listening"}
+    for acks in results:
+        assert len(acks) == num_polls
+        assert all(ack["payload"]["state"] in FPGA_AWG.STATE_TRANSITIONS for ack in acks)
+
+
+def test_read_only_commands_are_not_blocked(awg, tmp_path):
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    uploader = connect()
+    poller = connect()
+    # a long mutating command holds the lock
+    with awg._lock:
+        uploader.upload_waveform_cfg(str(path), "X")
+        poller.get_state()
+        (ack,) = poller.wait_all().values()
+        assert ack["payload"] == {"state": "listening", "armed_program": None}
+        assert uploader._pending != {}
+    (ack,) = uploader.wait_all().values()
+    assert ack["payload"] == {"name": "X", "updated_programs": []}
+    uploader.disconnect()
+    poller.disconnect()
+
+
+def test_arm_and_fire(awg, tmp_path):
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    prog_path = tmp_path / "prog.json"
+    prog_path.write_text(json.dumps({"prog_structure": {"ch6": "[X, 10, X]"}}))
+    client = connect()
+    client.upload_waveform_cfg(str(path), "X")
+    client.upload_program(str(prog_path), "prog")
+    client.fire()
+    client.arm_program("prog")
+    client.get_state()
+    acks = list(client.wait_all().values())
+    assert (acks[2]["status"], acks[2]["error"]) == ("error", "StateError")
+    assert acks[3]["payload"]["program"] == "prog" and not acks[3]["payload"]["cached"]
+    assert acks[4]["payload"] == {"state": "armed", "armed_program": "prog"}
+    instructions_written = awg.soc.instructions_written
+
+    # back to back shots only start the tproc
+    client.fire()
+    client.fire()
+    acks = list(client.wait_all().values())
+    assert all(ack["payload"]["program"] == "prog" for ack in acks)
+    assert awg.soc.start_count == 2
+    assert awg.soc.instructions_written == instructions_written
+
+    # stopping replaces the program in the tproc, so it has to be armed again
+    client.stop_program()
+    client.fire()
+    client.arm_program("prog")
+    # changing a file of the armed program disarms it
+    client.upload_waveform_cfg(str(path), "X")
+    client.get_state()
+    acks = list(client.wait_all().values())
+    assert acks[1]["error"] == "StateError"
+    assert acks[2]["payload"]["cached"]
+    assert acks[4]["payload"]["state"] == "listening"
+    client.disconnect()
+
+
+def test_compile_jobs(awg, tmp_path):
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    client = connect()
+    client.upload_waveform_cfg(str(path), "X")
+    for name, prog_structure in [("prog", {"ch6": "[X, 10, X]"}),
+                                 ("broken", {"ch6": "[X, Z]"}),
+                                 # loops that start at different times are unrolled, this takes a while to compile
+                                 ("slow", {f"ch{ch}": f"[{ch}, loop(10000, [X, 10, X, 10])]" for ch in range(8)})]:
+        prog_path = tmp_path / f"{name}.json"
+        prog_path.write_text(json.dumps({"prog_structure": prog_structure}))
+        client.upload_program(str(prog_path), name)
+    client.wait_all()
+
+    def job_status(job_id):
+        client.get_job_status(job_id)
+        (ack,) = client.wait_all().values()
+        return ack["payload"]
+
+    client.compile_program("slow")
+    client.compile_program("prog")
+    client.compile_program("broken")
+    acks = list(client.wait_all().values())
+    assert [ack["payload"] for ack in acks] == [{"job_id": i, "program": name} for i, name in enumerate(["slow", "prog", "broken"])]
+    while any(job_status(i)["state"] in ["queued", "running"] for i in [1, 2]):
+        time.sleep(0.01)
+    assert (job_status(0)["program"], job_status(0)["state"]) == ("slow", "running")
+    assert (job_status(1)["program"], job_status(1)["state"]) == ("prog", "done")
+    assert job_status(2)["state"] == "failed" and "Compilation Error" in job_status(2)["error"]
+
+    # the server keeps answering while slow compiles, and the compiled program is armed from the cache
+    client.arm_program("prog")
+    client.cancel_job(0)
+    client.cancel_job(1)
+    acks = list(client.wait_all().values())
+    assert acks[0]["payload"]["cached"]
+    assert acks[1]["payload"] == {"job_id": 0, "cancelled": True}
+    assert acks[2]["payload"] == {"job_id": 1, "cancelled": False}
+    assert job_status(0)["state"] == "cancelled"
+    client.disconnect()
+
+
+def test_structured_responses(awg, tmp_path):
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    client = connect(pipelined=False)
+    assert client.upload_waveform_cfg(str(path), "X") == {"name": "X", "updated_programs": []}
+    assert client.get_waveform_lst() == ["X"]
+    with pytest.raises(AWGServerError) as e:
+        client.arm_program("missing")
+    assert e.value.error == "NotFoundError"
+    with pytest.raises(AWGServerError) as e:
+        with client.batch():
+            client.set_trigger_mode("internal")
+            client.fire()
+    assert e.value.error == "BatchError"
+    assert [(r["command"], r["error"]) for r in client.batch_result] == [("SET_TRIGGER_MODE", None), ("FIRE", "StateError")]
+    client.disconnect()
+
+    # clients that don't ask for JSON keep getting the text acks
+    client = connect(pipelined=False, structured=False)
+    assert client.get_state() == "[Server acknowledgement]: Current state is listening..."
+    client.disconnect()
+
+
+def test_dependencies_and_incremental_update(awg, tmp_path):
+    client = connect(pipelined=False)
+    np.save(tmp_path / "env.npy", np.full(48, 100, dtype=np.int16))
+    client.upload_envelope_data(str(tmp_path / "env.npy"), "env")
+    for name, cfg in [("X", {"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}),
+                      ("A", {"style": "arb", "freq": 100, "gain": 1000, "phase": 0, "length": 3, "i_data_name": "env"})]:
+        path = tmp_path / f"{name}.json"
+        path.write_text(json.dumps(cfg))
+        client.upload_waveform_cfg(str(path), name)
+    prog_path = tmp_path / "prog.json"
+    prog_path.write_text(json.dumps({"prog_structure": {"ch6": "[X, 10, A]"}}))
+    client.upload_program(str(prog_path), "prog")
+    assert client.get_dependencies("prog") == [{"kind": "program", "name": "prog", "used_by": [],
+                                                "uses": [["envelope", "env"], ["waveform", "A"], ["waveform", "X"]]}]
+    assert client.get_dependencies("env")[0]["used_by"] == [["program", "prog"], ["waveform", "A"]]
+    client.arm_program("prog")
+
+    # a new phase or a new envelope of the same length only patches the cached program
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 45, "length": 10}))
+    assert client.upload_waveform_cfg(str(path), "X")["updated_programs"] == ["prog"]
+    np.save(tmp_path / "env.npy", np.full(48, 200, dtype=np.int16))
+    assert client.upload_envelope_data(str(tmp_path / "env.npy"), "env")["updated_programs"] == ["prog"]
+    # the report describes the updated program
+    assert client.get_compile_report("prog")["patched"] == [["waveform", "X"], ["envelope", "env"]]
+    assert client.arm_program("prog")["cached"]
+    pulses = awg.soc.program.run()
+    assert pulses[0][2]["phase"] == awg.awg_prog.deg2reg(45)
+    assert np.all(awg.soc.program.envelopes[6]["A"]["data"] == 200)
+
+    # a new length changes the schedule, the program is compiled again
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 45, "length": 20}))
+    assert client.upload_waveform_cfg(str(path), "X")["updated_programs"] == []
+    assert not client.arm_program("prog")["cached"]
+    client.disconnect()
+
+
+def test_update_live_pulse(awg, tmp_path):
+    client = connect(pipelined=False)
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    client.upload_waveform_cfg(str(path), "X")
+    prog_path = tmp_path / "prog.json"
+    prog_path.write_text(json.dumps({"prog_structure": {"ch6": "[X, 10, X]", "ch7": "[X]"}, "live_pulses": ["X"]}))
+    client.upload_program(str(prog_path), "prog")
+    with pytest.raises(AWGServerError) as e:
+        client.update_pulse("X", gain=2000)
+    assert e.value.error == "StateError"
+
+    client.arm_program("prog")
+    client.fire()
+    config_count = awg.soc.config_count
+    # the running program is neither compiled nor loaded again
+    result = client.update_pulse("X", gain=-2000, phase=90)
+    assert result["params"] == {"phase": 90, "gain": -2000}
+    assert awg.soc.config_count == config_count and client.get_state()["state"] == "firing"
+    pulses = awg.soc.program.run(dmem=awg.soc.tproc.dmem)
+    assert [(regs["gain"], regs["phase"]) for (ch, t, regs) in pulses] == [(-2000 % 2**32, 2**30)] * 3
+
+    with pytest.raises(AWGServerError) as e:
+        client.update_pulse("Y", gain=2000)
+    assert e.value.error == "InvalidArgumentError"
+    client.disconnect()
+
+
+def test_timeline(awg, tmp_path):
+    client = connect(pipelined=False)
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    client.upload_waveform_cfg(str(path), "X")
+    prog_path = tmp_path / "prog.json"
+    prog_path.write_text(json.dumps({"prog_structure": {"ch6": "[X, loop(1000, [X, loop(1000, [X, 10])])]"}}))
+    client.upload_program(str(prog_path), "prog")
+    with pytest.raises(AWGServerError) as e:
+        client.get_timeline("prog")
+    assert e.value.error == "NotFoundError"
+
+    client.arm_program("prog")
+    table = client.get_timeline("prog")
+    assert len(table) == client.timeline_info["total_rows"] == 1 + 1000 * 1001
+    assert table.dtype == Compiler.TIMELINE_DTYPE and np.all(np.diff(table["start"]) >= 10)
+    rows = client.get_timeline("prog", start=1000, stop=1010)
+    assert np.array_equal(rows, table[1000:1010]) and client.timeline_info["rows"] == 10
+    client.disconnect()
+
+
+def test_compile_report(awg, tmp_path):
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    prog_path = tmp_path / "prog.json"
+    prog_path.write_text(json.dumps({"prog_structure": {"ch6": "[X, loop(100, [X, 1000])]"}}))
+    bad_path = tmp_path / "bad.json"
+    bad_path.write_text(json.dumps({"prog_structure": {"ch6": "[X, Z]"}}))
+    client = connect(pipelined=False)
+    client.upload_waveform_cfg(str(path), "X")
+    client.upload_program(str(prog_path), "prog")
+    client.upload_program(str(bad_path), "bad")
+
+    report = client.start_program("prog")["report"]
+    assert report["phase"] is None
+    assert set(report["timings"]) == set(Compiler.COMPILE_PHASES + ["compile", "config_all"])
+    assert report["instructions"] == len(awg.awg_prog.prog_list)
+    assert report["instruction_capacity"] == awg.soc["tprocs"][0]["pmem_size"]
+    # 4 registers of X and the time register
+    assert report["registers"]["used"] == 5
+    assert report["end_time"] == 200 + 10 + 99 * 1010 + 10
+    assert client.get_compile_report("prog") == report
+    client.stop_program()
+
+    # a failed compilation reports the phase it failed in
+    with pytest.raises(AWGServerError) as e:
+        client.start_program("bad")
+    assert e.value.error == "CompilationError" and e.value.payload["report"]["phase"] == "pulse_cfg"
+    assert client.get_compile_report("bad")["phase"] == "pulse_cfg"
+    client.disconnect()
+
+
+def test_metrics(awg, tmp_path):
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    prog_path = tmp_path / "prog.json"
+    prog_path.write_text(json.dumps({"prog_structure": {"ch6": "[X, 10, X]"}}))
+    client = connect(pipelined=False)
+    client.upload_waveform_cfg(str(path), "X")
+    client.upload_program(str(prog_path), "prog")
+    for _ in range(3):
+        client.get_state()
+    client.start_program("prog")
+    client.stop_program()
+    client.start_program("prog")
+    client.stop_program()
+    with pytest.raises(AWGServerError):
+        client.stop_program()
+    with pytest.raises(AWGServerError):
+        client.send_command("NO_SUCH_COMMAND")
+        client.receive_server_ack()
+
+    payload = client.get_metrics()
+    metrics = payload["metrics"]
+    assert payload["state"] == "listening"
+    commands = metrics["command_seconds"]
+    assert commands["GET_STATE"]["count"] == 3 and commands["STOP_PROGRAM"]["count"] == 3
+    assert commands["unknown"]["count"] == 1
+    assert sum(commands["GET_STATE"]["buckets"]) == 3
+    assert metrics["errors_total"] == {"StateError": 1, "UnknownCommandError": 1}
+    assert metrics["files_received_total"] == 2
+    assert metrics["received_bytes_total"] == path.stat().st_size + prog_path.stat().st_size
+    assert metrics["connections_open"] == 1
+    # the second start is cached
+    assert metrics["compiles_total"] == {"done": 1, "cached": 1}
+    assert metrics["compile_seconds"]["count"] == 1 and metrics["config_all_seconds"]["count"] == 2
+    assert metrics["state_transitions_total"] == {"listening": 3, "armed": 2, "firing": 2}
+    assert metrics["state_seconds_total"]["listening"] > 0
+
+    awg.metrics.write_prometheus(str(tmp_path / "awg.prom"))
+    text = (tmp_path / "awg.prom").read_text()
+    assert "# TYPE awg_command_seconds histogram" in text
+    assert 'awg_command_seconds_count{command="GET_STATE"} 3' in text
+    assert 'awg_command_seconds_bucket{command="GET_STATE",le="+Inf"} 3' in text
+    assert 'awg_errors_total{error="StateError"} 1' in text
+    client.disconnect()
+
+
+def test_metrics_overhead(awg):
+    # what a command adds to the hot path: one histogram observation, and a counter for an error
+    metrics = Metrics()
+    metrics.describe("command_seconds", "histogram", "", label="command")
+    metrics.describe("errors_total", "counter", "", label="error")
+    # the best of several runs, so a busy machine doesn't make the test flaky
+    n = 2000
+    overhead = float("inf")
+    for _ in range(10):
+        t = time.perf_counter()
+        for _ in range(n):
+            metrics.observe("command_seconds", 1e-4, label="GET_STATE")
+            metrics.inc("errors_total", label="StateError")
+        overhead = min(overhead, (time.perf_counter() - t) / n)
+
+    client = connect(pipelined=False)
+    client.get_state()
+    n = 200
+    t = time.perf_counter()
+    for _ in range(n):
+        client.get_state()
+    latency = (time.perf_counter() - t) / n
+    client.disconnect()
+    assert overhead < 0.02 * latency
+
+
+def test_large_uploads_stay_framed(awg, tmp_path):
+    # larger than the receive buffer, so it's received in several pieces
+    assert awg.buffer_size == 2**20
+    prog_path = tmp_path / "prog.json"
+    prog_path.write_text(json.dumps({"prog_structure": {"ch6": "[X]"}, "notes": "x" * (3 * 2**20 + 12345)}))
+    data = np.arange(2**20 + 7, dtype=np.int16)
+    client = connect(pipelined=False)
+    client.upload_program(str(prog_path), "prog")
+    client.upload_envelope_array(data, "E")
+    # the next commands are read from the right place
+    assert client.get_state()["state"] == "listening"
+    assert client.get_program_lst() == ["prog"]
+    client.disconnect()
+    assert (tmp_path / "program_cfg" / "prog.json").read_bytes() == prog_path.read_bytes()
+    assert np.array_equal(np.load(tmp_path / "envelope_data" / "E.npy"), data)
+
+
+def test_request_ids_in_text_mode(awg):
+    client = connect(pipelined=False, structured=False)
+    client.send_string("#7 GET_STATE")
+    assert client._receive_string() == "#7 [Server acknowledgement]: Current state is listening..."
+    # untagged requests get untagged acks
+    assert client.get_state() == "[Server acknowledgement]: Current state is listening..."
+    client.disconnect()
+
+    client = connect(pipelined=True, structured=False)
+    client.get_state()
+    client.delete_waveform_cfg("missing")
+    client.get_program_lst()
+    acks = client.wait_all()
+    assert list(acks) == [0, 1, 2]
+    assert acks[0] == "[Server acknowledgement]: Current state is listening..."
+    assert acks[2] == "[Server acknowledgement]: Current program list: []"
+    client.disconnect()
+
+
+def test_batch_with_a_failing_command(awg, tmp_path):
+    paths = {}
+    for name in ["X", "Y"]:
+        paths[name] = tmp_path / f"{name}.json"
+        paths[name].write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    client = connect(pipelined=False)
+    with pytest.raises(AWGServerError) as e:
+        with client.batch():
+            client.upload_waveform_cfg(str(paths["X"]), "X")
+            client.delete_program("missing")
+            client.upload_waveform_cfg(str(paths["Y"]), "Y")
+            client.get_waveform_lst()
+    assert e.value.error == "BatchError"
+    # the commands after the failing one still run, and their arguments (the files) are consumed
+    assert [(r["command"], r["status"], r["error"]) for r in client.batch_result] == [
+        ("UPLOAD_WAVEFORM_CFG", "ok", None), ("DELETE_PROGRAM", "error", "NotFoundError"),
+        ("UPLOAD_WAVEFORM_CFG", "ok", None), ("GET_WAVEFORM_LIST", "ok", None)]
+    assert client.batch_result[-1]["payload"] == ["X", "Y"]
+    # the connection is still framed after END_BATCH
+    assert client.get_state()["state"] == "listening"
+    # a batch in a batch is refused, the batch goes on
+    client.send_string("BATCH")
+    client.send_string("BATCH")
+    client.send_string("GET_STATE")
+    client.send_string("END_BATCH")
+    with pytest.raises(AWGServerError) as e:
+        client.receive_server_ack()
+    assert [r["status"] for r in e.value.payload] == ["error", "ok"]
+    client.disconnect()
+
+
+def test_uncollected_compile_results_are_kept(awg, tmp_path, monkeypatch):
+    monkeypatch.setattr(CompileJobs, "max_finished_jobs", 1)
+    path = tmp_path / "X.json"
+    path.write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    client = connect(pipelined=False)
+    client.upload_waveform_cfg(str(path), "X")
+    for name, prog_structure in [("prog", {"ch6": "[X, 10, X]"}), ("broken", {"ch6": "[X, Z]"})]:
+        prog_path = tmp_path / f"{name}.json"
+        prog_path.write_text(json.dumps({"prog_structure": prog_structure}))
+        client.upload_program(str(prog_path), name)
+
+    job_id = client.compile_program("prog")["job_id"]
+    while client.get_job_status(job_id)["state"] != "done":
+        time.sleep(0.01)
+    # more finished jobs than are kept
+    failed = []
+    for _ in range(3):
+        failed.append(client.compile_program("broken")["job_id"])
+        while client.get_job_status(failed[-1])["state"] != "failed":
+            time.sleep(0.01)
+    # nobody took the result of prog yet, it's still there
+    assert client.get_job_status(job_id)["state"] == "done"
+    assert client.arm_program("prog")["cached"]
+    # the older failed jobs are forgotten
+    with pytest.raises(AWGServerError):
+        client.get_job_status(failed[0])
+    client.disconnect()
+
+
+def test_batch_keeps_the_lock_while_compiling(awg, tmp_path):
+    paths = {}
+    for name in ["X", "Y"]:
+        paths[name] = tmp_path / f"{name}.json"
+        paths[name].write_text(json.dumps({"style": "const", "freq": 100, "gain": 1000, "phase": 0, "length": 10}))
+    prog_path = tmp_path / "slow.json"
+    prog_path.write_text(json.dumps({"prog_structure": {f"ch{ch}": f"[{ch}, loop(10000, [X, 10, X, 10])]" for ch in range(8)}}))
+    client = connect(pipelined=False)
+    client.upload_waveform_cfg(str(paths["X"]), "X")
+    client.upload_program(str(prog_path), "slow")
+
+    def run_batch():
+        # slow is too large for the tproc, loading it fails after compiling
+        with pytest.raises(AWGServerError):
+            with client.batch():
+                client.start_program("slow")
+    batch = threading.Thread(target=run_batch)
+    batch.start()
+    other = connect(pipelined=False)
+    # the batch compiles slow in job 0
+    while True:
+        try:
+            if other.get_job_status(0)["state"] == "running":
+                break
+        except AWGServerError:
+            pass
+        time.sleep(0.01)
+    # a mutating command of another client waits for the whole batch
+    other.upload_waveform_cfg(str(paths["Y"]), "Y")
+    assert awg.compile_jobs.status(0)["state"] == "done"
+    batch.join()
+    assert "does not fit" in client.batch_result[0]["message"]
+    client.disconnect()
+    other.disconnect()